@@ -24,7 +24,7 @@ CREATE TABLE `main_config` (
   `description` varchar(200) NOT NULL,
   `display` varchar(8) NOT NULL,
   PRIMARY KEY (`id`)
-) ENGINE=MyISAM AUTO_INCREMENT=33 DEFAULT CHARSET=utf8;
+) ENGINE=MyISAM AUTO_INCREMENT=45 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
 --
@@ -33,7 +33,7 @@ CREATE TABLE `main_config` (
 
 LOCK TABLES `main_config` WRITE;
 /*!40000 ALTER TABLE `main_config` DISABLE KEYS */;
-INSERT INTO `main_config` VALUES (1,'google_key','','Google API Key','The Google API key used for Google Search and Google Pagespeed.','password'),(2,'max_keyword_results','20','Keyword Rank Max Results','The maximum number of search results to review when determining keyword rankings.','string'),(3,'max_google_api_calls','1000','Keyword Rank Max API Calls','The maximum number of Google search API calls that Quinico is permitted to make each day.  Google provides 100 free API calls to the Search API per day, beyond which you must setup billing.  If you ar','string'),(4,'seomoz_access_id','','SEOMoz Access ID','The SEOMoz access ID.','string'),(5,'seomoz_secret_key','','SEOMoz Secret Key','The SEOMoz Secret Key.','password'),(6,'wpt_key','','Webpagetest Key','The Webpagetest API Key','password'),(7,'wpt_attempts','30','Webpagetest Attempts','The number of time to check for completion of a test, before skipping the current test and moving on to the next test.','string'),(8,'wpt_wait','120','Webpagetest Wait Time','The amount of time to wait, after a Webpagetest request has been lodged, to check for completion.','string'),(9,'google_wm_username','','Google Webmaster Username','The Google user account username with access to the Webmaster tools for the sites being monitored by Quinico.','string'),(10,'google_wm_password','','Google Webmaster Password','The Google user account password with access to the Webmaster tools for the sites being monitored by Quinico.','password'),(11,'seomoz_account_type','','SEOMoz Account Type','The SEOMoz Account Type (free or paid)','string'),(12,'google_se_id','','Keyword Rank Search Engine ID','The Google custom search engine ID for the Quinico application.  ','string'),(13,'smtp_notify_data_start','0','Notify Data Start','Whether or not to notify via email each time a data job starts.','boolean'),(14,'smtp_notify_seomoz_new','1','SEOMoz Notify New','Notify via email if SEOMoz data is new','boolean'),(15,'dashboard_refresh','1800','Dashboard Refresh','The dashboard needs to be refreshed periodically (for example, to pick up new charts that may have been added).  This is the rate at which the browser refresh will occur, in seconds, for anonymous and logged in users.','string'),(16,'dashboard_slots','2x2','Dashboard Slots','The number of dashboard slots for an anonymous user when running the dashboard application.  The only supported values are 2x2 and 3x3.','string'),(17,'dashboard_width','475','Dashboard Width','The width of dashboard slots for an anonymous user when running the dashboard application.','string'),(18,'dashboard_height','250','Dashboard Height','The height of dashboard slots for an anonymous user when running the dashboard application.','string'),(19,'dashboard_font','14','Dashboard Font','The dashboard font size for an anonymous user.  Dashboard fonts control chart and graph font sizes in the dashboard application.','string'),(20,'dashboard_frequency','5','Dashboard Frequency','The frequency (in seconds) that dashboard charts will be changed for an anonymous user when running the dashboard application.','string'),(21,'alert','','Visual Alert','Display an alert message to users of Quinico on the homepage.  This field supports HTML tags.','string'),(22,'report_path','','Report Download Location','Location on the local file system where Google Pagespeed and Webpagetest raw reports will be saved.  This location must be writeable by the user that runs Apache.','string'),(23,'pagespeed_locale','en','Pagespeed Locale','The locale that results should be generated in.  The only currently supported Locale is en.','string'),(24,'pagespeed_threads','5','Pagespeed Threads','The number of independent worker threads to spawn during data collection.','string'),(25,'wpt_threads','5','Webpagetest Threads','The number of independent worker threads to spawn during data collection.','string'),(26,'keyword_rank_threads','5','Keyword Rank Threads','The number of independent worker threads to spawn during data collection.  ','string'),(27,'webmaster_threads','5','Webmaster Threads','The number of independent worker threads to spawn during data collection.','string'),(28,'disable_pagespeed_reports','0','Disable Pagespeed Reports','Whether or not to display the Pagespeed report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(29,'disable_keyword_rank_reports','0','Disable Keyword Rank Reports','Whether or not to display the Keyword Rank report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(30,'disable_webmaster_reports','0','Disable Webmaster Reports','Whether or not to disable the Webmaster report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(31,'disable_seomoz_reports','0','Disable Seomoz Reports','Whether or not to display the Seomoz report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(32,'disable_webpagetest_reports','0','Disable Webpagetest Reports','Whether or not to disable the Webpagetest report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean');
+INSERT INTO `main_config` VALUES (1,'google_key','','Google API Key','The Google API key used for Google Search and Google Pagespeed.','password'),(2,'max_keyword_results','20','Keyword Rank Max Results','The maximum number of search results to review when determining keyword rankings.','string'),(3,'max_google_api_calls','1000','Keyword Rank Max API Calls','The maximum number of Google search API calls that Quinico is permitted to make each day.  Google provides 100 free API calls to the Search API per day, beyond which you must setup billing.  If you ar','string'),(4,'seomoz_access_id','','SEOMoz Access ID','The SEOMoz access ID.','string'),(5,'seomoz_secret_key','','SEOMoz Secret Key','The SEOMoz Secret Key.','password'),(6,'wpt_key','','Webpagetest Key','The Webpagetest API Key','password'),(7,'wpt_attempts','30','Webpagetest Attempts','The number of time to check for completion of a test, before skipping the current test and moving on to the next test.','string'),(8,'wpt_wait','120','Webpagetest Wait Time','The amount of time to wait, after a Webpagetest request has been lodged, to check for completion.','string'),(9,'google_wm_username','','Google Webmaster Username','The Google user account username with access to the Webmaster tools for the sites being monitored by Quinico.','string'),(10,'google_wm_password','','Google Webmaster Password','The Google user account password with access to the Webmaster tools for the sites being monitored by Quinico.','password'),(11,'seomoz_account_type','','SEOMoz Account Type','The SEOMoz Account Type (free or paid)','string'),(12,'google_se_id','','Keyword Rank Search Engine ID','The Google custom search engine ID for the Quinico application.  ','string'),(13,'smtp_notify_data_start','0','Notify Data Start','Whether or not to notify via email each time a data job starts.','boolean'),(14,'smtp_notify_seomoz_new','1','SEOMoz Notify New','Notify via email if SEOMoz data is new','boolean'),(15,'dashboard_refresh','1800','Dashboard Refresh','The dashboard needs to be refreshed periodically (for example, to pick up new charts that may have been added).  This is the rate at which the browser refresh will occur, in seconds, for anonymous and logged in users.','string'),(16,'dashboard_slots','2x2','Dashboard Slots','The number of dashboard slots for an anonymous user when running the dashboard application.  The only supported values are 2x2 and 3x3.','string'),(17,'dashboard_width','475','Dashboard Width','The width of dashboard slots for an anonymous user when running the dashboard application.','string'),(18,'dashboard_height','250','Dashboard Height','The height of dashboard slots for an anonymous user when running the dashboard application.','string'),(19,'dashboard_font','14','Dashboard Font','The dashboard font size for an anonymous user.  Dashboard fonts control chart and graph font sizes in the dashboard application.','string'),(20,'dashboard_frequency','5','Dashboard Frequency','The frequency (in seconds) that dashboard charts will be changed for an anonymous user when running the dashboard application.','string'),(21,'alert','','Visual Alert','Display an alert message to users of Quinico on the homepage.  This field supports HTML tags.','string'),(22,'report_path','','Report Download Location','Location on the local file system where Google Pagespeed and Webpagetest raw reports will be saved.  This location must be writeable by the user that runs Apache.','string'),(23,'pagespeed_locale','en','Pagespeed Locale','The locale that results should be generated in.  The only currently supported Locale is en.','string'),(24,'pagespeed_threads','5','Pagespeed Threads','The number of independent worker threads to spawn during data collection.','string'),(25,'wpt_threads','5','Webpagetest Threads','The number of independent worker threads to spawn during data collection.','string'),(26,'keyword_rank_threads','5','Keyword Rank Threads','The number of independent worker threads to spawn during data collection.  ','string'),(27,'webmaster_threads','5','Webmaster Threads','The number of independent worker threads to spawn during data collection.','string'),(28,'disable_pagespeed_reports','0','Disable Pagespeed Reports','Whether or not to display the Pagespeed report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(29,'disable_keyword_rank_reports','0','Disable Keyword Rank Reports','Whether or not to display the Keyword Rank report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(30,'disable_webmaster_reports','0','Disable Webmaster Reports','Whether or not to disable the Webmaster report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(31,'disable_seomoz_reports','0','Disable Seomoz Reports','Whether or not to display the Seomoz report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(32,'disable_webpagetest_reports','0','Disable Webpagetest Reports','Whether or not to disable the Webpagetest report interfaces.  Setting this to true hides the report interfaces but data jobs, if enabled, will still run.','boolean'),(33,'pagespeed_concurrency','0','Pagespeed Concurrency','The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.','string'),(34,'wpt_concurrency','0','Webpagetest Concurrency','The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.','string'),(35,'keyword_rank_concurrency','0','Keyword Rank Concurrency','The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.','string'),(36,'webmaster_concurrency','0','Webmaster Concurrency','The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.','string'),(37,'sql_slow_query','1','SQL Slow Query Threshold','Data jobs log any SQL statement that takes at least this many seconds, along with its arguments.','string'),(38,'sql_stats_email','0','SQL Statistics Email','Whether or not to email a summary of SQL statement timings at the end of each data job.  The summary is always written to the log.','boolean'),(39,'work_lease','0','Work Queue Lease','If above 0, the keyword rank, pagespeed and webmaster jobs share their work through the database so they can run on several hosts at once.  Seconds to finish an item.','string'),(40,'seomoz_threads','5','SEOMoz Threads','The number of independent worker threads to spawn during data collection.','string'),(41,'seomoz_batch_size','10','SEOMoz Batch Size','The number of urls to request metrics for in each SEOMoz API request.','string'),(42,'seomoz_interval','','SEOMoz Request Interval','The minimum number of seconds between SEOMoz API requests.  If blank, free accounts wait 10 seconds between requests and paid accounts do not wait.','string'),(43,'pagespeed_domain_concurrency','2','Pagespeed Domain Concurrency','The maximum number of Pagespeed requests in flight for any one domain during data collection.  0 for no limit.','string'),(44,'config_version','0','Configuration Version','Changed by Quinico whenever the configuration or help is saved so that cached copies are reloaded.','string');
 /*!40000 ALTER TABLE `main_config` ENABLE KEYS */;
 UNLOCK TABLES;
 
@@ -50,6 +50,7 @@ CREATE TABLE `main_data_job` (
   `job_status` tinyint(1) NOT NULL,
   `job_hour` varchar(25) COLLATE utf8_unicode_ci NOT NULL,
   `job_minute` varchar(25) COLLATE utf8_unicode_ci NOT NULL,
+  `data_version` int(11) NOT NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY `job_name` (`job_name`)
 ) ENGINE=MyISAM AUTO_INCREMENT=6 DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
@@ -61,7 +62,7 @@ CREATE TABLE `main_data_job` (
 
 LOCK TABLES `main_data_job` WRITE;
 /*!40000 ALTER TABLE `main_data_job` DISABLE KEYS */;
-INSERT INTO `main_data_job` VALUES (1,'pagespeed',0,'06','05'),(2,'keyword_rank',0,'07','05'),(3,'webmaster',0,'08','05'),(4,'seomoz',0,'09','05'),(5,'webpagetest',0,'10','05');
+INSERT INTO `main_data_job` VALUES (1,'pagespeed',0,'06','05',0),(2,'keyword_rank',0,'07','05',0),(3,'webmaster',0,'08','05',0),(4,'seomoz',0,'09','05',0),(5,'webpagetest',0,'10','05',0);
 /*!40000 ALTER TABLE `main_data_job` ENABLE KEYS */;
 UNLOCK TABLES;
 
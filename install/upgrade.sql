@@ -0,0 +1,242 @@
+--
+-- Quinico database upgrade
+--
+-- Run this against an existing Quinico database after upgrading the source
+-- (new installs get these changes from syncdb and do not need it), e.g.:
+--   mysql -u <user> -p <database> < install/upgrade.sql
+--
+
+--
+-- The local dates of the pagespeed and webpagetest scores are filled in
+-- from UTC, so set @time_zone to the TIME_ZONE in settings.py before
+-- running this.  The MySQL time zone tables must be loaded for CONVERT_TZ
+-- to accept it (mysql_tzinfo_to_sql /usr/share/zoneinfo | mysql -u root mysql).
+--
+
+SET @time_zone = '';
+
+-- Stop here, before anything is changed, if the time zone is not set or
+-- not known to MySQL (CONVERT_TZ returns NULL and the insert fails)
+CREATE TEMPORARY TABLE `upgrade_time_zone_check` (`now` datetime NOT NULL);
+
+INSERT INTO `upgrade_time_zone_check` (`now`) VALUES (CONVERT_TZ(NOW(),'UTC',@time_zone));
+
+DROP TEMPORARY TABLE `upgrade_time_zone_check`;
+
+--
+-- keyword_rank_url: add an indexed SHA1 hash of the url and remove duplicate urls
+--
+
+ALTER TABLE `keyword_rank_url` ADD COLUMN `url_hash` varchar(40) NOT NULL DEFAULT '';
+
+UPDATE `keyword_rank_url` SET `url_hash` = SHA1(`url`);
+
+-- Map every duplicate url to the lowest id with the same hash
+CREATE TEMPORARY TABLE `keyword_rank_url_dedupe` AS
+  SELECT `u`.`id` AS `old_id`, `k`.`keep_id` AS `new_id`
+  FROM `keyword_rank_url` `u`
+  INNER JOIN (SELECT `url_hash`, MIN(`id`) AS `keep_id`
+              FROM `keyword_rank_url`
+              GROUP BY `url_hash`) `k` ON `u`.`url_hash` = `k`.`url_hash`
+  WHERE `u`.`id` <> `k`.`keep_id`;
+
+ALTER TABLE `keyword_rank_url_dedupe` ADD PRIMARY KEY (`old_id`);
+
+UPDATE `keyword_rank_rank` `r`
+  INNER JOIN `keyword_rank_url_dedupe` `d` ON `r`.`url_id` = `d`.`old_id`
+  SET `r`.`url_id` = `d`.`new_id`;
+
+UPDATE `keyword_rank_top_ten` `t`
+  INNER JOIN `keyword_rank_url_dedupe` `d` ON `t`.`url_id` = `d`.`old_id`
+  SET `t`.`url_id` = `d`.`new_id`;
+
+DELETE `u` FROM `keyword_rank_url` `u`
+  INNER JOIN `keyword_rank_url_dedupe` `d` ON `u`.`id` = `d`.`old_id`;
+
+DROP TEMPORARY TABLE `keyword_rank_url_dedupe`;
+
+ALTER TABLE `keyword_rank_url` ALTER COLUMN `url_hash` DROP DEFAULT;
+ALTER TABLE `keyword_rank_url` ADD UNIQUE KEY `url_hash` (`url_hash`);
+
+--
+-- main_config: concurrency for the shared worker mode of the data jobs
+--
+
+INSERT INTO `main_config` (`config_name`,`config_value`,`friendly_name`,`description`,`display`)
+SELECT * FROM (
+  SELECT 'pagespeed_concurrency' AS `config_name`,'0' AS `config_value`,'Pagespeed Concurrency' AS `friendly_name`,'The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.' AS `description`,'string' AS `display`
+  UNION ALL SELECT 'wpt_concurrency','0','Webpagetest Concurrency','The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.','string'
+  UNION ALL SELECT 'keyword_rank_concurrency','0','Keyword Rank Concurrency','The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.','string'
+  UNION ALL SELECT 'webmaster_concurrency','0','Webmaster Concurrency','The number of concurrent workers during data collection.  If above 0, the workers share the database connections of the configured threads.  0 gives each thread its own.','string'
+) `c`
+WHERE NOT EXISTS (SELECT * FROM `main_config` WHERE `main_config`.`config_name` = `c`.`config_name`);
+
+--
+-- main_config: SQL statement timing settings
+--
+
+INSERT INTO `main_config` (`config_name`,`config_value`,`friendly_name`,`description`,`display`)
+SELECT * FROM (
+  SELECT 'sql_slow_query' AS `config_name`,'1' AS `config_value`,'SQL Slow Query Threshold' AS `friendly_name`,'Data jobs log any SQL statement that takes at least this many seconds, along with its arguments.' AS `description`,'string' AS `display`
+  UNION ALL SELECT 'sql_stats_email','0','SQL Statistics Email','Whether or not to email a summary of SQL statement timings at the end of each data job.  The summary is always written to the log.','boolean'
+) `c`
+WHERE NOT EXISTS (SELECT * FROM `main_config` WHERE `main_config`.`config_name` = `c`.`config_name`);
+
+--
+-- main_work_item: work items shared by processes running the same data job
+--
+
+CREATE TABLE IF NOT EXISTS `main_work_item` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `job_name` varchar(25) NOT NULL,
+  `run` varchar(20) NOT NULL,
+  `item_key` varchar(40) NOT NULL,
+  `payload` longtext NOT NULL,
+  `state` int(11) NOT NULL,
+  `owner` varchar(100) NOT NULL,
+  `lease_expires` datetime DEFAULT NULL,
+  `attempts` int(11) NOT NULL,
+  `created` datetime NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `job_name` (`job_name`,`run`,`item_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+INSERT INTO `main_config` (`config_name`,`config_value`,`friendly_name`,`description`,`display`)
+SELECT 'work_lease','0','Work Queue Lease','If above 0, the keyword rank, pagespeed and webmaster jobs share their work through the database so they can run on several hosts at once.  Seconds to finish an item.','string'
+FROM DUAL
+WHERE NOT EXISTS (SELECT * FROM `main_config` WHERE `config_name` = 'work_lease');
+
+--
+-- main_config: SEOMoz data collection settings
+--
+
+INSERT INTO `main_config` (`config_name`,`config_value`,`friendly_name`,`description`,`display`)
+SELECT * FROM (
+  SELECT 'seomoz_threads' AS `config_name`,'5' AS `config_value`,'SEOMoz Threads' AS `friendly_name`,'The number of independent worker threads to spawn during data collection.' AS `description`,'string' AS `display`
+  UNION ALL SELECT 'seomoz_batch_size','10','SEOMoz Batch Size','The number of urls to request metrics for in each SEOMoz API request.','string'
+  UNION ALL SELECT 'seomoz_interval','','SEOMoz Request Interval','The minimum number of seconds between SEOMoz API requests.  If blank, free accounts wait 10 seconds between requests and paid accounts do not wait.','string'
+) `c`
+WHERE NOT EXISTS (SELECT * FROM `main_config` WHERE `main_config`.`config_name` = `c`.`config_name`);
+
+--
+-- main_config: Pagespeed requests in flight per domain
+--
+
+INSERT INTO `main_config` (`config_name`,`config_value`,`friendly_name`,`description`,`display`)
+SELECT 'pagespeed_domain_concurrency','2','Pagespeed Domain Concurrency','The maximum number of Pagespeed requests in flight for any one domain during data collection.  0 for no limit.','string'
+FROM DUAL
+WHERE NOT EXISTS (SELECT * FROM `main_config` WHERE `config_name` = 'pagespeed_domain_concurrency');
+
+--
+-- pagespeed_rule_result, pagespeed_rule_url: rule results of the Pagespeed
+-- reports, saved when the reports are collected
+--
+
+CREATE TABLE IF NOT EXISTS `pagespeed_rule_result` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `score_id` int(11) NOT NULL,
+  `rule_name` varchar(100) NOT NULL,
+  `formatted_name` varchar(255) NOT NULL,
+  `rule_score` int(11) NOT NULL,
+  `rule_impact` double NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `pagespeed_rule_result_score_id` (`score_id`),
+  KEY `pagespeed_rule_result_rule_name` (`rule_name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS `pagespeed_rule_url` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `score_id` int(11) NOT NULL,
+  `rule_name` varchar(100) NOT NULL,
+  `block` int(11) NOT NULL,
+  `header` longtext NOT NULL,
+  `url` longtext NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `pagespeed_rule_url_score_id` (`score_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+--
+-- keyword_rank_summary, keyword_rank_summary_change: daily first page and
+-- rank change counts, saved by the keyword_rank job for the dashboards
+--
+
+CREATE TABLE IF NOT EXISTS `keyword_rank_summary` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `date` date NOT NULL,
+  `domain_id` int(11) NOT NULL,
+  `first_page` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `date` (`date`,`domain_id`),
+  KEY `keyword_rank_summary_domain_id` (`domain_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS `keyword_rank_summary_change` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `date` date NOT NULL,
+  `domain_id` int(11) NOT NULL,
+  `days` int(11) NOT NULL,
+  `up` int(11) NOT NULL,
+  `down` int(11) NOT NULL,
+  `unch` int(11) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `date` (`date`,`domain_id`,`days`),
+  KEY `keyword_rank_summary_change_domain_id` (`domain_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+--
+-- pagespeed_score, webpagetest_score: store the local date of every score
+-- and index it with the test so the trends do not convert every row
+-- (converted from UTC to @time_zone, set at the top of this file)
+--
+
+ALTER TABLE `pagespeed_score` ADD COLUMN `local_date` date NOT NULL;
+
+UPDATE `pagespeed_score` SET `local_date` = DATE(CONVERT_TZ(`date`,'UTC',@time_zone));
+
+ALTER TABLE `pagespeed_score` ADD KEY `pagespeed_score_test_strategy_local_date` (`test_id`,`strategy`,`local_date`);
+
+ALTER TABLE `webpagetest_score` ADD COLUMN `local_date` date NOT NULL;
+
+UPDATE `webpagetest_score` SET `local_date` = DATE(CONVERT_TZ(`date`,'UTC',@time_zone));
+
+ALTER TABLE `webpagetest_score` ADD KEY `webpagetest_score_test_view_local_date` (`test_id`,`viewNumber`,`local_date`);
+
+--
+-- main_config: version stamp of the cached configuration
+--
+
+INSERT INTO `main_config` (`config_name`,`config_value`,`friendly_name`,`description`,`display`)
+SELECT 'config_version','0','Configuration Version','Changed by Quinico whenever the configuration or help is saved so that cached copies are reloaded.','string'
+FROM DUAL
+WHERE NOT EXISTS (SELECT * FROM `main_config` WHERE `config_name` = 'config_version');
+
+--
+-- main_data_job: version of the data saved by each job, for the response cache
+--
+
+ALTER TABLE `main_data_job` ADD COLUMN `data_version` int(11) NOT NULL DEFAULT 0;
+
+--
+-- Tables written by the data jobs: InnoDB, so a batch of rows (or a score
+-- and its rule results) that fails part way through is rolled back
+-- instead of being left half written.  Converting copies every row, so
+-- this takes a while on large tables.
+--
+
+ALTER TABLE `keyword_rank_rank` ENGINE=InnoDB;
+
+ALTER TABLE `keyword_rank_top_ten` ENGINE=InnoDB;
+
+ALTER TABLE `pagespeed_score` ENGINE=InnoDB;
+
+ALTER TABLE `pagespeed_rule_result` ENGINE=InnoDB;
+
+ALTER TABLE `pagespeed_rule_url` ENGINE=InnoDB;
+
+ALTER TABLE `seomoz_metrics` ENGINE=InnoDB;
+
+ALTER TABLE `webmaster_crawl_error` ENGINE=InnoDB;
+
+ALTER TABLE `webmaster_top_search_queries` ENGINE=InnoDB;
+
+ALTER TABLE `webpagetest_score` ENGINE=InnoDB;
@@ -27,6 +27,7 @@
 import os
 import logging
 import quinico
+import datetime
 import urllib
 import json
 import Queue
@@ -38,6 +39,9 @@ from django.conf import settings
 from qclasses import qemail
 from qclasses import qsql
 from qclasses import qlib
+from qclasses import qhttp
+from qclasses import qquota
+from qclasses import qwork
 
 
 # -- GLOBALLY AVAILABLE -- #
@@ -54,6 +58,22 @@ max_results = ''
 # Max Google API calls
 max_api_calls = ''
 
+# Process-wide API quota accountant shared by all threads
+api_quota = None
+
+# Domain ids, keyed by (domain,gl,googlehost)
+domain_ids = {}
+
+# Keyword ids, keyed by keyword
+keyword_ids = {}
+
+# Process-wide url -> id cache shared by all threads
+url_cache = None
+
+# The date the ranks of this run are saved under (the local date when the
+# run started, so a run that goes past midnight stays on one date)
+run_date = None
+
 # Grab the Quinico webapp settings
 os.environ['DJANGO_SETTINGS_MODULE'] = 'quinico.settings'
 
@@ -78,7 +98,19 @@ parser.add_option('-t','--test',
                         of any database data when this script is run.  \
                         No data will be added or deleted from the database \
                         except for API calls/errors.')
-(options, args) = parser.parse_args()
+parser.add_option('-r','--run',
+                  action='store',
+                  dest='run',
+                  default=None,
+                  help='The work queue run to join (required when the work \
+                        queue is enabled).  Every process started for the same \
+                        scheduled run must be given the same run, e.g. the \
+                        scheduled date and time.')
+# When imported (by the scheduler) the defaults are used
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+else:
+    (options, args) = parser.parse_args([])
 
 # -- END GLOBALLY AVAILABLE -- #
 
@@ -87,69 +119,77 @@ class Worker(threading.Thread):
     and acquiring/committing data
 
     To avoid contention, each thread will have its own ql, qs and
-    qemail instance
+    qemail instance, unless it is given a shared set of resources
+    (see start_workers)
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, resources=None):
         threading.Thread.__init__(self)
         self.queue = queue
+        self.resources = resources
 
     def run(self):
         t_name = threading.current_thread().name
         logger.info('Starting thread: %s' % t_name)
 
-        # Create qm, qs and ql instances
-        (qm,qs,ql) = create_resources()
+        # In shared mode the resources belong to main, which flushes and closes them
+        if self.resources is None:
+            resources = create_worker_resources()
+        else:
+            resources = self.resources
+
+        (qm,qs,ql,rank_writer,top_ten_writer) = resources
 
         while True:
             # Pop the next job off the queue and don't block if empty
             try:
                 row = self.queue.get(False)
-                domain = row[0]
+                keyword = row[0]
                 gl = row[1]
                 googlehost = row[2]
-                logger.info('Found a domain: %s with gl: %s and googlehost: %s - now looking for keywords' % (domain,gl,googlehost))
-                keywords = obtain_keywords(qs,qm,domain,gl,googlehost)
+                domains = row[3]
+                logger.info('Found a keyword: %s with gl: %s and googlehost: %s for domains: %s - now processing rankings' % (keyword,gl,googlehost,domains))
 
-                if not keywords:
-                    logger.warning('No keywords defined for %s' % domain)
-                else:
-                    for keyword in keywords:
+                # One set of search results is shared by every domain tracking this keyword
+                # (a shared work queue keeps the lease of the test between API calls)
+                result = obtain_ranking(ql,domains,gl,googlehost,keyword,getattr(self.queue,'touch',None))
 
-                        keyword = keyword[0]
+                # The lease expired and another worker has the test now, leave it to them
+                if result is None:
+                    logger.warning('Lost the test for keyword: %s with gl: %s and googlehost: %s, skipping it' % (keyword,gl,googlehost))
+                    self.queue.task_done()
+                    continue
 
-                        logger.info('Found a keyword: %s, now processing rankings' % (keyword))
-                        (rank,url,top_ten) = obtain_ranking(ql,domain,gl,googlehost,keyword)
-                        logger.info('Rank: %s, URL: %s' % (str(rank),url))
+                (ranks,top_ten) = result
 
-                        # Produce a utf-8 byte string
-                        url = url.encode('utf-8')
+                # Add all of the urls and obtain their ids at once
+                url_ids = {}
+                if not options.test:
+                    url_ids = add_urls(qm,[ranks[domain][1] for domain in domains] + top_ten)
 
-                        # Add the url
-                        if not options.test:
-                            add_url(qs,qm,url)
+                keyword_id = keyword_ids[keyword]
+
+                for domain in domains:
+
+                    domain_id = domain_ids[(domain,gl,googlehost)]
 
-                        # Add the rank
+                    (rank,url) = ranks[domain]
+                    logger.info('Domain: %s, Rank: %s, URL: %s' % (domain,str(rank),url))
+
+                    # Add the rank
+                    if not options.test:
+                        add_rank(qm,rank_writer,domain_id,keyword_id,rank,url,url_ids)
+
+                    logger.info('Adding the top ten urls for the keyword')
+                    top_rank = 1
+                    for top_url in top_ten:
+
+                        # Add the position
                         if not options.test:
-                            add_rank(qs,qm,domain,gl,googlehost,keyword,rank,url)
-
-                        logger.info('Adding the top ten urls for the keyword')
-                        top_rank = 1
-                        for top_url in top_ten:
-    
-                            # Produce a utf-8 byte string
-                            top_url = top_url.encode('utf-8')
-    
-                            # Add the URL
-                            if not options.test:
-                                add_url(qs,qm,top_url)
-    
-                            # Add the position
-                            if not options.test:
-                                add_top_ten(qs,qm,domain,gl,googlehost,keyword,top_url,top_rank)
-    
-                            top_rank += 1
-    
+                            add_top_ten(qm,top_ten_writer,domain_id,keyword_id,top_url,top_rank,url_ids)
+
+                        top_rank += 1
+
                 # Let the queue know I am done
                 self.queue.task_done()
 
@@ -157,8 +197,9 @@ class Worker(threading.Thread):
                 # Queue is empty, close down this thread.
                 logger.info('Queue is empty, stopping thread %s' % t_name)
 
-                # Disconnect from the DB server
-                qs.close()
+                # Write any buffered rows and disconnect from the DB server
+                if self.resources is None:
+                    close_worker_resources(resources)
 
                 # Stop the thread
                 break
@@ -171,69 +212,146 @@ class Worker(threading.Thread):
                 if settings.SMTP_NOTIFY_ERROR:
                     qm.send('Error','Exception encountered with thread %s: %s' % (t_name,traceback.format_exc()))
 
-                # Disconnect from the DB server
-                qs.close()
+                # Write any buffered rows and disconnect from the DB server
+                if self.resources is None:
+                    close_worker_resources(resources)
 
                 # Stop the thread
                 break
 
 
-def add_top_ten(qs,qm,domain,gl,googlehost,keyword,url,rank):
+def create_writers(qs):
+    """
+    Create and return the buffered writers for ranks and top ten urls
+    """
+
+    columns = ['date','domain_id','keyword_id','url_id','rank']
+
+    rank_writer = qsql.bulk(qs,'keyword_rank_rank',columns,logger=logger)
+    top_ten_writer = qsql.bulk(qs,'keyword_rank_top_ten',columns,logger=logger)
+
+    return (rank_writer,top_ten_writer)
+
+
+def flush_writer(qm,writer):
+    """
+    Write any rows buffered in a writer
+    """
+
+    writer.flush()
+    if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
+
+
+def create_worker_resources():
+    """Create and return the resources used by a worker
+       - (qm,qs,ql,rank_writer,top_ten_writer)
+    """
+
+    (qm,qs,ql) = create_resources()
+
+    # Ranks and top ten urls are buffered and written in batches
+    (rank_writer,top_ten_writer) = create_writers(qs)
+
+    return (qm,qs,ql,rank_writer,top_ten_writer)
+
+
+def close_worker_resources(resources):
+    """
+    Write any buffered rows and disconnect from the DB server
+    """
+
+    (qm,qs,ql,rank_writer,top_ten_writer) = resources
+
+    flush_writer(qm,rank_writer)
+    flush_writer(qm,top_ten_writer)
+
+    qs.close()
+
+
+def start_workers(queue,threads,concurrency):
+    """Start the workers and return any shared resources
+       - by default, threads workers are started and each has its own
+         resources
+       - if concurrency is set, that many workers are started and they share
+         threads sets of resources (DB connections and writers) between them,
+         so far more API requests can be in flight than there are DB
+         connections.  The shared resources must be closed by the caller.
+    """
+
+    resources = []
+
+    if concurrency > 0:
+        logger.info('Starting %i workers sharing %i sets of resources' % (concurrency,threads))
+
+        for i in range(threads):
+            resources.append(create_worker_resources())
+
+        # Keep enough idle connections around for every worker to reuse one
+        qhttp.shared(logger).size = concurrency
+
+        for i in range(concurrency):
+            # Create a worker and pass it the queue and its resources
+            w = Worker(queue,resources[i % threads])
+
+            # Start the worker
+            w.start()
+    else:
+        for i in range(threads):
+            # Create a worker and pass it the queue
+            w = Worker(queue)
+
+            # Start the worker
+            w.start()
+
+    return resources
+
+
+def add_top_ten(qm,writer,domain_id,keyword_id,url,rank,url_ids):
     """
     Add a top_ten URL rank
     """
 
-    logger.info('Adding a top 10 url: %s, %s, %s, %s' % (domain,keyword,url,rank))
+    logger.info('Adding a top 10 url: %s, %s, %s, %s' % (domain_id,keyword_id,url,rank))
 
-    sql = """
-           INSERT INTO keyword_rank_top_ten (date,domain_id,keyword_id,url_id,rank)
-           VALUES (DATE(NOW()),
-           (SELECT id from keyword_rank_domain where domain=%s AND gl=%s AND googlehost=%s),
-           (SELECT id from keyword_rank_keyword where keyword=%s),
-           (SELECT id from keyword_rank_url where url=%s),
-           %s)"""
-
-    qs.execute(sql,(domain,gl,googlehost,keyword,url,rank))
-    if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
-        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+    if not url in url_ids:
+        logger.error('No id for url %s, skipping top 10 rank' % url)
+        return
 
+    writer.add((run_date,domain_id,keyword_id,url_ids[url],rank))
+    if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
 
-def add_url(qs,qm,url):
+
+def add_urls(qm,urls):
     """
-    Add a URL
+    Add URLs (if they are not already there) and return a dictionary
+    of url -> id
     """
 
-    logger.info('Adding URL to database: %s' % url)
+    logger.info('Adding URLs to database: %s' % urls)
 
-    sql = """
-           INSERT INTO keyword_rank_url (url)
-           SELECT %s
-           FROM dual
-           WHERE not exists (SELECT * from keyword_rank_url WHERE url=%s)"""
+    url_ids = url_cache.get_ids(urls)
+    if url_cache.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (url_cache.sql,url_cache.emessage))
 
-    qs.execute(sql,(url,url))
-    if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
-        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+    return url_ids
 
 
-def add_rank(qs,qm,domain,gl,googlehost,keyword,rank,url):
+def add_rank(qm,writer,domain_id,keyword_id,rank,url,url_ids):
     """
     Add a keyword rank
     """
 
-    logger.info('Saving Rank: domain:%s, gl:%s, googlehost:%s, keyword:%s, rank:%s, url:%s' % (domain,gl,googlehost,keyword,rank,url))
+    logger.info('Saving Rank: domain_id:%s, keyword_id:%s, rank:%s, url:%s' % (domain_id,keyword_id,rank,url))
 
-    sql = """
-           INSERT INTO keyword_rank_rank (date,domain_id,keyword_id,url_id,rank) 
-           VALUES (DATE(NOW()),
-           (SELECT id from keyword_rank_domain where domain=%s AND gl=%s AND googlehost=%s),
-           (SELECT id from keyword_rank_keyword where keyword=%s),
-           (SELECT id from keyword_rank_url where url=%s),
-           %s)"""
-
-    qs.execute(sql,(domain,gl,googlehost,keyword,url,rank))
-    if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
-        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+    if not url in url_ids:
+        logger.error('No id for url %s, skipping rank' % url)
+        return
+
+    writer.add((run_date,domain_id,keyword_id,url_ids[url],rank))
+    if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
 
 
 def obtain_domains(qs,qm):
@@ -245,7 +363,7 @@ def obtain_domains(qs,qm):
 
     # Create SQL statement
     sql = """
-           SELECT domain,gl,googlehost
+           SELECT id,domain,gl,googlehost
            FROM keyword_rank_domain"""
 
     (rowcount,rows) = qs.execute(sql)
@@ -256,24 +374,19 @@ def obtain_domains(qs,qm):
     return rows
 
 
-def obtain_keywords(qs,qm,domain,gl,googlehost):
+def obtain_keywords(qs,qm):
     """
-    Obtain a list of keywords, given a domain
+    Obtain a list of keywords that are in the system
     """
 
-    logger.info('Looking for keywords for %s' % domain)
+    logger.info('Looking for keywords')
 
     # Create SQL statement
     sql = """
-           SELECT keyword
-           FROM keyword_rank_test
-           INNER JOIN keyword_rank_domain on keyword_rank_test.domain_id=keyword_rank_domain.id
-           INNER JOIN keyword_rank_keyword on keyword_rank_test.keyword_id=keyword_rank_keyword.id
-           WHERE domain=%s
-           AND gl=%s
-           AND googlehost=%s"""
-
-    (rowcount,rows) = qs.execute(sql,(domain,gl,googlehost))
+           SELECT id,keyword
+           FROM keyword_rank_keyword"""
+
+    (rowcount,rows) = qs.execute(sql)
     if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
         qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
 
@@ -281,21 +394,55 @@ def obtain_keywords(qs,qm,domain,gl,googlehost):
     return rows
 
 
-def obtain_ranking(ql,domain,gl,googlehost,keyword):
+def obtain_tests(qs,qm):
+    """
+    Generate the domain and keyword ids that are tested together
+    The rows are streamed from the server rather than loaded all at once
+    """
+
+    logger.info('Looking for tests')
+
+    # Create SQL statement
+    sql = """
+           SELECT domain_id,keyword_id
+           FROM keyword_rank_test"""
+
+    for rows in qs.iterate(sql):
+        for row in rows:
+            yield row
+
+    if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+
+
+def obtain_ranking(ql,domains,gl,googlehost,keyword,touch=None):
     """
     Query the Google Search API
+
+    The search results for a keyword (with a given gl and googlehost) are the
+    same for every domain, so each result page is requested once and every
+    domain in the list is ranked against it.  Returns a dictionary of
+    domain -> (rank,url) and the top ten urls.
+
+    touch (if given) is called after every API call to keep the lease of the
+    work item; if it returns False the item was lost and None is returned.
     """
 
-    # Total queries
+    # Current position in the search results
     counter = 1
 
     # Top 10 search results
     top_ten = []
 
-    logger.info('Checking %s for keyword %s with max results %s' % (domain,keyword,max_results))
+    # Assume no domain is found until we see it in the results
+    ranks = {}
+    for domain in domains:
+        ranks[domain] = (0,'none')
 
-    # Determine how many api calls we currently have for today
-    current_api_calls = ql.count_api_calls('keyword_rank')
+    # Domains we are still looking for
+    remaining = set(domains)
+
+    logger.info('Checking %s for keyword %s with max results %s' % (domains,keyword,max_results))
 
     # Construct the initial request and urlencode the keyword
     keyword_enc = urllib.urlencode({'q':keyword.encode('utf-8')})
@@ -305,31 +452,30 @@ def obtain_ranking(ql,domain,gl,googlehost,keyword):
     url += '%s&num=10&ie=utf8&oe=utf8&' % keyword_enc
     url += 'gl=%s&' % gl
     url += 'googlehost=%s' % googlehost
-  
-    # We are only going to check a certain number of user configurable 
-    # search results
-    while counter < int(max_results):
-
-        # If we are maxed out on API requests for the day, don't make any more b/c this costs $$
-        if current_api_calls >= int(max_api_calls):
-           logger.info('API calls are maxed out for today')
-           return (0,'none',top_ten)
-
-        response = ql.http_request1('keyword_rank',url,1)
-        # If there was an error in requesting results, we have to quit and send back nothing
-        if not response:
-            return (0,'none',top_ten)
 
-        # Count how many api calls we currently have
-        current_api_calls = ql.count_api_calls('keyword_rank')
+    # We are only going to check a certain number of user configurable
+    # search results, and stop early once every domain has been found
+    while counter < int(max_results) and remaining:
+
+        # Every attempt (retries too) reserves one of the day's API calls b/c they cost $$,
+        # and nothing is requested once they are maxed out
+        response = ql.http_request1('keyword_rank',url,None,int(max_api_calls))
+
+        # Requesting a page can take a while (retries), keep the lease
+        if not touch is None and not touch():
+            return None
+        # If there was an error in requesting results, or we are maxed out on API requests
+        # for the day, we have to quit and send back what we have
+        if not response:
+            return (ranks,top_ten)
 
         logger.debug(json.dumps(response))
         raw_json = json.loads(response)
 
-        for d in json.loads(response):
+        for d in raw_json:
             logger.info('Found JSON item: %s' % d)
 
-        total_results = raw_json['searchInformation']['totalResults']
+        total_results = int(raw_json['searchInformation']['totalResults'])
 
         # Parse the results (this will be skipped if there are no results)
         results = raw_json['items']
@@ -339,20 +485,19 @@ def obtain_ranking(ql,domain,gl,googlehost,keyword):
             for i in results:
                 top_ten.append(i['link'])
 
-        # Now check the results for our domain
+        # Now check the results for our domains
         for i in results:
             logger.info('Search result:%s, domain:%s, url:%s' % (counter,i['displayLink'],i['link']))
-            # If we get a match, return
-            if i['displayLink'] == domain:
-               logger.info('Got a match!')
-               return (counter,i['link'],top_ten)
-            else:
-               # no match
-               counter += 1
+            # Only the first (highest) match counts for each domain
+            if i['displayLink'] in remaining:
+               logger.info('Got a match for %s!' % i['displayLink'])
+               ranks[i['displayLink']] = (counter,i['link'])
+               remaining.discard(i['displayLink'])
+            counter += 1
 
         # Don't request more results than Google says they have
         if counter >= total_results:
-            return (0,'none',top_ten)
+            return (ranks,top_ten)
         else:
             url = 'https://www.googleapis.com/customsearch/v1?'
             url += 'key=' + google_key + '&'
@@ -362,10 +507,61 @@ def obtain_ranking(ql,domain,gl,googlehost,keyword):
             url += 'googlehost=%s&' % googlehost
             url += 'start=' + str(counter)
 
-    # Looks like we didn't find a result
-    logger.info('Result not found within %s' % max_results)
+    # Looks like we didn't find every domain
+    if remaining:
+        logger.info('Result not found within %s for %s' % (max_results,list(remaining)))
+
+    return (ranks,top_ten)
+
+
+def update_summary(qs,qm,date):
+    """
+    Save the first page rank count and rank changes (against the days the
+    keyword dashboard compares with) of date, the date the ranks of the run
+    were saved under, for every domain
+    """
+
+    logger.info('Updating the keyword rank summary for %s' % date)
 
-    return (0,'none',top_ten)
+    # The days before date that the dashboard shows
+    offsets = [1,2,3,4,5,6,30]
+
+    # First page counts for date and the days before it (the tests may
+    # have changed since those days were summarized)
+    dates = [date - datetime.timedelta(days=d) for d in [0] + offsets]
+
+    sql = """
+           INSERT INTO keyword_rank_summary (date,domain_id,first_page)
+           SELECT r.date,r.domain_id,SUM(r.rank > 0 AND r.rank <= 10)
+           FROM keyword_rank_rank r
+           INNER JOIN keyword_rank_test t ON t.domain_id=r.domain_id AND t.keyword_id=r.keyword_id
+           WHERE r.date IN (%s)
+           GROUP BY r.date,r.domain_id
+           ON DUPLICATE KEY UPDATE first_page=VALUES(first_page)""" % ','.join(['%s'] * len(dates))
+
+    qs.execute(sql,dates)
+    if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+
+    # Rank changes between date and each of the days before it, counted
+    # the same way the dashboard does (a rank of 0 is not in the results)
+    for offset in offsets:
+        sql = """
+               INSERT INTO keyword_rank_summary_change (date,domain_id,days,up,down,unch)
+               SELECT c.date,c.domain_id,%s,
+                      SUM(c.rank <> p.rank AND ((p.rank = 0 AND c.rank > 0) OR (c.rank <> 0 AND p.rank <> 0 AND c.rank < p.rank))),
+                      SUM(c.rank <> p.rank AND ((c.rank = 0 AND p.rank > 0) OR (c.rank <> 0 AND p.rank <> 0 AND c.rank > p.rank))),
+                      SUM(c.rank = p.rank)
+               FROM keyword_rank_rank c
+               INNER JOIN keyword_rank_test t ON t.domain_id=c.domain_id AND t.keyword_id=c.keyword_id
+               INNER JOIN keyword_rank_rank p ON p.domain_id=c.domain_id AND p.keyword_id=c.keyword_id AND p.date=c.date - INTERVAL %s DAY
+               WHERE c.date=%s
+               GROUP BY c.date,c.domain_id
+               ON DUPLICATE KEY UPDATE up=VALUES(up),down=VALUES(down),unch=VALUES(unch)"""
+
+        qs.execute(sql,(offset,offset,date))
+        if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
+            qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
 
 
 def create_resources():
@@ -385,21 +581,108 @@ def create_resources():
     qm = qemail.notify(settings.SMTP_HOST,
                       settings.SMTP_SENDER,
                       settings.SMTP_RECIPIENT,
-                      logger
+                      logger,
+                      'keyword_rank'
                      )
 
     # Create a qsql instance
-    qs = qsql.sql(host,user,password,name,logger)
+    qs = qsql.connect(host,user,password,name,logger)
 
-    # Create a qlib instance
-    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+    # Create a qlib instance (all instances share the API quota accountant)
+    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger,api_quota)
 
     return (qm,qs,ql)
 
 
+def create_quota():
+    """Create and return the API quota accountant
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'keyword_rank'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qquota.quota(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+
+
+def create_url_cache():
+    """Create and return the url -> id cache
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    # Urls are looked up by the hash of the url, which is indexed
+    return qsql.idmap(qs,'keyword_rank_url','url',logger,hash_column='url_hash')
+
+
+def create_work_queue(lease):
+    """Create and return the work queue shared with every other process
+       running this job
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'keyword_rank'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qwork.queue(qs,qm,settings.SMTP_NOTIFY_ERROR,'keyword_rank',options.run,logger,lease=lease)
+
+
 def main():
     """ Main Program Execution"""
 
+    # Create the API quota accountant first so that every ql instance uses it
+    global api_quota
+    api_quota = create_quota()
+
+    # Forget the ids and url cache of any previous run (the scheduler runs main repeatedly)
+    global domain_ids
+    global keyword_ids
+    global url_cache
+    domain_ids = {}
+    keyword_ids = {}
+    url_cache = None
+
+    # Every rank of the run, and its summary, is saved under the date it
+    # started on (the same local date the dashboard asks for)
+    global run_date
+    run_date = datetime.date.today()
+
     # Create qm, qs and ql instances so we can do some work
     (qm,qs,ql) = create_resources()
 
@@ -429,6 +712,9 @@ def main():
     if smtp_notify_data_start:
         qm.send('Keyword Rank Job Starting','Starting Quinico Keyword Rank data collection job')
 
+    # Apply the slow SQL statement threshold
+    ql.init_sql_stats()
+
     # Obtain configuration parameters
     # If we cannot obtain any of these, we have to quit
 
@@ -476,11 +762,40 @@ def main():
     else:
        logger.info('Keyword Rank threads = %s' % keyword_rank_threads)
 
+    # Keyword Rank Concurrency (0, or not defined, gives each worker thread its own resources)
+    keyword_rank_concurrency = ql.return_config('keyword_rank_concurrency')
+    if keyword_rank_concurrency is None:
+        keyword_rank_concurrency = 0
+    logger.info('Keyword Rank concurrency = %s' % keyword_rank_concurrency)
+
+    # Work queue lease (0, or not defined, keeps the work in this process)
+    work_lease = ql.return_config('work_lease')
+    if work_lease is None:
+        work_lease = 0
+    logger.info('Work queue lease = %s' % work_lease)
+
+    # If the work is shared with other processes (on any host) through the
+    # database, only the process that sets the run up removes today's data
+    # and adds the work items - the others wait for it
+    work = None
+    setup = True
+    if int(work_lease) > 0:
+        # Processes only share a run if they are all given the same one
+        if not options.run:
+            logger.error('The work queue is enabled but no run was given (--run)')
+            ql.terminate()
+
+        work = create_work_queue(int(work_lease))
+        setup = work.begin()
+
+        # The other processes use the same daily API call limit
+        api_quota.shared = True
+
     # Remove any keyword rankings from today as these new
     # rankings should override them
-    if not options.test:
-        ql.remove_data('keyword_rank_rank')
-        ql.remove_data('keyword_rank_top_ten')
+    if setup and not options.test:
+        ql.remove_data('keyword_rank_rank',run_date)
+        ql.remove_data('keyword_rank_top_ten',run_date)
 
     # Check all keywords
     domains = obtain_domains(qs,qm)
@@ -488,15 +803,54 @@ def main():
         logger.error('No domains defined')
         ql.terminate()
     else:
-        # Create a queue for the tests
-        queue = Queue.Queue()
-
+        # Load the domains, keywords and tests into memory so that rows
+        # can be inserted with plain ids
+        domains_by_id = {}
         for row in domains:
-            queue.put(row)
+            domain_ids[(row[1],row[2],row[3])] = row[0]
+            domains_by_id[row[0]] = (row[1],row[2],row[3])
+
+        keywords_by_id = {}
+        for row in obtain_keywords(qs,qm):
+            keyword_ids[row[1]] = row[0]
+            keywords_by_id[row[0]] = row[1]
+
+        # Group the domains by keyword, gl and googlehost so that each
+        # set of search results is only requested once
+        groups = {}
+        tested = set()
+        for row in obtain_tests(qs,qm):
+            (domain,gl,googlehost) = domains_by_id[row[0]]
+            keyword = keywords_by_id[row[1]]
+            groups.setdefault((keyword,gl,googlehost),[]).append(domain)
+            tested.add(row[0])
+
+        for domain_id in domains_by_id:
+            if not domain_id in tested:
+                logger.warning('No keywords defined for %s' % domains_by_id[domain_id][0])
+
+        # Create the shared url cache
+        url_cache = create_url_cache()
+
+        logger.info('Found %s unique keyword searches' % len(groups))
+
+        if work is None:
+            # Create a queue for the tests
+            queue = Queue.Queue()
+
+            for (keyword,gl,googlehost) in groups:
+                queue.put((keyword,gl,googlehost,groups[(keyword,gl,googlehost)]))
+        else:
+            # The workers claim the tests from the shared work queue
+            queue = work
+
+            if setup:
+                work.add([(keyword,gl,googlehost,groups[(keyword,gl,googlehost)]) for (keyword,gl,googlehost) in groups])
+                work.ready()
 
         # Start the workers.
         #   Notes:
-        #   - Keep the main thread open until it is the only one left
+        #   - Keep the main thread open until every worker is done
         #   - Do not daemonize the threads nor join on the queue
         #   - If the threads experience exceptions, or if they detect
         #     that the queue is empty, they will die.
@@ -504,21 +858,48 @@ def main():
         #     and the queue never emptying.   It is preferable to have this process
         #     die and someone get alerted and investigate.
 
-        for i in range(int(keyword_rank_threads)):
-            # Create a worker and pass it the queue
-            w = Worker(queue)
+        resources = start_workers(queue,int(keyword_rank_threads),int(keyword_rank_concurrency))
 
-            # Start the worker
-            w.start()
-
-        # If all threads except this one are done, then quit
+        # If all of the workers are done, then quit
         # Check at 1 second intervals
-        while threading.active_count() > 1:
+        #   - other threads (e.g. the email sender) may still be running, so
+        #     only the workers are counted
+        while [t for t in threading.enumerate() if isinstance(t,Worker)]:
             time.sleep(1)
 
+        # In shared mode, write any buffered rows and disconnect from the DB server
+        for r in resources:
+            close_worker_resources(r)
+
+        # Summarize the run for the dashboards (when the work is shared,
+        # whichever process finishes last leaves the complete summary)
+        if not options.test:
+            update_summary(qs,qm,run_date)
+
+    # Report any tests that were given up on and disconnect the work queue
+    if not work is None:
+        failed = work.failed()
+        if failed:
+            logger.error('%s keyword searches failed on every attempt' % failed)
+        work.close()
+
     # All done
     logger.info('All done with keyword rank data processing')
 
+    # Save any outstanding API calls/errors
+    api_quota.close()
+
+    # Have the reports show the new data
+    if not options.test:
+        ql.bump_data_version('keyword_rank')
+
+    # Disconnect the url cache from the DB server
+    if not url_cache is None:
+        url_cache.close()
+
+    # Report how long the SQL statements took
+    ql.report_sql_stats()
+
     # Disconnect from the DB server
     qs.close()
 
@@ -38,6 +38,9 @@ from django.conf import settings
 from qclasses import qemail
 from qclasses import qsql
 from qclasses import qlib
+from qclasses import qhttp
+from qclasses import qquota
+from qclasses import qwork
 
 
 # -- GLOBALLY AVAILABLE -- #
@@ -51,6 +54,18 @@ pagespeed_locale = ''
 # The path to save reports
 report_path = ''
 
+# Process-wide API quota accountant shared by all threads
+api_quota = None
+
+# The strategies each test is run with
+strategies = ['desktop','mobile']
+
+# The maximum number of requests in flight for one domain (0 for no
+# limit) and the semaphore enforcing it for each domain
+domain_concurrency = 0
+domain_slots = {}
+domain_slots_lock = threading.Lock()
+
 # Grab the Quinico webapp settings
 os.environ['DJANGO_SETTINGS_MODULE'] = 'quinico.settings'
 
@@ -75,7 +90,19 @@ parser.add_option('-t','--test',
                         of any database data when this script is run.  \
                         No data will be added or deleted from the database \
                         except for API calls/errors.')
-(options, args) = parser.parse_args()
+parser.add_option('-r','--run',
+                  action='store',
+                  dest='run',
+                  default=None,
+                  help='The work queue run to join (required when the work \
+                        queue is enabled).  Every process started for the same \
+                        scheduled run must be given the same run, e.g. the \
+                        scheduled date and time.')
+# When imported (by the scheduler) the defaults are used
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+else:
+    (options, args) = parser.parse_args([])
 
 # -- END GLOBALLY AVAILABLE -- #
 
@@ -85,19 +112,26 @@ class Worker(threading.Thread):
     and acquiring/committing data
 
     To avoid contention, each thread will have its own ql, qs and
-    qemail instance
+    qemail instance, unless it is given a shared set of resources
+    (see start_workers)
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, resources=None):
         threading.Thread.__init__(self)
         self.queue = queue
+        self.resources = resources
 
     def run(self):
         t_name = threading.current_thread().name
         logger.info('Starting thread: %s' % t_name)
 
-        # Create qm, qs and ql instances
-        (qm,qs,ql) = create_resources()
+        # In shared mode the resources belong to main, which closes them
+        if self.resources is None:
+            resources = create_worker_resources()
+        else:
+            resources = self.resources
+
+        (qm,qs,ql) = resources
 
         while True:
             # Pop the next job off the queue and don't block if empty
@@ -106,11 +140,19 @@ class Worker(threading.Thread):
                 t_id = row[0]
                 t_domain = row[1]
                 t_url = row[2]
+                t_strategy = row[3]
 
-                logger.info('%s found a test: id:%s, domain:%s, url:%s' % (t_name,t_id,t_domain,t_url))
+                logger.info('%s found a test: id:%s, domain:%s, url:%s, strategy:%s' % (t_name,t_id,t_domain,t_url,t_strategy))
 
-                query_pagespeed(qs,qm,ql,t_id,t_domain,t_url,'desktop')
-                query_pagespeed(qs,qm,ql,t_id,t_domain,t_url,'mobile')
+                # Wait for a free slot so our own sites are not overloaded
+                slot = domain_slot(t_domain)
+                if not slot is None:
+                    slot.acquire()
+                try:
+                    query_pagespeed(qm,qs,ql,t_id,t_domain,t_url,t_strategy,getattr(self.queue,'touch',None))
+                finally:
+                    if not slot is None:
+                        slot.release()
 
                 # Let the queue know I am done
                 self.queue.task_done()
@@ -120,7 +162,8 @@ class Worker(threading.Thread):
                 logger.info('Queue is empty, stopping thread %s' % t_name)
 
                 # Disconnect from the DB server
-                qs.close()
+                if self.resources is None:
+                    close_worker_resources(resources)
 
                 # Stop the thread
                 break
@@ -134,7 +177,8 @@ class Worker(threading.Thread):
                     qm.send('Error','Exception encountered with thread %s: %s' % (t_name,traceback.format_exc()))
 
                 # Disconnect from the DB server
-                qs.close()
+                if self.resources is None:
+                    close_worker_resources(resources)
 
                 # Stop the thread
                 break
@@ -162,9 +206,83 @@ def obtain_tests(qs,qm):
     return rows
 
 
-def query_pagespeed(qs,qm,ql,t_id,domain,u,strategy):
+def domain_slot(domain):
+    """
+    Return the semaphore limiting the requests in flight for a domain, or
+    None if there is no limit
+    """
+
+    if not domain_concurrency:
+        return None
+
+    with domain_slots_lock:
+        if not domain in domain_slots:
+            domain_slots[domain] = threading.BoundedSemaphore(domain_concurrency)
+
+    return domain_slots[domain]
+
+
+def create_worker_resources():
+    """Create and return the resources used by a worker
+       - (qm,qs,ql)
+    """
+
+    return create_resources()
+
+
+def close_worker_resources(resources):
+    """
+    Disconnect from the DB server
+    """
+
+    (qm,qs,ql) = resources
+
+    qs.close()
+
+
+def start_workers(queue,threads,concurrency):
+    """Start the workers and return any shared resources
+       - by default, threads workers are started and each has its own
+         resources
+       - if concurrency is set, that many workers are started and they share
+         threads sets of resources (DB connections) between them,
+         so far more API requests can be in flight than there are DB
+         connections.  The shared resources must be closed by the caller.
+    """
+
+    resources = []
+
+    if concurrency > 0:
+        logger.info('Starting %i workers sharing %i sets of resources' % (concurrency,threads))
+
+        for i in range(threads):
+            resources.append(create_worker_resources())
+
+        # Keep enough idle connections around for every worker to reuse one
+        qhttp.shared(logger).size = concurrency
+
+        for i in range(concurrency):
+            # Create a worker and pass it the queue and its resources
+            w = Worker(queue,resources[i % threads])
+
+            # Start the worker
+            w.start()
+    else:
+        for i in range(threads):
+            # Create a worker and pass it the queue
+            w = Worker(queue)
+
+            # Start the worker
+            w.start()
+
+    return resources
+
+
+def query_pagespeed(qm,qs,ql,t_id,domain,u,strategy,touch=None):
     """
     Query the Google Pagespeed API
+    touch (if given) is called once the report is in to keep the lease of
+    the work item; if it returns False the item was lost and nothing is saved
     """
 
     logger.info('Checking %s for url %s with strategy %s' % (domain,u,strategy))
@@ -184,6 +302,10 @@ def query_pagespeed(qs,qm,ql,t_id,domain,u,strategy):
     # Create a datetime object for right now
     time_now = datetime.datetime.now()
 
+    # The local date is stored too so that trends can be grouped by day
+    # without converting every row back from UTC
+    local_date = time_now.date()
+
     # Add the server's timezone and then convert to UTC before adding to the DB
     time_now = ql.convert_date_utc(time_now,settings.TIME_ZONE)
 
@@ -191,6 +313,11 @@ def query_pagespeed(qs,qm,ql,t_id,domain,u,strategy):
     if not response:
         return
 
+    # A report can take a while, make sure another worker has not taken the test over
+    if not touch is None and not touch():
+        logger.warning('Lost the test for %s%s with strategy %s, not saving it' % (domain,u,strategy))
+        return
+
     logger.debug(json.dumps(response))
     raw_json = json.loads(response)
 
@@ -229,33 +356,141 @@ def query_pagespeed(qs,qm,ql,t_id,domain,u,strategy):
     # Add the full report
     report_file = ql.save_report(report_path,'pagespeed',json.dumps(raw_json))
     results.append(report_file)
+    results.append(local_date)
 
-    sql = """
-           INSERT INTO pagespeed_score (
-                                        date,
-                                        test_id,
-                                        strategy,
-                                        score,
-                                        numberHosts,
-                                        numberResources,
-                                        numberCssResources,
-                                        numberStaticResources,
-                                        totalRequestBytes,
-                                        textResponseBytes,
-                                        cssResponseBytes,
-                                        htmlResponseBytes,
-                                        imageResponseBytes,
-                                        javascriptResponseBytes,
-                                        otherResponseBytes,
-                                        report
-                                       )
-           VALUES (
-           %s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
+    if options.test:
+        return
 
-    if not options.test:
-        qs.execute(sql,results)
-        if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
+    # Save the rule results and their urls with the score so the report
+    # does not have to be read back from the file
+    (rule_results,rule_urls) = extract_rules(raw_json)
+
+    save_score(qm,qs,results,rule_results,rule_urls)
+
+
+def save_score(qm,qs,results,rule_results,rule_urls,size=500):
+    """
+    Save a score with its rule results and rule urls (rows without the
+    score id) and return its id, or None if it could not be saved
+
+    It is all one transaction, so a report either has every one of its
+    rules saved or none (and is then read back from the file)
+    """
+
+    columns = [
+        'date',
+        'test_id',
+        'strategy',
+        'score',
+        'numberHosts',
+        'numberResources',
+        'numberCssResources',
+        'numberStaticResources',
+        'totalRequestBytes',
+        'textResponseBytes',
+        'cssResponseBytes',
+        'htmlResponseBytes',
+        'imageResponseBytes',
+        'javascriptResponseBytes',
+        'otherResponseBytes',
+        'report',
+        'local_date'
+        ]
+
+    sql = 'INSERT INTO pagespeed_score (%s) VALUES (%s)' % (','.join(columns),','.join(['%s'] * len(columns)))
+
+    # The transaction also keeps any other threads sharing the connection
+    # off it until we have the id of the new row
+    qs.begin()
+    if qs.status != 0:
+        if settings.SMTP_NOTIFY_ERROR:
             qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+        return
+
+    qs.execute(sql,results)
+    if qs.status == 0:
+        (rowcount,rows) = qs.execute('SELECT LAST_INSERT_ID()')
+        if qs.status == 0:
+            score_id = rows[0][0]
+
+    rules = [('pagespeed_rule_result',['score_id','rule_name','formatted_name','rule_score','rule_impact'],rule_results),
+             ('pagespeed_rule_url',['score_id','rule_name','block','header','url'],rule_urls)]
+
+    for (table,rule_columns,rule_rows) in rules:
+        if qs.status != 0:
+            break
+
+        # Never put more than size rows into one statement
+        for i in range(0,len(rule_rows),size):
+            chunk = rule_rows[i:i + size]
+
+            sql = 'INSERT INTO %s (%s) VALUES %s' % (table,
+                                                     ','.join(rule_columns),
+                                                     ','.join(['(' + ','.join(['%s'] * len(rule_columns)) + ')'] * len(chunk)))
+
+            args = []
+            for row in chunk:
+                args.extend([score_id] + row)
+
+            qs.execute(sql,args)
+            if qs.status != 0:
+                break
+
+    if qs.status != 0:
+        if settings.SMTP_NOTIFY_ERROR:
+            qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+        qs.rollback()
+        return
+
+    qs.commit()
+    if qs.status != 0:
+        if settings.SMTP_NOTIFY_ERROR:
+            qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+        return
+
+    return score_id
+
+
+def interpolate(message):
+    """
+    Return a Pagespeed formatted message with its $N placeholders
+    replaced by its args
+    """
+
+    text = message['format']
+
+    if 'args' in message:
+        for counter,item in enumerate(message['args'],start=1):
+            text = text.replace('$%s' % counter,item['value'])
+
+    return text
+
+
+def extract_rules(raw_json):
+    """
+    Extract the rule results of a report
+    Returns ([[rule name,formatted name,score,impact]],
+             [[rule name,block,header,url]]) - a url block without urls
+    has a single row with an empty url
+    """
+
+    rule_results = []
+    rule_urls = []
+
+    for (name,result) in raw_json.get('formattedResults',{}).get('ruleResults',{}).items():
+        rule_results.append([name,result['localizedRuleName'],result['ruleScore'],result['ruleImpact']])
+
+        for (block,url_block) in enumerate(result.get('urlBlocks',[])):
+            header = interpolate(url_block['header'])
+
+            urls = [interpolate(url['result']) for url in url_block.get('urls',[])]
+            if not urls:
+                urls = ['']
+
+            for url in urls:
+                rule_urls.append([name,block,header,url])
+
+    return (rule_results,rule_urls)
 
 
 def create_resources():
@@ -275,21 +510,77 @@ def create_resources():
     qm = qemail.notify(settings.SMTP_HOST,
                       settings.SMTP_SENDER,
                       settings.SMTP_RECIPIENT,
-                      logger
+                      logger,
+                      'pagespeed'
                      )
 
     # Create a qsql instance
-    qs = qsql.sql(host,user,password,name,logger)
+    qs = qsql.connect(host,user,password,name,logger)
 
-    # Create a qlib instance
-    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+    # Create a qlib instance (all instances share the API quota accountant)
+    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger,api_quota)
 
     return (qm,qs,ql)
 
 
+def create_quota():
+    """Create and return the API quota accountant
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'pagespeed'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qquota.quota(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+
+
+def create_work_queue(lease):
+    """Create and return the work queue shared with every other process
+       running this job
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'pagespeed'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qwork.queue(qs,qm,settings.SMTP_NOTIFY_ERROR,'pagespeed',options.run,logger,lease=lease)
+
+
 def main():
     """ Main Program Execution"""
 
+    # Create the API quota accountant first so that every ql instance uses it
+    global api_quota
+    api_quota = create_quota()
+
     # Create qm, qs and ql instances so we can do some work
     (qm,qs,ql) = create_resources()
 
@@ -319,6 +610,9 @@ def main():
     if smtp_notify_data_start:
         qm.send('Pagespeed Job Starting','Starting Quinico Pagespeed data collection job')
 
+    # Apply the slow SQL statement threshold
+    ql.init_sql_stats()
+
     # Obtain configuration parameters
     # If we cannot obtain any of these, we have to quit
     
@@ -357,44 +651,109 @@ def main():
     else:
        logger.info('Google Pagespeed threads = %s' % pagespeed_threads)
 
+    # Google Pagespeed Concurrency (0, or not defined, gives each worker thread its own resources)
+    pagespeed_concurrency = ql.return_config('pagespeed_concurrency')
+    if pagespeed_concurrency is None:
+        pagespeed_concurrency = 0
+    logger.info('Google Pagespeed concurrency = %s' % pagespeed_concurrency)
+
+    # Google Pagespeed Domain Concurrency (0, or not defined, for no limit)
+    global domain_concurrency
+    domain_concurrency = ql.return_config('pagespeed_domain_concurrency')
+    if domain_concurrency is None:
+        domain_concurrency = 0
+    domain_concurrency = int(domain_concurrency)
+    domain_slots.clear()
+    logger.info('Google Pagespeed domain concurrency = %s' % domain_concurrency)
+
+    # Work queue lease (0, or not defined, keeps the work in this process)
+    work_lease = ql.return_config('work_lease')
+    if work_lease is None:
+        work_lease = 0
+    logger.info('Work queue lease = %s' % work_lease)
+
+    # If the work is shared with other processes (on any host) through the
+    # database, only the process that sets the run up adds the work items -
+    # the others wait for it
+    work = None
+    setup = True
+    if int(work_lease) > 0:
+        # Processes only share a run if they are all given the same one
+        if not options.run:
+            logger.error('The work queue is enabled but no run was given (--run)')
+            ql.terminate()
+
+        work = create_work_queue(int(work_lease))
+        setup = work.begin()
+
     # Check all domains and urls
     tests = obtain_tests(qs,qm)
     if not tests:
         logger.error('No pagespeed tests defined')
         ql.terminate()
     else:
-        # Create a queue for the tests
-        queue = Queue.Queue()
+        # Each strategy of a test is queried on its own, so the strategies
+        # of a test run at the same time
+        items = [tuple(row) + (strategy,) for row in tests for strategy in strategies]
 
-        # Add all tests to the queue 
-        for row in tests:
-            queue.put(row)
+        if work is None:
+            # Create a queue for the tests
+            queue = Queue.Queue()
+
+            # Add all tests to the queue 
+            for item in items:
+                queue.put(item)
+        else:
+            # The workers claim the tests from the shared work queue
+            queue = work
+
+            if setup:
+                work.add(items)
+                work.ready()
 
         # Start the workers.  
         #   Notes:
-        #   - Keep the main thread open until it is the only one left
+        #   - Keep the main thread open until every worker is done
         #   - Do not daemonize the threads nor join on the queue
         #   - If the threads experience exceptions, or if they detect
         #     that the queue is empty, they will die.
         #   - The above prevents the threads dieing due to exceptions w/ the API
         #     and the queue never emptying.   It is preferable to have this process 
         #     die and someone get alerted and investigate.
-        for i in range(int(pagespeed_threads)):
-            # Create a worker and pass it the queue
-            w = Worker(queue)
+        resources = start_workers(queue,int(pagespeed_threads),int(pagespeed_concurrency))
 
-            # Start the worker
-            w.start()
-
-        # If all threads except this one are done, then quit
+        # If all of the workers are done, then quit
         # Check at 1 second intervals
-        while threading.active_count() > 1: 
+        #   - other threads (e.g. the email sender) may still be running, so
+        #     only the workers are counted
+        while [t for t in threading.enumerate() if isinstance(t,Worker)]:
             time.sleep(1)
 
+        # In shared mode, disconnect from the DB server
+        for r in resources:
+            close_worker_resources(r)
+
+    # Report any tests that were given up on and disconnect the work queue
+    if not work is None:
+        failed = work.failed()
+        if failed:
+            logger.error('%s pagespeed tests failed on every attempt' % failed)
+        work.close()
+
 
     # All done
     logger.info('All done with pagespeed data processing')
 
+    # Save any outstanding API calls/errors
+    api_quota.close()
+
+    # Have the reports show the new data
+    if not options.test:
+        ql.bump_data_version('pagespeed')
+
+    # Report how long the SQL statements took
+    ql.report_sql_stats()
+
     # Disconnect from the DB server
     qs.close()
 
@@ -0,0 +1,315 @@
+#!/usr/bin/python
+
+#
+# Copyright 2013 - Tom Alessi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Quinico Data Job Scheduler
+
+   Runs the data collection jobs inside this (long running) process on the
+   schedules saved on the Data Jobs admin page.  The jobs share the HTTP
+   connection pool and a pool of DB connections, so each run starts with
+   warm connections instead of a cold process.
+
+   The schedules are re-read every minute, and immediately when the process
+   receives a SIGHUP (sent by the Data Jobs admin page when it is saved).
+   SIGTERM stops the scheduler once any running jobs have finished.
+
+   Requirements:
+    - A properly configured Quinico environment (database, logging, configuration params)
+
+"""
+
+
+import os
+import datetime
+import logging
+import quinico
+import signal
+import threading
+import traceback
+from optparse import OptionParser
+from django.conf import settings
+from qclasses import qemail
+from qclasses import qsql
+from qclasses import qlib
+import keyword_rank
+import pagespeed
+import seomoz
+import webmaster
+import webpagetest
+
+
+# -- GLOBALLY AVAILABLE -- #
+
+# The data collection jobs, keyed by their name in the Data Job table
+jobs = {'keyword_rank': keyword_rank,
+        'pagespeed': pagespeed,
+        'seomoz': seomoz,
+        'webmaster': webmaster,
+        'webpagetest': webpagetest}
+
+# Set when the schedules should be re-read (SIGHUP) or the scheduler
+# should stop (SIGTERM)
+wakeup = threading.Event()
+stopping = False
+
+# Grab the Quinico webapp settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'quinico.settings'
+
+# Setup an instance of the Quinico logger
+# Logging is thread-safe so all jobs will share the same logger
+logger = logging.getLogger('quinico')
+
+# Parse Arguments
+parser = OptionParser(description='Data collection job \
+scheduler', version='%prog 1.0')
+parser.add_option('-t','--test',
+                  action='store_true',
+                  dest='test',
+                  default=False,
+                  help='Run every job in testing mode to prevent modification \
+                        of any database data.  \
+                        No data will be added or deleted from the database \
+                        except for API calls/errors.')
+(options, args) = parser.parse_args()
+
+# -- END GLOBALLY AVAILABLE -- #
+
+
+def obtain_schedules(qm,qs,schedules):
+    """
+    Obtain the schedules of the enabled jobs
+    Returns {job name: ([hours],minute)}, or the given schedules if they
+    cannot be read
+    """
+
+    sql = """
+            SELECT job_name,job_hour,job_minute
+            FROM main_data_job
+            WHERE job_status = 1"""
+
+    result = qs.execute(sql)
+    if qs.status != 0:
+        if settings.SMTP_NOTIFY_ERROR:
+            qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+        return schedules
+
+    (rowcount,rows) = result
+
+    new_schedules = {}
+    for (job_name,job_hour,job_minute) in rows:
+        if not job_name in jobs:
+            logger.error('Unknown data job %s, not scheduling it' % job_name)
+            continue
+
+        try:
+            hours = [int(hour) for hour in job_hour.split(',') if hour.strip()]
+            minute = int(job_minute)
+        except ValueError:
+            logger.error('Invalid schedule for data job %s (hour:%s, minute:%s), not scheduling it' % (job_name,job_hour,job_minute))
+            continue
+
+        new_schedules[job_name] = (hours,minute)
+
+    if new_schedules != schedules:
+        logger.info('Data job schedules: %s' % new_schedules)
+
+    return new_schedules
+
+
+def run_job(qm,job_name,running,run):
+    """
+    Run a data collection job (in its own thread)
+    run is the scheduled date and time of the job, so every host running
+    the job on the same schedule joins the same work queue run
+    """
+
+    job = jobs[job_name]
+    job.options.test = options.test
+    job.options.run = run
+
+    # Statement timings are reported per run, which only works when the
+    # run has the process to itself
+    if len(running) == 1:
+        qsql.shared_stats(logger).reset()
+
+    logger.info('Starting %s data job' % job_name)
+
+    try:
+        job.main()
+    except SystemExit as e:
+        # The jobs exit (ql.terminate) when they cannot continue
+        logger.error('%s data job exited with status %s' % (job_name,e.code))
+    except Exception:
+        logger.error('Exception encountered with %s data job: %s' % (job_name,traceback.format_exc()))
+        if settings.SMTP_NOTIFY_ERROR:
+            qm.send('Error','Exception encountered with %s data job: %s' % (job_name,traceback.format_exc()))
+    finally:
+        # A job that exits early (e.g. ql.terminate) leaves connections
+        # checked out, and the pools would run dry run after run
+        released = qsql.release()
+        if released:
+            logger.warning('%s data job left %s database connections checked out' % (job_name,released))
+
+        remove_pid(job_name)
+        logger.info('Finished %s data job' % job_name)
+
+
+def remove_pid(job_name):
+    """
+    Remove a job's PID file if it was left behind by this process
+    (a job that terminates does not remove its own PID file)
+    """
+
+    file = '%s/jobs/pid/%s.pid' % (settings.APP_DIR,job_name)
+
+    try:
+        pidfile = open(file, "r")
+        pid = pidfile.readline().strip()
+        pidfile.close()
+    except IOError:
+        return
+
+    if pid == str(os.getpid()):
+        try:
+            os.unlink(file)
+        except OSError as e:
+            logger.error('Could not remove pid file %s with error %s' % (file,e))
+
+
+def reload_schedules(signum,frame):
+    """
+    Signal handler (SIGHUP): re-read the schedules now
+    """
+
+    wakeup.set()
+
+
+def stop(signum,frame):
+    """
+    Signal handler (SIGTERM): stop scheduling jobs
+    """
+
+    global stopping
+    stopping = True
+    wakeup.set()
+
+
+def main():
+    """ Main Program Execution"""
+
+    # Every job (and this scheduler) checks its DB connections out of
+    # process-wide pools, so they stay connected between runs
+    qsql.enable_pooling()
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'scheduler'
+                     )
+
+    # Create qsql and qlib instances
+    qs = qsql.connect(host,user,password,name,logger)
+    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+
+    # If we could not connect to MySQL, quit and notify someone
+    if qs.status != 0:
+        ql.terminate()
+
+    # Check if another instance is already running
+    if ql.check_pid('%s/jobs/pid/scheduler.pid' % settings.APP_DIR):
+        ql.terminate()
+
+    # Set a PID (the Data Jobs admin page signals this process)
+    if (ql.set_pid('%s/jobs/pid/scheduler.pid' % settings.APP_DIR)):
+        ql.terminate()
+
+    signal.signal(signal.SIGHUP,reload_schedules)
+    signal.signal(signal.SIGTERM,stop)
+
+    logger.info('Started data job scheduler')
+
+    # Running jobs, keyed by job name: thread
+    running = {}
+
+    schedules = {}
+    last_minute = None
+
+    while not stopping:
+        wakeup.clear()
+
+        schedules = obtain_schedules(qm,qs,schedules)
+
+        # Start the jobs that are due this minute (only once per minute, as
+        # the schedules may be re-read several times within a minute)
+        now = datetime.datetime.now()
+        minute = now.replace(second=0,microsecond=0)
+
+        if minute != last_minute:
+            last_minute = minute
+
+            for job_name in running.keys():
+                if not running[job_name].is_alive():
+                    del running[job_name]
+
+            for job_name in sorted(schedules):
+                (hours,job_minute) = schedules[job_name]
+                if not (now.hour in hours and now.minute == job_minute):
+                    continue
+
+                if job_name in running:
+                    logger.error('%s data job is still running, skipping this run' % job_name)
+                    continue
+
+                t = threading.Thread(target=run_job,args=(qm,job_name,running,minute.strftime('%Y-%m-%d %H:%M')),name=job_name)
+                running[job_name] = t
+                t.start()
+
+        # Sleep until the next minute, unless signalled
+        now = datetime.datetime.now()
+        wakeup.wait(60 - now.second - now.microsecond / 1000000.0)
+
+    logger.info('Stopping data job scheduler, waiting for running jobs to finish')
+
+    for t in running.values():
+        t.join()
+
+    # Disconnect from the DB server
+    qs.close()
+
+    # Remove the PID file
+    if (ql.remove_pid('%s/jobs/pid/scheduler.pid' % settings.APP_DIR)):
+        ql.terminate()
+
+    logger.info('Data job scheduler stopped')
+
+
+# This program can only run is executed directly
+if __name__ == "__main__":
+
+    # Run main program
+    main()
+
+    # Quit program
+    exit(0)
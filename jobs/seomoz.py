@@ -35,22 +35,128 @@ import json
 import datetime
 import urllib
 import quinico
+import Queue
+import threading
+import traceback
 from optparse import OptionParser
 from django.conf import settings
 from qclasses import qemail
 from qclasses import qsql
 from qclasses import qlib
+from qclasses import qquota
 
 
-def query_urlmetrics(i_url):
+# -- GLOBALLY AVAILABLE -- #
+
+# SEOMoz access id and secret key
+access_id = ''
+secret_key = ''
+
+# Process-wide API quota accountant shared by all threads
+api_quota = None
+
+# This is the order in which we want to insert the metrics into the DB
+metrics = ['ueid','feid','peid','ujid','uifq','uipl','uid','fid','pid','umrp','fmrp','pmrp','utrp','ftrp','ptrp','uemrp','fejp','pejp','fjp','pjp','fuid','puid','fipl','upa','pda']
+
+# Grab the Quinico webapp settings
+os.environ['DJANGO_SETTINGS_MODULE'] = 'quinico.settings'
+
+# Setup an instance of the Quinico logger
+# Logging is thread-safe so all threads will share the same logger
+logger = logging.getLogger('quinico')
+
+# Parse Arguments
+parser = OptionParser(description='SEOMoz query and data \
+loading script', version='%prog 1.0')
+parser.add_option('-f','--force',
+                  action='store_true',
+                  dest='force',
+                  default=False,
+                  help='Force data acquisition regardless of whether or not the seomoz index is old')
+parser.add_option('-m','--message',
+                  action='store_true',
+                  dest='message',
+                  default=False,
+                  help='Send a test email message using the Quinico SMTP settings \
+                        configured in local_settings.py and then exit')
+parser.add_option('-t','--test',
+                  action='store_true',
+                  dest='test',
+                  default=False,
+                  help='Enable testing mode to prevent modification \
+                        of any database data when this script is run.  \
+                        No data will be added or deleted from the database \
+                        except for API calls/errors.')
+# When imported (by the scheduler) the defaults are used
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+else:
+    (options, args) = parser.parse_args([])
+
+# -- END GLOBALLY AVAILABLE -- #
+
+
+class Worker(threading.Thread):
+    """Worker thread for talking to external API 
+    and acquiring/committing data
+
+    To avoid contention, each thread will have its own ql, qs and
+    qemail instance
     """
-    Query the URL Metrics
-    Try to grab all data (paid API access) and insert
-    zeroes for all non-existent values
+
+    def __init__(self, queue):
+        threading.Thread.__init__(self)
+        self.queue = queue
+
+    def run(self):
+        t_name = threading.current_thread().name
+        logger.info('Starting thread: %s' % t_name)
+
+        resources = create_worker_resources()
+        (qm,qs,ql,writer) = resources
+
+        while True:
+            # Pop the next batch of urls off the queue and don't block if empty
+            try:
+                batch = self.queue.get(False)
+
+                logger.info('%s found a batch of %i urls' % (t_name,len(batch)))
+
+                query_urlmetrics(qm,ql,writer,batch)
+
+                # Let the queue know I am done
+                self.queue.task_done()
+
+            except Queue.Empty:
+                # Queue is empty, close down this thread.
+                logger.info('Queue is empty, stopping thread %s' % t_name)
+
+                # Write any buffered rows and disconnect from the DB server
+                close_worker_resources(resources)
+
+                # Stop the thread
+                break
+
+            except Exception:
+                # Most likely there was a problem with the SEOMoz API
+                # This generally should not happen as the function definitions that
+                # that perform the work have their own exception handling
+                logger.error('Exception encountered with thread %s: %s' % (t_name,traceback.format_exc()))
+                if settings.SMTP_NOTIFY_ERROR:
+                    qm.send('Error','Exception encountered with thread %s: %s' % (t_name,traceback.format_exc()))
+
+                # Write any buffered rows and disconnect from the DB server
+                close_worker_resources(resources)
+
+                # Stop the thread
+                break
+
+
+def signed_params():
+    """
+    Return the authentication parameters for a SEOMoz API request
     """
 
-    logger.info('Checking urlmetrics for %s' % i_url)
-    base_url = 'http://lsapi.seomoz.com/linkscape/url-metrics/%s?%s'
     expires = int(time.time() + 300)
     sig = '%s\n%i' % (access_id, expires)
     signature = base64.b64encode(hmac.new(secret_key, sig, hashlib.sha1).digest())
@@ -59,47 +165,65 @@ def query_urlmetrics(i_url):
     params['AccessID'] = access_id
     params['Expires'] = expires
     params['Signature'] = signature
+
+    return params
+
+
+def query_urlmetrics(qm,ql,writer,batch):
+    """
+    Query the URL Metrics for a batch of urls in one request
+    Try to grab all data (paid API access) and insert
+    zeroes for all non-existent values
+    """
+
+    logger.info('Checking urlmetrics for %s' % ', '.join([i_url for (url_id,i_url) in batch]))
+
+    # The urls are POSTed as a JSON list and the metrics come back
+    # as a JSON list, in the same order
+    base_url = 'http://lsapi.seomoz.com/linkscape/url-metrics/?%s'
+    params = signed_params()
     params['Cols'] = 133177540576
-    url = base_url % (i_url.encode('utf-8'), urllib.urlencode(params))
+    url = base_url % urllib.urlencode(params)
 
-    response = ql.http_request1('seomoz',url,1)
+    body = json.dumps([i_url for (url_id,i_url) in batch])
+
+    response = ql.http_request2('seomoz',url,None,None,1,body)
     if not response:
         return
 
-    logger.debug(json.dumps(response))
+    logger.debug(response)
     raw_json = json.loads(response)
 
-    # This is the order in which we want to insert the data into the DB
-    metrics = ['ueid','feid','peid','ujid','uifq','uipl','uid','fid','pid','umrp','fmrp','pmrp','utrp','ftrp','ptrp','uemrp','fejp','pejp','fjp','pjp','fuid','puid','fipl','upa','pda']
+    if not isinstance(raw_json,list) or len(raw_json) != len(batch):
+        logger.error('SEOMoz returned metrics for %s urls, expected %i' % (len(raw_json) if isinstance(raw_json,list) else 'no',len(batch)))
+        if settings.SMTP_NOTIFY_ERROR:
+            qm.send('Error','SEOMoz url metrics response does not match the request:\n%s\n\nRESPONSE:\n%s' % (body,response))
+        return
 
-    # This is the ordered list of data we'll use for the SQL
-    # We'll make this match the above data
-    metrics_data = [i_url]
+    for ((url_id,i_url),url_json) in zip(batch,raw_json):
 
-    # Cycle through the metrics and see if the metric was returned (if not, then the API account
-    # is probably a free one so just insert zero
-    # Also, convert to strings (with one sigfig, if appropriate)
-    for metric in metrics:
-        if metric in raw_json:
-            logger.info('metric %s is there and has value %s' % (metric,raw_json[metric]))
-            metrics_data.append(convert_metric(raw_json[metric]))
-        else:
-            metrics_data.append(str(0))
+        # This is the ordered list of data we'll use for the SQL
+        # We'll make this match the metrics list
+        metrics_data = [url_id]
 
-    # Save the data to the DB
-    sql = """
-       INSERT INTO seomoz_metrics (date,url_id,ueid,feid,peid,ujid,uifq,uipl,uid,fid,pid,umrp,fmrp,pmrp,utrp,ftrp,ptrp,uemrp,fejp,pejp,fjp,pjp,fuid,puid,fipl,upa,pda)
-       VALUES (DATE(NOW()),
-       (SELECT id from seomoz_url where url=%s),
-       %s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
+        # Cycle through the metrics and see if the metric was returned (if not, then the API account
+        # is probably a free one so just insert zero
+        # Also, convert to strings (with one sigfig, if appropriate)
+        for metric in metrics:
+            if metric in url_json:
+                logger.debug('metric %s is there for %s and has value %s' % (metric,i_url,url_json[metric]))
+                metrics_data.append(convert_metric(url_json[metric]))
+            else:
+                metrics_data.append(str(0))
 
-    if not options.test:
-        qs.execute(sql,metrics_data)
-        if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
-            qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+        # Save the data to the DB (rows are buffered and written in batches)
+        if not options.test:
+            writer.add(metrics_data)
+            if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+                qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
 
 
-def query_meta():
+def query_meta(ql):
     """
     Query the Metadata Metrics
     The API calls on this method do not count against allowed calls
@@ -109,15 +233,7 @@ def query_meta():
     logger.info('Checking metadata')
 
     base_url = 'http://lsapi.seomoz.com/linkscape/metadata/last_update?%s'
-    expires = int(time.time() + 300)
-    sig = '%s\n%i' % (access_id, expires)
-    signature = base64.b64encode(hmac.new(secret_key, sig, hashlib.sha1).digest())
-
-    params = {}
-    params['AccessID'] = access_id
-    params['Expires'] = expires
-    params['Signature'] = signature
-    url = base_url % (urllib.urlencode(params))
+    url = base_url % (urllib.urlencode(signed_params()))
 
     response = ql.http_request1('seomoz',url,1)
     if response:
@@ -126,7 +242,7 @@ def query_meta():
         return
 
 
-def obtain_last_update():
+def obtain_last_update(qs,qm):
     """
     Obtain the last data update date
     """
@@ -155,16 +271,16 @@ def convert_metric(metric):
     """
 
     if re.match('^\d+\.\d+$',str(metric)):
-       logger.info('converting to string with one sigfig')
+       logger.debug('converting to string with one sigfig')
        return str('%.1f' % metric)
     elif re.match('^\d+$',str(metric)):
-       logger.info('converting to string')
+       logger.debug('converting to string')
        return str(metric)
     else:
        return metric
 
 
-def obtain_urls():
+def obtain_urls(qs,qm):
     """
     Obtain a list of urls
     """
@@ -173,7 +289,7 @@ def obtain_urls():
 
     # Create SQL statement
     sql = """
-           SELECT url
+           SELECT id,url
            FROM seomoz_url"""
 
     (rowcount,rows) = qs.execute(sql)
@@ -184,7 +300,7 @@ def obtain_urls():
     return rows
 
 
-def update_update():
+def update_update(qs,qm):
     """
     Update the update table
     """
@@ -201,176 +317,317 @@ def update_update():
         qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
 
 
-#
-# BEGIN MAIN PROGRAM EXECUTION
-#
+def create_writer(qs):
+    """
+    Create and return the buffered writer for metrics
+    """
 
+    columns = ['date','url_id'] + metrics
 
-# Parse Arguments
-parser = OptionParser(description='SEOMoz query and data \
-loading script', version='%prog 1.0')
-parser.add_option('-f','--force',
-                  action='store_true',
-                  dest='force',
-                  default=False,
-                  help='Force data acquisition regardless of whether or not the seomoz index is old')
-parser.add_option('-m','--message',
-                  action='store_true',
-                  dest='message',
-                  default=False,
-                  help='Send a test email message using the Quinico SMTP settings \
-                        configured in local_settings.py and then exit')
-parser.add_option('-t','--test',
-                  action='store_true',
-                  dest='test',
-                  default=False,
-                  help='Enable testing mode to prevent modification \
-                        of any database data when this script is run.  \
-                        No data will be added or deleted from the database \
-                        except for API calls/errors.')
-(options, args) = parser.parse_args()
+    return qsql.bulk(qs,
+                     'seomoz_metrics',
+                     columns,
+                     '(DATE(NOW()),%s)' % ','.join(['%s'] * (len(columns) - 1)),
+                     logger=logger)
 
-# Grab the Quinico webapp settings
-os.environ['DJANGO_SETTINGS_MODULE'] = 'quinico.settings'
 
-# Setup an instance of the Quinico logger
-logger = logging.getLogger('quinico')
+def flush_writer(qm,writer):
+    """
+    Write any rows buffered in a writer
+    """
+
+    writer.flush()
+    if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
 
-# Obtain database parameters from DJango
-host = settings.DATABASES['default']['HOST']
-user = settings.DATABASES['default']['USER']
-password = settings.DATABASES['default']['PASSWORD']
-name = settings.DATABASES['default']['NAME']
-
-# Create a qemail instance
-qm = qemail.notify(settings.SMTP_HOST,
-                  settings.SMTP_SENDER,
-                  settings.SMTP_RECIPIENT,
-                  logger
-                 )
-
-# Send a test message, if requested to do so and then quit
-if options.message:
-    qm.send('SEOMoz Test','Test message from the Quinico SEOMoz data collection job')
-    exit(0)
 
-# Create a qsql instance
-qs = qsql.sql(host,user,password,name,logger)
+def create_worker_resources():
+    """Create and return the resources used by a worker
+       - (qm,qs,ql,writer)
+    """
 
-# Create a qlib instance
-ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+    (qm,qs,ql) = create_resources()
 
-# If we could not connect to MySQL, quit and notify someone
-if qs.status != 0:
-    ql.terminate()
+    # Metrics are buffered and written in batches
+    writer = create_writer(qs)
 
-# Check if another instance is already running
-if ql.check_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR):
-    ql.terminate()
+    return (qm,qs,ql,writer)
 
-# Set a PID
-if (ql.set_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR)):
-    ql.terminate()
 
-# Let someone know we are starting data collection
-logger.info('Started SEOMoz data collection job')
-smtp_notify_data_start = int(ql.return_config('smtp_notify_data_start'))
-if smtp_notify_data_start:
-    qm.send('SEOMoz Job Starting','Starting Quinico SEOMoz data collection job')
+def close_worker_resources(resources):
+    """
+    Write any buffered rows and disconnect from the DB server
+    """
 
-# Obtain configuration parameters
-# If we cannot obtain any of these, we have to quit
+    (qm,qs,ql,writer) = resources
 
-# SEOMoz access id (must be encoded as ascii for the hashing to work)
-access_id = ql.return_config('seomoz_access_id')
-access_id = access_id.encode('ascii')
+    flush_writer(qm,writer)
 
-if access_id is None:
-    logger.error('SEOMoz Access ID is not defined, perhaps someone deleted it')
-    ql.terminate()
-else:
-   logger.info('SEOmoz Access ID = %s' % access_id)
-
-# SEOMoz secret key ((must be encoded as ascii for the hashing to work)
-secret_key = ql.return_config('seomoz_secret_key')
-secret_key = secret_key.encode('ascii')
-if secret_key is None:
-    logger.error('SEOMoz Secret Key is not defined, perhaps someone deleted it')
-    ql.terminate()
-else:
-   logger.info('SEOmoz Secret Key = *****')
+    qs.close()
 
-# Check when SEOMoz last updated data.  If its newer than our
-# newest data, then perform the update, otherwise quit
 
-# SEOMoz data about last update (this is an epoch)
-sm_last_update = query_meta()
-logger.info('Epoch return value from SEOMoz meta API: %s' % sm_last_update)
+def create_resources():
+    """Create and return the following resources
+       - a qlib instance
+       - a qemail instance
+       - a qsql instance
+    """
+       
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
 
-# If this is not working for some reason, we need to quit
-if sm_last_update is None:
-    ql.terminate()
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'seomoz'
+                     )
 
-# Quinico data about last update (this is a datetime object)
-qu_last_update = obtain_last_update()
-logger.info('Last Quinico update from SEOMoz (localtime): %s' % qu_last_update)
-if qu_last_update == 'none':
-    logger.info('SEOMoz statistics have never been updated, proceed to update data')
-else:
-    # Convert the localtime to UTC
-    qu_last_update = ql.convert_date_utc(qu_last_update,settings.TIME_ZONE)
-    logger.info('Last Quinico update from SEOMoz (UTC): %s' % qu_last_update)
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
 
-    qu_epoch = time.mktime(qu_last_update.timetuple())
-    logger.info('Last Quinico update from SEOMoz (UTC epoch): %s' % qu_epoch)
+    # Create a qlib instance (all instances share the API quota accountant)
+    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger,api_quota)
 
-    # If the SEOMoz last update is newer than our last update (or force is requested), then proceed, otherwise exit
-    if sm_last_update >= qu_epoch or options.force == True:
-        logger.info('SEOMoz index is new or force is being requested, proceed to update data')
-    else:
-        logger.info('SEOMoz index is old, quiting')
+    return (qm,qs,ql)
 
-        # Remove the PID file
-        if (ql.remove_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR)):
-            ql.terminate()
 
+def create_quota():
+    """Create and return the API quota accountant
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'seomoz'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qquota.quota(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+
+
+def main():
+    """ Main Program Execution"""
+
+    # Create the API quota accountant first so that every ql instance uses it
+    global api_quota
+    api_quota = create_quota()
+
+    # Create qm, qs and ql instances so we can do some work
+    (qm,qs,ql) = create_resources()
+
+    # If we could not connect to MySQL, quit and notify someone
+    if qs.status != 0:
+        ql.terminate()
+
+    # Send a test message, if requested to do so and then quit
+    if options.message:
+        qm.send('SEOMoz Test','Test message from the Quinico SEOMoz data collection job')
+
+        # Disconnect from the DB server and exit
+        qs.close()
         exit(0)
 
-# If requested, let someone know
-smtp_notify_seomoz_new = int(ql.return_config('smtp_notify_seomoz_new'))
-if smtp_notify_seomoz_new:
-    qm.send('SEOMoz Data Collection','SEOMoz data is being refreshed today')
-
-# Remove any SEOMoz data from today as these new metrics
-# should override them
-if not options.test:
-    ql.remove_data('seomoz_metrics')
-
-# Obtain the list of urls to check
-# Pause after each query b/c free accounts are rate limited
-urls = obtain_urls()
-if not urls:
-    logger.error('No urls defined')
-    ql.terminate()
-else:
-    for url in urls:
-        # Query the API for url metrics
-        query_urlmetrics(url[0])
-        ql.pause(10)
+    # Check if another instance is already running
+    if ql.check_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR):
+        ql.terminate()
+
+    # Set a PID
+    if (ql.set_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR)):
+        ql.terminate()
+
+    # Let someone know we are starting data collection
+    logger.info('Started SEOMoz data collection job')
+    smtp_notify_data_start = int(ql.return_config('smtp_notify_data_start'))
+    if smtp_notify_data_start:
+        qm.send('SEOMoz Job Starting','Starting Quinico SEOMoz data collection job')
+
+    # Apply the slow SQL statement threshold
+    ql.init_sql_stats()
+
+    # Obtain configuration parameters
+    # If we cannot obtain any of these, we have to quit
+
+    # SEOMoz access id (must be encoded as ascii for the hashing to work)
+    global access_id
+    access_id = ql.return_config('seomoz_access_id')
+    if access_id is None:
+        logger.error('SEOMoz Access ID is not defined, perhaps someone deleted it')
+        ql.terminate()
+    else:
+       access_id = access_id.encode('ascii')
+       logger.info('SEOmoz Access ID = %s' % access_id)
+
+    # SEOMoz secret key ((must be encoded as ascii for the hashing to work)
+    global secret_key
+    secret_key = ql.return_config('seomoz_secret_key')
+    if secret_key is None:
+        logger.error('SEOMoz Secret Key is not defined, perhaps someone deleted it')
+        ql.terminate()
+    else:
+       secret_key = secret_key.encode('ascii')
+       logger.info('SEOmoz Secret Key = *****')
+
+    # SEOMoz Threads
+    seomoz_threads = ql.return_config('seomoz_threads')
+    if seomoz_threads is None:
+        seomoz_threads = 1
+    logger.info('SEOMoz threads = %s' % seomoz_threads)
+
+    # SEOMoz Batch Size (the number of urls in each url metrics request)
+    seomoz_batch_size = ql.return_config('seomoz_batch_size')
+    if seomoz_batch_size is None:
+        seomoz_batch_size = 1
+    logger.info('SEOMoz batch size = %s' % seomoz_batch_size)
+
+    # The minimum number of seconds between requests, spaced across all
+    # threads by ql.  If blank, free accounts are limited to one request
+    # every 10 seconds and paid accounts are not limited.
+    seomoz_interval = ql.return_config('seomoz_interval')
+    if not seomoz_interval:
+        seomoz_account_type = ql.return_config('seomoz_account_type')
+        logger.info('SEOMoz account type = %s' % seomoz_account_type)
+        if seomoz_account_type == 'paid':
+            seomoz_interval = 0
+        else:
+            seomoz_interval = 10
+    logger.info('SEOMoz request interval = %s' % seomoz_interval)
+    ql.set_interval('seomoz',float(seomoz_interval))
+
+    # Check when SEOMoz last updated data.  If its newer than our
+    # newest data, then perform the update, otherwise quit
+
+    # SEOMoz data about last update (this is an epoch)
+    sm_last_update = query_meta(ql)
+    logger.info('Epoch return value from SEOMoz meta API: %s' % sm_last_update)
+
+    # If this is not working for some reason, we need to quit
+    if sm_last_update is None:
+        ql.terminate()
+
+    # Quinico data about last update (this is a datetime object)
+    qu_last_update = obtain_last_update(qs,qm)
+    logger.info('Last Quinico update from SEOMoz (localtime): %s' % qu_last_update)
+    if qu_last_update == 'none':
+        logger.info('SEOMoz statistics have never been updated, proceed to update data')
+    else:
+        # Convert the localtime to UTC
+        qu_last_update = ql.convert_date_utc(qu_last_update,settings.TIME_ZONE)
+        logger.info('Last Quinico update from SEOMoz (UTC): %s' % qu_last_update)
 
-# Update the seomoz_update table
-if not options.test:
-    update_update()
+        qu_epoch = time.mktime(qu_last_update.timetuple())
+        logger.info('Last Quinico update from SEOMoz (UTC epoch): %s' % qu_epoch)
 
-# All done
-logger.info('All done with seomoz data checking')
+        # If the SEOMoz last update is newer than our last update (or force is requested), then proceed, otherwise exit
+        if sm_last_update >= qu_epoch or options.force == True:
+            logger.info('SEOMoz index is new or force is being requested, proceed to update data')
+        else:
+            logger.info('SEOMoz index is old, quiting')
+
+            # Save the API calls/errors
+            api_quota.close()
+
+            # Disconnect from the DB server
+            qs.close()
+
+            # Remove the PID file
+            if (ql.remove_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR)):
+                ql.terminate()
+
+            return
+
+    # If requested, let someone know
+    smtp_notify_seomoz_new = int(ql.return_config('smtp_notify_seomoz_new'))
+    if smtp_notify_seomoz_new:
+        qm.send('SEOMoz Data Collection','SEOMoz data is being refreshed today')
+
+    # Remove any SEOMoz data from today as these new metrics
+    # should override them
+    if not options.test:
+        ql.remove_data('seomoz_metrics')
+
+    # Obtain the list of urls to check
+    urls = obtain_urls(qs,qm)
+    if not urls:
+        logger.error('No urls defined')
+        ql.terminate()
+    else:
+        # Create a queue for the batches of urls
+        queue = Queue.Queue()
+
+        # Add all urls to the queue, seomoz_batch_size at a time
+        size = max(int(seomoz_batch_size),1)
+        for i in range(0,len(urls),size):
+            queue.put(urls[i:i + size])
+
+        # Start the workers.  
+        #   Notes:
+        #   - Keep the main thread open until every worker is done
+        #   - Do not daemonize the threads nor join on the queue
+        #   - If the threads experience exceptions, or if they detect
+        #     that the queue is empty, they will die.
+        #   - The above prevents the threads dieing due to exceptions w/ the API
+        #     and the queue never emptying.   It is preferable to have this process 
+        #     die and someone get alerted and investigate.
+        for i in range(int(seomoz_threads)):
+            # Create a worker and pass it the queue
+            w = Worker(queue)
+
+            # Start the worker
+            w.start()
+
+        # If all of the workers are done, then quit
+        # Check at 1 second intervals
+        #   - other threads (e.g. the email sender) may still be running, so
+        #     only the workers are counted
+        while [t for t in threading.enumerate() if isinstance(t,Worker)]:
+            time.sleep(1)
+
+    # Update the seomoz_update table
+    if not options.test:
+        update_update(qs,qm)
+
+    # All done
+    logger.info('All done with seomoz data checking')
+
+    # Save any outstanding API calls/errors
+    api_quota.close()
+
+    # Have the reports show the new data
+    if not options.test:
+        ql.bump_data_version('seomoz')
 
-# Disconnect from the DB server
-qs.close()
+    # Report how long the SQL statements took
+    ql.report_sql_stats()
 
-# Remove the PID file
-if (ql.remove_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR)):
-    ql.terminate()
+    # Disconnect from the DB server
+    qs.close()
 
-# Quit progam
-exit(0)
+    # Remove the PID file
+    if (ql.remove_pid('%s/jobs/pid/seomoz.pid' % settings.APP_DIR)):
+        ql.terminate()
+
+
+# This program can only run is executed directly
+if __name__ == "__main__":
+
+    # Run main program
+    main()
+
+    # Quit program
+    exit(0)
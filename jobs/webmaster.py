@@ -46,6 +46,9 @@ from django.core.mail import send_mail
 from qclasses import qemail
 from qclasses import qsql
 from qclasses import qlib
+from qclasses import qhttp
+from qclasses import qquota
+from qclasses import qwork
 
 
 # -- GLOBALLY AVAILABLE -- #
@@ -65,6 +68,18 @@ auth_key = ''
 # Top Queries Date
 check_date_tq = ''
 
+# Process-wide API quota accountant shared by all threads
+api_quota = None
+
+# Domain ids, keyed by domain
+domain_ids = {}
+
+# Keyword ids, keyed by keyword
+keyword_ids = {}
+
+# Process-wide crawl error type -> id cache shared by all threads
+error_types = None
+
 # Grab the Quinico webapp settings
 os.environ['DJANGO_SETTINGS_MODULE'] = 'quinico.settings'
 
@@ -89,7 +104,19 @@ parser.add_option('-t','--test',
                         of any database data when this script is run.  \
                         No data will be added or deleted from the database \
                         except for API calls/errors.')
-(options, args) = parser.parse_args()
+parser.add_option('-r','--run',
+                  action='store',
+                  dest='run',
+                  default=None,
+                  help='The work queue run to join (required when the work \
+                        queue is enabled).  Every process started for the same \
+                        scheduled run must be given the same run, e.g. the \
+                        scheduled date and time.')
+# When imported (by the scheduler) the defaults are used
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+else:
+    (options, args) = parser.parse_args([])
 
 # -- END GLOBALLY AVAILABLE -- #
 
@@ -99,25 +126,35 @@ class Worker(threading.Thread):
     and acquiring/committing data
 
     To avoid contention, each thread will have its own ql, qs and
-    qemail instance
+    qemail instance, unless it is given a shared set of resources
+    (see start_workers)
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, resources=None):
         threading.Thread.__init__(self)
         self.queue = queue
+        self.resources = resources
 
     def run(self):
         t_name = threading.current_thread().name
         logger.info('Starting thread: %s' % t_name)
 
-        # Create qm, qs and ql instances
-        (qm,qs,ql) = create_resources()
+        # In shared mode the resources belong to main, which flushes and closes them
+        if self.resources is None:
+            resources = create_worker_resources()
+        else:
+            resources = self.resources
+
+        (qm,qs,ql,error_writer,tq_writer) = resources
 
         while True:
             # Pop the next job off the queue and don't block if empty
             try:
                 row = self.queue.get(False)
-                domain = row[0]
+                domain = row[1]
+
+                # A shared work queue keeps the lease of the domain between API calls
+                touch = getattr(self.queue,'touch',None)
 
                 # Google expects the domain to be preceeded with 'http://' and have a trailing '/'
                 g_domain = 'http://%s/' % domain
@@ -131,7 +168,7 @@ class Worker(threading.Thread):
                     logger.debug('No keywords are defined for this domain - will not check Google search queries')
                 else:
                     # Check for top search queries
-                    query_webmaster_tq(qs,qm,ql,domain,keywords)
+                    query_webmaster_tq(qm,ql,tq_writer,domain,keywords)
 
                 # Check for crawl errors
                 logger.debug('Checking %s for crawl errors' % domain)
@@ -165,26 +202,30 @@ class Worker(threading.Thread):
                         else:
                             errors,next_url = query_webmaster_api_ce(qm,ql,next_url,errors)
 
+                    # The lease expired and another worker has the domain now, leave it to them
+                    if not touch is None and not touch():
+                        logger.warning('Lost the domain %s, not saving its crawl errors' % domain)
+                        errors = {}
+                        process = False
+
+                # Make sure the error types exist in the DB and obtain their ids
+                type_ids = {}
+                if not options.test and errors:
+                    type_ids = add_errors(qm,errors.keys())
+
                 # Add the data
                 for error in errors:
 
                     logger.debug('%s had a count of %s for %s' % (domain,errors[error],error))
 
-                    # Make sure the error type exists in the DB
                     if not options.test:
-                        add_error(qs,qm,error)
-
-                    sql = """
-                            INSERT INTO webmaster_crawl_error (date,domain_id,type_id,count)
-                            VALUES (DATE(NOW()),
-                            (SELECT id from webmaster_domain where domain=%s),
-                            (SELECT id from webmaster_crawl_error_type where type=%s),
-                            %s)"""
+                        if not error in type_ids:
+                            logger.error('No id for error type %s, skipping' % error)
+                            continue
 
-                    if not options.test:
-                        qs.execute(sql,(domain,error,errors[error]))
-                        if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
-                            qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+                        error_writer.add((domain_ids[domain],type_ids[error],errors[error]))
+                        if error_writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+                            qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (error_writer.sql,error_writer.emessage))
 
                 # Let the queue know I am done
                 self.queue.task_done()
@@ -193,8 +234,9 @@ class Worker(threading.Thread):
                 # Queue is empty, close down this thread.
                 logger.info('Queue is empty, stopping thread %s' % t_name)
 
-                # Disconnect from the DB server
-                qs.close()
+                # Write any buffered rows and disconnect from the DB server
+                if self.resources is None:
+                    close_worker_resources(resources)
 
                 # Stop the thread
                 break
@@ -207,8 +249,9 @@ class Worker(threading.Thread):
                 if settings.SMTP_NOTIFY_ERROR:
                     qm.send('Error','Exception encountered with thread %s: %s' % (t_name,traceback.format_exc()))
 
-                # Disconnect from the DB server
-                qs.close()
+                # Write any buffered rows and disconnect from the DB server
+                if self.resources is None:
+                    close_worker_resources(resources)
 
                 # Stop the thread
                 break
@@ -223,7 +266,7 @@ def obtain_domains(qs,qm):
 
     # Create SQL statement
     sql = """
-           SELECT domain
+           SELECT id,domain
            FROM webmaster_domain
           """
 
@@ -258,45 +301,150 @@ def obtain_keywords(qs,qm,domain):
     return rows
 
 
-def add_tq(qs,qm,domain,query,impressions,clicks):
+def create_writers(qs):
+    """
+    Create and return the buffered writers for crawl errors and top queries
+    """
+
+    error_writer = qsql.bulk(qs,
+                             'webmaster_crawl_error',
+                             ['date','domain_id','type_id','count'],
+                             '(DATE(NOW()),%s,%s,%s)',
+                             logger=logger)
+
+    tq_writer = qsql.bulk(qs,
+                          'webmaster_top_search_queries',
+                          ['date','domain_id','keyword_id','impressions','clicks'],
+                          logger=logger)
+
+    return (error_writer,tq_writer)
+
+
+def flush_writer(qm,writer):
+    """
+    Write any rows buffered in a writer
+    """
+
+    writer.flush()
+    if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
+
+
+def create_worker_resources():
+    """Create and return the resources used by a worker
+       - (qm,qs,ql,error_writer,tq_writer)
+    """
+
+    (qm,qs,ql) = create_resources()
+
+    # Crawl errors and top queries are buffered and written in batches
+    (error_writer,tq_writer) = create_writers(qs)
+
+    return (qm,qs,ql,error_writer,tq_writer)
+
+
+def close_worker_resources(resources):
+    """
+    Write any buffered rows and disconnect from the DB server
+    """
+
+    (qm,qs,ql,error_writer,tq_writer) = resources
+
+    flush_writer(qm,error_writer)
+    flush_writer(qm,tq_writer)
+
+    qs.close()
+
+
+def start_workers(queue,threads,concurrency):
+    """Start the workers and return any shared resources
+       - by default, threads workers are started and each has its own
+         resources
+       - if concurrency is set, that many workers are started and they share
+         threads sets of resources (DB connections and writers) between them,
+         so far more API requests can be in flight than there are DB
+         connections.  The shared resources must be closed by the caller.
+    """
+
+    resources = []
+
+    if concurrency > 0:
+        logger.info('Starting %i workers sharing %i sets of resources' % (concurrency,threads))
+
+        for i in range(threads):
+            resources.append(create_worker_resources())
+
+        # Keep enough idle connections around for every worker to reuse one
+        qhttp.shared(logger).size = concurrency
+
+        for i in range(concurrency):
+            # Create a worker and pass it the queue and its resources
+            w = Worker(queue,resources[i % threads])
+
+            # Start the worker
+            w.start()
+    else:
+        for i in range(threads):
+            # Create a worker and pass it the queue
+            w = Worker(queue)
+
+            # Start the worker
+            w.start()
+
+    return resources
+
+
+def add_tq(qm,writer,domain,query,impressions,clicks):
     """
     Add top query
     """
 
     logger.debug('Adding webmaster top_query to database for domain: %s' % (domain))
 
-    sql = """
-             INSERT INTO webmaster_top_search_queries (date,domain_id,keyword_id,impressions,clicks)
-             VALUES (
-                %s,
-                (SELECT id from webmaster_domain where domain=%s),
-                (SELECT id from keyword_rank_keyword where keyword=%s),
-                %s,
-                %s
-             )"""
-
-    qs.execute(sql,(check_date_tq,domain,query,impressions,clicks))
-    if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
-        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+    writer.add((check_date_tq,domain_ids[domain],keyword_ids[query],impressions,clicks))
+    if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
 
 
-def add_error(qs,qm,error):
+def obtain_keyword_ids(qs,qm):
     """
-    Add an error type
+    Obtain a dictionary of keyword -> id for all keywords
     """
 
-    logger.debug('Adding error type to database: %s' % error)
+    logger.debug('Looking for keyword ids')
 
+    # Create SQL statement
     sql = """
-           INSERT INTO webmaster_crawl_error_type (type)
-           SELECT %s
-           FROM dual
-           WHERE not exists (SELECT * from webmaster_crawl_error_type WHERE type=%s)"""
+           SELECT id,keyword
+           FROM keyword_rank_keyword
+          """
 
-    qs.execute(sql,(error,error))
+    (rowcount,rows) = qs.execute(sql)
     if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
         qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
 
+    ids = {}
+    for row in rows:
+        ids[row[1]] = row[0]
+
+    # return the data
+    return ids
+
+
+def add_errors(qm,errors):
+    """
+    Add error types (if they are not already there) and return a
+    dictionary of error type -> id
+    """
+
+    logger.debug('Adding error types to database: %s' % errors)
+
+    type_ids = error_types.get_ids(errors)
+    if error_types.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (error_types.sql,error_types.emessage))
+
+    return type_ids
+
 
 
 def auth_webmaster(ql):
@@ -504,7 +652,7 @@ def query_webmaster_api_messages(qs,ql,qm):
             logger.debug('This message has already been read')
                 
 
-def query_webmaster_tq(qs,qm,ql,domain,keywords):
+def query_webmaster_tq(qm,ql,writer,domain,keywords):
     """
     Query the Google Webmaster for the top search queries
     """
@@ -557,7 +705,7 @@ def query_webmaster_tq(qs,qm,ql,domain,keywords):
                         impressions = re.sub('[,<]','',impressions)
                         clicks = re.sub('[,<]','',clicks)
                         if not options.test:
-                            add_tq(qs,qm,domain,keyword[0],impressions,clicks)
+                            add_tq(qm,writer,domain,keyword[0],impressions,clicks)
 
             except ValueError, ve:
                 # Log it and count the error
@@ -579,45 +727,40 @@ def query_webmaster_api_ce(qm,ql,url,errors):
 
     logger.debug('Processing next url: %s' % (url))
 
-    r = urllib2.Request(url)
-    r.add_header('Authorization','GoogleLogin auth=%s' % auth_key)
-    r.add_header('GData-Version','2')
+    headers = {'Authorization': 'GoogleLogin auth=%s' % auth_key,
+               'GData-Version': '2'}
 
     ATOM_NS = 'http://www.w3.org/2005/Atom'
 
-    # Count the API Call
-    ql.add_api_calls('webmaster',1)
+    # Count the API Call (connection errors and 5xx responses are retried by ql)
+    (code,response) = ql.http_fetch('webmaster',url,headers,1)
 
-    try:
-        request = urllib2.urlopen(r)
-    except urllib2.URLError, e:
-       # Count the error
-       ql.add_api_calls('webmaster',1,1)
+    if code is None and response is None:
+       # The API is down (its circuit breaker is open) - don't wait for it
+       logger.error('Google Webmaster API is unavailable - stopping further processing on this domain')
+       return errors,None
 
-       logger.error('error encountered requesting url %s : %s' % (url,e))
+    if code != 200:
+       if not code is None and code < 500 and code != 429:
+           # Count the error (other errors were counted when they were retried)
+           ql.add_api_calls('webmaster',1,1)
+
+       logger.error('error encountered requesting url %s : %s' % (url,code or response))
        if settings.SMTP_NOTIFY_ERROR:
-           qm.send('Error','error encountered requesting url %s : %s' % (url,e))
+           qm.send('Error','error encountered requesting url %s : %s' % (url,code or response))
 
        # If the error is a 403, then re-auth, the auth token may have expired.  Try again w/ the same URL
-       if re.match(r'403',str(e.code)):
+       if code == 403:
            logger.error('403 error detected - attempting to re-auth to Google ClientLogin Service')
            ql.pause(30)
            auth_webmaster(ql) 
            return errors,url
 
-       # If the error is a 500, then wait a bit and then try again w/ the same URL
-       if re.match(r'5(.*)',str(e.code)):
-           logger.error('5xx error detected - will wait a bit and try again with the same url')
-           ql.pause(30)
-           return errors,url
-
-       # Anything else, just return b/c we don't know how to handle this
+       # Anything else (including server errors that persisted through the
+       # retries), just return b/c we don't know how to handle this
        logger.error('Unknown error detected - stopping further processing on this domain')
        return errors,None
 
-    response = request.read()
-    request.close()
-
     xml = minidom.parseString(response)
 
     # Assume there is no next_url
@@ -659,21 +802,98 @@ def create_resources():
     qm = qemail.notify(settings.SMTP_HOST,
                       settings.SMTP_SENDER,
                       settings.SMTP_RECIPIENT,
-                      logger
+                      logger,
+                      'webmaster'
                      )
 
     # Create a qsql instance
-    qs = qsql.sql(host,user,password,name,logger)
+    qs = qsql.connect(host,user,password,name,logger)
 
-    # Create a qlib instance
-    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+    # Create a qlib instance (all instances share the API quota accountant)
+    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger,api_quota)
 
     return (qm,qs,ql)
 
 
+def create_quota():
+    """Create and return the API quota accountant
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'webmaster'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qquota.quota(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+
+
+def create_error_types():
+    """Create and return the crawl error type -> id cache
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qsql.idmap(qs,'webmaster_crawl_error_type','type',logger)
+
+
+def create_work_queue(lease):
+    """Create and return the work queue shared with every other process
+       running this job
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'webmaster'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qwork.queue(qs,qm,settings.SMTP_NOTIFY_ERROR,'webmaster',options.run,logger,lease=lease)
+
+
 def main():
     """ Main Program Execution"""
 
+    # Create the API quota accountant first so that every ql instance uses it
+    global api_quota
+    api_quota = create_quota()
+
+    # Forget the error type cache of any previous run (the scheduler runs main repeatedly)
+    global error_types
+    error_types = None
+
     # Create qm, qs and ql instances so we can do some work
     (qm,qs,ql) = create_resources()
 
@@ -700,6 +920,9 @@ def main():
     if smtp_notify_data_start:
         qm.send('Webmaster Job Starting','Starting Quinico Webmaster data collection job')
 
+    # Apply the slow SQL statement threshold
+    ql.init_sql_stats()
+
     # Obtain configuration parameters
     # If we cannot obtain any of these, we have to quit
 
@@ -738,6 +961,31 @@ def main():
     else:
        logger.info('Google Webmaster threads = %s' % webmaster_threads)
 
+    # Google Webmaster Concurrency (0, or not defined, gives each worker thread its own resources)
+    webmaster_concurrency = ql.return_config('webmaster_concurrency')
+    if webmaster_concurrency is None:
+        webmaster_concurrency = 0
+    logger.info('Google Webmaster concurrency = %s' % webmaster_concurrency)
+
+    # Work queue lease (0, or not defined, keeps the work in this process)
+    work_lease = ql.return_config('work_lease')
+    if work_lease is None:
+        work_lease = 0
+    logger.info('Work queue lease = %s' % work_lease)
+
+    # If the work is shared with other processes (on any host) through the
+    # database, only the process that sets the run up removes old data,
+    # checks the messages and adds the work items - the others wait for it
+    work = None
+    setup = True
+    if int(work_lease) > 0:
+        # Processes only share a run if they are all given the same one
+        if not options.run:
+            logger.error('The work queue is enabled but no run was given (--run)')
+            ql.terminate()
+
+        work = create_work_queue(int(work_lease))
+        setup = work.begin()
 
     # Top Queries Date (We'll check the data from two days ago, each day)
     global check_date_tq
@@ -746,7 +994,7 @@ def main():
 
     # Remove any webmaster data for our check_dates as this new data
     # should override them
-    if not options.test:
+    if setup and not options.test:
         ql.remove_data('webmaster_crawl_error')
         ql.remove_data('webmaster_top_search_queries',check_date_tq)
 
@@ -759,10 +1007,11 @@ def main():
 
     # Check the Google messages queue first, as that part is easy and quick
     # All other Google data queries will be threaded so they can progress faster
-    query_webmaster_api_messages(qs,ql,qm)
+    if setup:
+        query_webmaster_api_messages(qs,ql,qm)
 
-    # Sent a summary email of all urgent messages
-    send_urgent_messages(qs,ql,qm)
+        # Sent a summary email of all urgent messages
+        send_urgent_messages(qs,ql,qm)
 
     # Check all domains for crawl errors - we'll perform the tests serially so as not to overload the API
     domains = obtain_domains(qs,qm)
@@ -771,15 +1020,35 @@ def main():
         logger.error('No domains defined')
         ql.terminate()
     else:
-        # Create a queue for the tests
-        queue = Queue.Queue()
-
+        # Load the domain and keyword ids so that rows can be inserted with plain ids
+        global domain_ids
+        global keyword_ids
+        domain_ids = {}
         for row in domains:
-            queue.put(row)
+            domain_ids[row[1]] = row[0]
+        keyword_ids = obtain_keyword_ids(qs,qm)
+
+        # Create the shared error type cache (there are only a handful so load them all)
+        error_types = create_error_types()
+        error_types.load()
+
+        if work is None:
+            # Create a queue for the tests
+            queue = Queue.Queue()
+
+            for row in domains:
+                queue.put(row)
+        else:
+            # The workers claim the domains from the shared work queue
+            queue = work
+
+            if setup:
+                work.add(domains)
+                work.ready()
 
         # Start the workers.
         #   Notes:
-        #   - Keep the main thread open until it is the only one left
+        #   - Keep the main thread open until every worker is done
         #   - Do not daemonize the threads nor join on the queue
         #   - If the threads experience exceptions, or if they detect
         #     that the queue is empty, they will die.
@@ -787,21 +1056,43 @@ def main():
         #     and the queue never emptying.   It is preferable to have this process
         #     die and someone get alerted and investigate.
 
-        for i in range(int(webmaster_threads)):
-            # Create a worker and pass it the queue
-            w = Worker(queue)
-
-            # Start the worker
-            w.start()
+        resources = start_workers(queue,int(webmaster_threads),int(webmaster_concurrency))
 
-        # If all threads except this one are done, then quit
+        # If all of the workers are done, then quit
         # Check at 1 second intervals
-        while threading.active_count() > 1:
+        #   - other threads (e.g. the email sender) may still be running, so
+        #     only the workers are counted
+        while [t for t in threading.enumerate() if isinstance(t,Worker)]:
             time.sleep(1)
 
+        # In shared mode, write any buffered rows and disconnect from the DB server
+        for r in resources:
+            close_worker_resources(r)
+
+    # Report any domains that were given up on and disconnect the work queue
+    if not work is None:
+        failed = work.failed()
+        if failed:
+            logger.error('%s webmaster domains failed on every attempt' % failed)
+        work.close()
+
     # All done
     logger.info('All done with webmaster data processing')
 
+    # Save any outstanding API calls/errors
+    api_quota.close()
+
+    # Have the reports show the new data
+    if not options.test:
+        ql.bump_data_version('webmaster')
+
+    # Disconnect the error type cache from the DB server
+    if not error_types is None:
+        error_types.close()
+
+    # Report how long the SQL statements took
+    ql.report_sql_stats()
+
     # Disconnect from the DB server
     qs.close()
 
@@ -32,15 +32,21 @@ import datetime
 import pytz
 import quinico
 import Queue
+import BaseHTTPServer
+import socket
+import urlparse
 import threading
 import time
 import traceback
+import StringIO
 import xml.etree.ElementTree as ET
 from optparse import OptionParser
 from django.conf import settings
 from qclasses import qemail
 from qclasses import qsql
 from qclasses import qlib
+from qclasses import qhttp
+from qclasses import qquota
 
 
 # -- GLOBALLY AVAILABLE -- #
@@ -57,6 +63,9 @@ report_path = ''
 # API key
 wpt_key = ''
 
+# Process-wide API quota accountant shared by all threads
+api_quota = None
+
 # Grab the Quinico webapp settings
 os.environ['DJANGO_SETTINGS_MODULE'] = 'quinico.settings'
 
@@ -80,55 +89,90 @@ parser.add_option('-t','--test',
                         of any database data when this script is run.  \
                         No data will be added or deleted from the database \
                         except for API calls/errors.')
-(options, args) = parser.parse_args()
+# When imported (by the scheduler) the defaults are used
+if __name__ == "__main__":
+    (options, args) = parser.parse_args()
+else:
+    (options, args) = parser.parse_args([])
 
 # -- END GLOBALLY AVAILABLE -- #
 
 
+class Pingback(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handler for WPT pingbacks
+
+    WPT requests the pingback url with the test id as the 'id' parameter
+    when a test completes.  The test id is put on the server's queue.
+    """
+
+    def do_GET(self):
+        params = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+
+        if 'id' in params:
+            logger.info('Received pingback for test id: %s' % params['id'][0])
+            self.server.completed.put(params['id'][0])
+
+        self.send_response(200)
+        self.send_header('Content-Length','0')
+        self.end_headers()
+
+    def log_message(self,format,*args):
+        logger.debug('pingback request from %s: %s' % (self.client_address[0],format % args))
+
+
 class Worker(threading.Thread):
     """Worker thread for talking to external API 
     and acquiring/committing data
 
     To avoid contention, each thread will have its own ql, qs and
-    qemail instance
+    qemail instance, unless it is given a shared set of resources
+    (see start_workers)
     """
 
-    def __init__(self, queue):
+    def __init__(self, queue, resources=None):
         threading.Thread.__init__(self)
         self.queue = queue
+        self.resources = resources
 
     def run(self):
         t_name = threading.current_thread().name
         logger.info('Starting thread: %s' % t_name)
 
-        # Create qm, qs and ql instances
-        (qm,qs,ql) = create_resources()
+        # In shared mode the resources belong to main, which flushes and closes them
+        if self.resources is None:
+            resources = create_worker_resources()
+        else:
+            resources = self.resources
+
+        (qm,qs,ql,writer) = resources
 
         while True:
-            # Pop the next job off the queue and don't block if empty
+            # Wait for the next completed test
             try:
-                row = self.queue.get(False)
+                row = self.queue.get()
+
+                # Once all tests are finished, there is a None on the queue for each worker
+                if row is None:
+                    logger.info('No more tests, stopping thread %s' % t_name)
+
+                    # Write any buffered rows and disconnect from the DB server
+                    if self.resources is None:
+                        close_worker_resources(resources)
+
+                    # Stop the thread
+                    break
+
                 t_id = row[0]
                 t_domain = row[1]
-                t_url = row[2]
-                t_location = row[3]
-        
-                logger.info('Found a test: id:%s, domain:%s, url:%s, location:%s' % (t_id,t_domain,t_url,t_location))
-                query_webpagetest(qs,qm,ql,t_id,t_domain,t_url,t_location)
+                testId = row[2]
+                xml_url = row[3]
+
+                logger.info('Found a completed test: id:%s, domain:%s, test id:%s' % (t_id,t_domain,testId))
+                collect_webpagetest(qm,ql,writer,t_id,t_domain,testId,xml_url)
 
                 # Let the queue know I am done
                 self.queue.task_done()
 
-            except Queue.Empty:
-                # Queue is empty, close down this thread.
-                logger.info('Queue is empty, stopping thread %s' % t_name)
-
-                # Disconnect from the DB server
-                qs.close()
-
-                # Stop the thread
-                break
-
             except Exception:
                 # Most likely there was a problem with the Webpagetest API
                 # This generally should not happen as the function definitions that
@@ -137,8 +181,9 @@ class Worker(threading.Thread):
                 if settings.SMTP_NOTIFY_ERROR:
                     qm.send('Error','Exception encountered with thread %s: %s' % (t_name,traceback.format_exc()))
 
-                # Disconnect from the DB server
-                qs.close()
+                # Write any buffered rows and disconnect from the DB server
+                if self.resources is None:
+                    close_worker_resources(resources)
 
                 # Stop the thread
                 break
@@ -167,20 +212,108 @@ def obtain_tests(qs,qm):
     return rows
 
 
-def query_webpagetest(qs,qm,ql,t_id,domain,u,l):
+def create_writer(qs):
+    """
+    Create and return the buffered writer for scores
+    """
+
+    columns = ['date','test_id','testId','viewNumber','loadTime','ttfb','bytesOut','bytesOutDoc','bytesIn','bytesInDoc','connections','requests','requestsDoc','responses_200','responses_404','responses_other','result','render','fullyLoaded','cached','docTime','domTime','score_cache','score_cdn','score_gzip','score_cookies','score_keep_alive','score_minify','score_combine','score_compress','score_etags','gzip_total','gzip_savings','minify_total','minify_savings','image_total','image_savings','aft','domElements','view_failed','test_failed','report','local_date']
+
+    return qsql.bulk(qs,'webpagetest_score',columns,logger=logger)
+
+
+def flush_writer(qm,writer):
+    """
+    Write any rows buffered in a writer
+    """
+
+    writer.flush()
+    if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+        qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
+
+
+def create_worker_resources():
+    """Create and return the resources used by a worker
+       - (qm,qs,ql,writer)
+    """
+
+    (qm,qs,ql) = create_resources()
+
+    # Scores are buffered and written in batches
+    writer = create_writer(qs)
+
+    return (qm,qs,ql,writer)
+
+
+def close_worker_resources(resources):
+    """
+    Write any buffered rows and disconnect from the DB server
+    """
+
+    (qm,qs,ql,writer) = resources
+
+    flush_writer(qm,writer)
+
+    qs.close()
+
+
+def start_workers(queue,threads,concurrency):
+    """Start the workers and return any shared resources
+       - by default, threads workers are started and each has its own
+         resources
+       - if concurrency is set, that many workers are started and they share
+         threads sets of resources (DB connections and writers) between them,
+         so far more API requests can be in flight than there are DB
+         connections.  The shared resources must be closed by the caller.
     """
-    Query the Webpagetest API
+
+    resources = []
+
+    if concurrency > 0:
+        logger.info('Starting %i workers sharing %i sets of resources' % (concurrency,threads))
+
+        for i in range(threads):
+            resources.append(create_worker_resources())
+
+        # Keep enough idle connections around for every worker to reuse one
+        qhttp.shared(logger).size = concurrency
+
+        for i in range(concurrency):
+            # Create a worker and pass it the queue and its resources
+            w = Worker(queue,resources[i % threads])
+
+            # Start the worker
+            w.start()
+    else:
+        for i in range(threads):
+            # Create a worker and pass it the queue
+            w = Worker(queue)
+
+            # Start the worker
+            w.start()
+
+    return resources
+
+
+def submit_webpagetest(qm,ql,t_id,domain,u,l,pingback=None):
+    """
+    Submit a test to the Webpagetest API, asking it to request the
+    pingback url (if given) once the test is done
+    Returns (t_id,domain,testId,xml_url) or None if the test was not submitted
     """
 
     logger.info('Checking %s for url %s from location %s' % (domain,u,l))
 
     test_url = 'http://%s/runtest.php?f=json&runs=1&%s'
-    stat_url = 'http://%s/testStatus.php?test=%s&f=json'
 
     params = {}
     params['url'] = '%s%s' % (domain,u)
     params['location'] = l
 
+    # Ask WPT to let us know when the test is done
+    if pingback:
+        params['pingback'] = pingback
+
     url = test_url % (settings.WPT_SERVER,urllib.urlencode(params)) 
 
     # Can't url_encode the key
@@ -215,28 +348,126 @@ def query_webpagetest(qs,qm,ql,t_id,domain,u,l):
             qm.send('Error','Error encountered in parsing json:\ndomain:%s\nerror:%s\nraw_data:%s' % (domain,e,raw_json))
         return
 
-    # We'll check at periodic intervals to see if the test has completed and we'll check a maximum
-    # number of times and then give up
-    status_url = stat_url % (settings.WPT_SERVER,testId) 
-    test_status_code = ''
+    return (t_id,domain,testId,xml_url)
+
+
+def start_pingback():
+    """
+    Start the pingback listener in its own thread and return it, or None
+    if it cannot listen on the port
+    Completed test ids are put on the server's completed queue
+    """
+
+    logger.info('Listening for WPT pingbacks on port %s' % settings.WPT_PINGBACK_PORT)
+
+    try:
+        server = BaseHTTPServer.HTTPServer(('',int(settings.WPT_PINGBACK_PORT)),Pingback)
+    except socket.error as e:
+        logger.error('Could not listen for WPT pingbacks on port %s (%s), checking the test status instead' % (settings.WPT_PINGBACK_PORT,e))
+        return None
+
+    server.completed = Queue.Queue()
+
+    # Daemonized so that it can never keep the job from exiting
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    return server
+
+
+def stop_pingback(server):
+    """
+    Stop the pingback listener
+    """
+
+    logger.info('Stopping the WPT pingback listener')
+
+    server.shutdown()
+    server.server_close()
+
+
+def wait_webpagetest(qm,ql,queue,pending,completed):
+    """
+    Wait for the pingbacks of all submitted tests, for at most wpt_wait *
+    wpt_attempts seconds, and put each test on the queue as soon as it
+    has completed so the workers can collect the results
+    Any test without a pingback gets a final status check
+    """
+
+    tests = {}
+    for test in pending:
+        tests[test[2]] = test
+
+    deadline = time.time() + int(wpt_wait) * int(wpt_attempts)
+    while tests and time.time() < deadline:
+        try:
+            testId = completed.get(True,min(60,max(1,deadline - time.time())))
+        except Queue.Empty:
+            logger.info('%s tests are waiting for a pingback' % len(tests))
+            continue
+
+        if testId in tests:
+            queue.put(tests.pop(testId))
+        else:
+            logger.warning('Received a pingback for an unknown test id: %s' % testId)
+
+    # The pingback may have been lost, so check anything still outstanding
+    if tests:
+        logger.warning('No pingback for %s tests, checking their status' % len(tests))
+        poll_webpagetest(qm,ql,queue,tests.values(),1)
+
+
+def poll_webpagetest(qm,ql,queue,pending,attempts):
+    """
+    Check the status of all submitted tests, once per wpt_wait period for at
+    most attempts periods, and put each test on the queue as soon as it
+    has completed so the workers can collect the results
+    """
+
+    stat_url = 'http://%s/testStatus.php?test=%s&f=json'
+
     counter = 0
-    while test_status_code != 200:
+    while pending:
         if counter != 0:
-           logger.info('Counter is at %s with a maximum of %s periods.  Sleeping %s seconds.' % (counter,wpt_attempts,wpt_wait))
+           logger.info('Counter is at %s with a maximum of %s periods.  %s tests are pending.  Sleeping %s seconds.' % (counter,attempts,len(pending),wpt_wait))
            ql.pause(int(wpt_wait))
-        
-        test_status_code = check_status(ql,status_url)
+
+        waiting = []
+        for test in pending:
+            status_url = stat_url % (settings.WPT_SERVER,test[2])
+            test_status_code = check_status(ql,status_url)
+
+            if test_status_code == 200:
+                # The test is done
+                queue.put(test)
+            elif test_status_code >= 400:
+                # The test failed or was cancelled so it will never complete
+                logger.error('WPT test %s for %s ended with status %s' % (test[2],test[1],test_status_code))
+                if settings.SMTP_NOTIFY_ERROR:
+                    qm.send('Error','WPT test %s for %s ended with status %s' % (test[2],test[1],test_status_code))
+            else:
+                waiting.append(test)
+
+        pending = waiting
         counter += 1
 
         # Could not obtain a status so quit checking
-        if counter >= int(wpt_attempts):
-            logger.error('Could not obtain WPT status for %s within %s intervals' % (status_url,wpt_attempts))
-            if settings.SMTP_NOTIFY_ERROR:
-                qm.send('Error','Could not obtain WPT status for %s within %s intervals' % (status_url,wpt_attempts))
+        if pending and counter >= int(attempts):
+            for test in pending:
+                status_url = stat_url % (settings.WPT_SERVER,test[2])
+                logger.error('Could not obtain WPT status for %s within %s intervals' % (status_url,attempts))
+                if settings.SMTP_NOTIFY_ERROR:
+                    qm.send('Error','Could not obtain WPT status for %s within %s intervals' % (status_url,attempts))
             return
 
-    # We received a good status (the test is done)
-    # Now grab the data (these API calls are not counted against our total)
+
+def collect_webpagetest(qm,ql,writer,t_id,domain,testId,xml_url):
+    """
+    Download and save the results of a completed test
+    """
+
+    # Grab the data (these API calls are not counted against our total)
     logger.info('downloading report from %s' % xml_url)
     x_response = ql.http_request1('webpagetest',xml_url,None)
     if not x_response:
@@ -245,7 +476,10 @@ def query_webpagetest(qs,qm,ql,t_id,domain,u,l):
             qm.send('Error','Could not obtain WPT test results for %s from %s.' % (domain,xml_url))
         return
 
-    xml = ET.fromstring(x_response)
+    # List of metrics we are tracking
+    output_values = ['loadTime','TTFB','bytesOut','bytesOutDoc','bytesIn','bytesInDoc','connections','requests','requestsDoc','responses_200','responses_404','responses_other','result','render','fullyLoaded','cached','docTime','domTime','score_cache','score_cdn','score_gzip','score_cookies','score_keep-alive','score_minify','score_combine','score_compress','score_etags','gzip_total','gzip_savings','minify_total','minify_savings','image_total','image_savings','aft','domElements']
+
+    (metrics,successful_runs) = parse_webpagetest(x_response,output_values)
 
     # Save the full report
     report_file = ql.save_report(report_path,'webpagetest',x_response)
@@ -253,24 +487,19 @@ def query_webpagetest(qs,qm,ql,t_id,domain,u,l):
     # Create a datetime object for right now
     time_now = datetime.datetime.now()
 
+    # The local date is stored too so that trends can be grouped by day
+    # without converting every row back from UTC
+    local_date = time_now.date()
+
     # Add the server's timezone and then convert to UTC before adding to the DB
     time_now = ql.convert_date_utc(time_now,settings.TIME_ZONE)
 
-    # List of metrics we are tracking
-    output_values = ['loadTime','TTFB','bytesOut','bytesOutDoc','bytesIn','bytesInDoc','connections','requests','requestsDoc','responses_200','responses_404','responses_other','result','render','fullyLoaded','cached','docTime','domTime','score_cache','score_cdn','score_gzip','score_cookies','score_keep-alive','score_minify','score_combine','score_compress','score_etags','gzip_total','gzip_savings','minify_total','minify_savings','image_total','image_savings','aft','domElements']
-
     # We are doing only one run with a repeat view
     # If one view fails, then the whole test will be marked as failed
     # We need to figure this out before looking at each test status as
     # we are inserting data into the DB after analyzing each run
     test_failed = 0
-    try:
-        successful_runs_fv = xml.findall('./data/successful%sRuns' % ('FV'))[0].text
-        successful_runs_rv = xml.findall('./data/successful%sRuns' % ('RV'))[0].text
-
-        if not successful_runs_fv == '1' or not successful_runs_rv == '1':
-            test_failed = 1
-    except Exception as e:
+    if not successful_runs.get('FV') == '1' or not successful_runs.get('RV') == '1':
         test_failed = 1
 
     # Look through each view for specific data
@@ -294,26 +523,24 @@ def query_webpagetest(qs,qm,ql,t_id,domain,u,l):
         # Run through the values we are looking for from WPT
         # If there is no value, insert a zero
         for output_value in output_values:
-            try:
-                values.append(xml.findall('./data/run/%s/results/%s' % (view_num,output_value))[0].text)
-            except Exception as e:
+            if output_value in metrics[view_num]:
+                values.append(metrics[view_num][output_value])
+            else:
                 # The value was not there, so add a zero
                 values.append(0)
-                logger.warning('Error encountered searching for %s in view %s for %s:nError: %s,Url: %s' % (output_value,view,domain,e,xml_url))
+                logger.warning('Could not find %s in view %s for %s, Url: %s' % (output_value,view,domain,xml_url))
 
         # Add the view status (we should have one successful run for FV and RV)
         # Start with success
         view_failed = 0
 
-        try:
-            successful_runs = xml.findall('./data/successful%sRuns' % (view_type))[0].text
-            logger.debug('Successful %s runs:%s' % (view_type,successful_runs))
+        if view_type in successful_runs:
+            logger.debug('Successful %s runs:%s' % (view_type,successful_runs[view_type]))
 
-            if not successful_runs == '1':
+            if not successful_runs[view_type] == '1':
                 view_failed = 1
-
-        except Exception as e:
-            logger.warning('Error encountered searching %s runs for %s : %s : %s.' % (view_type,domain,xml_url,e))
+        else:
+            logger.warning('Could not find successful %s runs for %s : %s.' % (view_type,domain,xml_url))
             view_failed = 1
         
         # Add the view and test status
@@ -323,14 +550,58 @@ def query_webpagetest(qs,qm,ql,t_id,domain,u,l):
         # Add the report file (it will be the same report file for both views)
         values.append(report_file)
 
-        sql = """
-           INSERT INTO webpagetest_score (date,test_id,testId,viewNumber,loadTime,ttfb,bytesOut,bytesOutDoc,bytesIn,bytesInDoc,connections,requests,requestsDoc,responses_200,responses_404,responses_other,result,render,fullyLoaded,cached,docTime,domTime,score_cache,score_cdn,score_gzip,score_cookies,score_keep_alive,score_minify,score_combine,score_compress,score_etags,gzip_total,gzip_savings,minify_total,minify_savings,image_total,image_savings,aft,domElements,view_failed,test_failed,report)
-           VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
+        # Add the local date of the test
+        values.append(local_date)
 
         if not options.test:
-            qs.execute(sql,values)
-            if qs.status != 0 and settings.SMTP_NOTIFY_ERROR:
-                qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,qs.emessage))
+            writer.add(values)
+            if writer.status != 0 and settings.SMTP_NOTIFY_ERROR:
+                qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (writer.sql,writer.emessage))
+
+
+def parse_webpagetest(x_response,output_values):
+    """
+    Parse a WPT XML report in a single pass
+    Returns (metrics,successful_runs) where metrics holds the output_values
+    found in ./data/run/<view>/results, keyed by view (firstView or repeatView)
+    and then by name, and successful_runs holds ./data/successful<FV|RV>Runs,
+    keyed by FV or RV.  Only the first run is used for each view.
+    """
+
+    wanted = set(output_values)
+    metrics = {'firstView': {}, 'repeatView': {}}
+    successful_runs = {}
+
+    # Tags of the open elements, below the root, and the open elements themselves
+    path = []
+    elements = []
+
+    for (event,elem) in ET.iterparse(StringIO.StringIO(x_response),events=('start','end')):
+        if event == 'start':
+            if elements:
+                path.append(elem.tag)
+            elements.append(elem)
+            continue
+
+        # data/run/<view>/results/<value>
+        if len(path) == 5 and path[0] == 'data' and path[1] == 'run' and path[3] == 'results':
+            if path[2] in metrics and path[4] in wanted and not path[4] in metrics[path[2]]:
+                metrics[path[2]][path[4]] = elem.text
+
+        # data/successful<FV|RV>Runs
+        elif len(path) == 2 and path[0] == 'data':
+            if path[1] == 'successfulFVRuns':
+                successful_runs.setdefault('FV',elem.text)
+            elif path[1] == 'successfulRVRuns':
+                successful_runs.setdefault('RV',elem.text)
+
+        # This element is done with, so drop it to keep memory use flat
+        elements.pop()
+        if elements:
+            path.pop()
+            elements[-1].remove(elem)
+
+    return (metrics,successful_runs)
 
 
 def check_status(ql,url):
@@ -346,10 +617,14 @@ def check_status(ql,url):
         return
 
     logger.debug(json.dumps(response))
-    raw_json = json.loads(response)
 
     # We are interested in the statusCode only
-    test_status_code = raw_json['statusCode']
+    try:
+        raw_json = json.loads(response)
+        test_status_code = int(raw_json['statusCode'])
+    except Exception as e:
+        logger.error('Error encountered in parsing status json: url:%s,error:%s,raw_data:%s' % (url,e,response))
+        return
     logger.info('test status code: %s' % test_status_code)
 
     return test_status_code
@@ -372,21 +647,51 @@ def create_resources():
     qm = qemail.notify(settings.SMTP_HOST,
                       settings.SMTP_SENDER,
                       settings.SMTP_RECIPIENT,
-                      logger
+                      logger,
+                      'webpagetest'
                      )
 
     # Create a qsql instance
-    qs = qsql.sql(host,user,password,name,logger)
+    qs = qsql.connect(host,user,password,name,logger)
 
-    # Create a qlib instance
-    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+    # Create a qlib instance (all instances share the API quota accountant)
+    ql = qlib.lib(qs,qm,settings.SMTP_NOTIFY_ERROR,logger,api_quota)
 
     return (qm,qs,ql)
 
 
+def create_quota():
+    """Create and return the API quota accountant
+       - it has its own qsql instance since it is shared by all threads
+    """
+
+    # Obtain database parameters from DJango
+    host = settings.DATABASES['default']['HOST']
+    user = settings.DATABASES['default']['USER']
+    password = settings.DATABASES['default']['PASSWORD']
+    name = settings.DATABASES['default']['NAME']
+
+    # Create a qemail instance
+    qm = qemail.notify(settings.SMTP_HOST,
+                      settings.SMTP_SENDER,
+                      settings.SMTP_RECIPIENT,
+                      logger,
+                      'webpagetest'
+                     )
+
+    # Create a qsql instance
+    qs = qsql.connect(host,user,password,name,logger)
+
+    return qquota.quota(qs,qm,settings.SMTP_NOTIFY_ERROR,logger)
+
+
 def main():
     """Main Program Execution"""
 
+    # Create the API quota accountant first so that every ql instance uses it
+    global api_quota
+    api_quota = create_quota()
+
     # Create qm, qs and ql instances so we can do some work
     (qm,qs,ql) = create_resources()
 
@@ -416,6 +721,9 @@ def main():
     if smtp_notify_data_start:
         qm.send('Webpagetest Job Starting','Starting Quinico Webpagetest data collection job')
 
+    # Apply the slow SQL statement threshold
+    ql.init_sql_stats()
+
     # Obtain configuration parameters
     # If we cannot obtain any of these, we have to quit
 
@@ -462,44 +770,88 @@ def main():
     else:
        logger.info('Webpagetest threads = %s' % wpt_threads)
 
+    # Webpagetest Concurrency (0, or not defined, gives each worker thread its own resources)
+    wpt_concurrency = ql.return_config('wpt_concurrency')
+    if wpt_concurrency is None:
+        wpt_concurrency = 0
+    logger.info('Webpagetest concurrency = %s' % wpt_concurrency)
+
     # Check all domains and urls
     tests = obtain_tests(qs,qm)
     if not tests:
         logger.error('No webpagetests defined')
         ql.terminate()
     else:
-        # Create a queue for the tests
-        queue = Queue.Queue()
-
-        # Add all tests to the queue
+        # Start listening before any test is submitted so no pingback is missed
+        # If the listener cannot be started the test status is polled instead
+        server = None
+        pingback = None
+        if settings.WPT_PINGBACK_URL:
+            server = start_pingback()
+            if not server is None:
+                pingback = settings.WPT_PINGBACK_URL
+
+        # Submit every test up front so the WPT agents are kept busy
+        pending = []
         for row in tests:
-            queue.put(row)
+            logger.info('Found a test: id:%s, domain:%s, url:%s, location:%s' % (row[0],row[1],row[2],row[3]))
+            test = submit_webpagetest(qm,ql,row[0],row[1],row[2],row[3],pingback)
+            if test:
+                pending.append(test)
+
+        # Create a queue for the completed tests
+        queue = Queue.Queue()
 
         # Start the workers.  
         #   Notes:
-        #   - Keep the main thread open until it is the only one left
+        #   - Keep the main thread open until every worker is done
         #   - Do not daemonize the threads nor join on the queue
-        #   - If the threads experience exceptions, or if they detect
-        #     that the queue is empty, they will die.
+        #   - The main thread waits for the pingbacks of (or polls the status of)
+        #     all submitted tests and puts each one on the queue when it completes.
+        #     The workers download and save the results.
+        #   - If the threads experience exceptions, or if they find a None
+        #     on the queue (there is one per worker once polling is done), they will die.
         #   - The above prevents the threads dieing due to exceptions w/ the API
         #     and the queue never emptying.   It is preferable to have this process 
         #     die and someone get alerted and investigate.
-        for i in range(int(wpt_threads)):
-            # Create a worker and pass it the queue
-            w = Worker(queue)
+        resources = start_workers(queue,int(wpt_threads),int(wpt_concurrency))
 
-            # Start the worker
-            w.start()
+        # Wait until every test has completed or has run out of time
+        if server is None:
+            poll_webpagetest(qm,ql,queue,pending,wpt_attempts)
+        else:
+            wait_webpagetest(qm,ql,queue,pending,server.completed)
+            stop_pingback(server)
 
-        # If all threads except this one are done, then quit
+        # Let every worker know that there are no more tests
+        for i in range(max(int(wpt_threads),int(wpt_concurrency))):
+            queue.put(None)
+
+        # If all of the workers are done, then quit
         # Check at 1 second intervals
-        while threading.active_count() > 1:
+        #   - other threads (e.g. the email sender) may still be running, so
+        #     only the workers are counted
+        while [t for t in threading.enumerate() if isinstance(t,Worker)]:
             time.sleep(1)
 
+        # In shared mode, write any buffered rows and disconnect from the DB server
+        for r in resources:
+            close_worker_resources(r)
+
 
     # All done
     logger.info('All done with webpagetest data processing')
 
+    # Save any outstanding API calls/errors
+    api_quota.close()
+
+    # Have the reports show the new data
+    if not options.test:
+        ql.bump_data_version('webpagetest')
+
+    # Report how long the SQL statements took
+    ql.report_sql_stats()
+
     # Disconnect from the DB server
     qs.close()
 
@@ -22,6 +22,8 @@ DATABASES = {
         'PASSWORD' : '$__db_pass__$', 
         'HOST'     : '$__db_host__$', 
         'PORT'     : '$__db_port__$', 
+        # New tables are InnoDB so the data jobs can write in transactions
+        'OPTIONS'  : {'init_command': 'SET default_storage_engine=INNODB'},
     }
 }
 SECRET_KEY = '$__secret_key__$'
@@ -48,3 +50,8 @@ SMTP_NOTIFY_ERROR = True
 # file but may be overridden here
 
 #TIME_ZONE = ''
+#WPT_PINGBACK_URL = ''
+#WPT_PINGBACK_PORT = 8765
+#RESPONSE_CACHE = 'memory'
+#RESPONSE_CACHE_DIR = ''
+#RESPONSE_CACHE_SIZE = 1000
@@ -16,6 +16,17 @@
 
 """Mail sending class for Quinico
 
+   Messages are queued and sent by a background thread so callers (often
+   worker threads in the middle of collecting data) never wait on DNS or
+   SMTP.  The first occurrence of a message is sent right away; repeats of
+   the same subject and message, and anything over the rate limit, are
+   counted and sent together as a periodic digest.  One SMTP session is
+   reused for all messages.
+
+   Functions:
+    - shared: return the process-wide sender for an SMTP host/sender/recipient
+    - flush_all: send everything queued by all senders (run at exit)
+
    Requirements:
     1. A properly configured SMTP host
     2. Valid sender and recipient addresses
@@ -26,40 +37,269 @@
 """
 
 
-import inspect
+import atexit
+import Queue
 import smtplib
 import socket
+import sys
+import threading
 import time
 
 
+# Process-wide senders returned by shared(), keyed by (server,sender,recipient)
+_shared = {}
+_shared_lock = threading.Lock()
+
+# Host metadata does not change while a job runs, so it is looked up once
+_hostname = None
+_job = None
+
+
+def host_metadata():
+    """
+    Return (hostname,job), looking them up on first use
+    """
+
+    global _hostname, _job
+
+    if _hostname is None:
+        # Obtain the hostname
+        if socket.gethostname().find('.')>=0:
+            _hostname=socket.gethostname()
+        else:
+            try:
+                _hostname=socket.gethostbyaddr(socket.gethostname())[0]
+            except socket.error:
+                _hostname=socket.gethostname()
+
+    if _job is None:
+        # Obtain the calling job
+        _job = sys.argv[0] if sys.argv and sys.argv[0] else 'unknown'
+
+    return (_hostname,_job)
+
+
+def shared(server, sender, recipient, logger=None):
+    """
+    Return the process-wide sender for these addresses, starting it if needed
+    """
+
+    key = (server,sender,recipient)
+
+    with _shared_lock:
+        if not key in _shared:
+            _shared[key] = queue(server,sender,recipient,logger)
+
+    return _shared[key]
+
+
+def flush_all():
+    """
+    Send everything that is still queued and stop all senders
+    """
+
+    with _shared_lock:
+        senders = _shared.values()
+
+    for q in senders:
+        q.close()
+
+
+# Jobs exit from many places (including qlib.terminate) so make sure
+# queued notifications always go out
+atexit.register(flush_all)
+
+
 class notify:
 
     Name = "notify"
 
 
-    def __init__(self, server, sender, recipient, logger=None):
-        """Constructor"""
+    def __init__(self, server, sender, recipient, logger=None, job=None):
+        """Constructor
+
+        job names the job in the messages (the program being run if not
+        given, which is the scheduler for every job it runs)
+        """
 
         self.server = server
         self.sender = sender
         self.recipient = recipient
         self.logger = logger
+        self.job = job
+        self.queue = shared(server,sender,recipient,logger)
 
 
     def send(self,subject,message):
-        """Send an email message"""
+        """Queue an email message (sent in the background)"""
 
-        # Obtain the hostname
-        if socket.gethostname().find('.')>=0:
-            hostname=socket.gethostname()
-        else:
-            hostname=socket.gethostbyaddr(socket.gethostname())[0]
+        self.queue.put(subject,message,self.job)
 
-        # Obtain the localtime
-        localtime = time.asctime( time.localtime(time.time()) )
 
-        # Obtain the calling job
-        job = inspect.stack()[-1][1]
+    def flush(self):
+        """Wait until all queued messages have been handed to the SMTP server"""
+
+        self.queue.flush()
+
+
+class queue:
+
+    Name = "queue"
+
+
+    def __init__(self, server, sender, recipient, logger=None, interval=300, limit=10):
+        """
+        Constructor
+
+        Within each interval (in seconds) at most limit messages are sent
+        individually and each distinct subject/message is sent only once;
+        everything else is summarized in a digest at the end of the interval
+        """
+
+        self.server = server
+        self.sender = sender
+        self.recipient = recipient
+        self.logger = logger
+        self.interval = interval
+        self.limit = limit
+
+        # The SMTP session, opened on first use and reused afterwards
+        self.smtp = None
+
+        # Messages waiting for the sender thread
+        self.messages = Queue.Queue()
+
+        # State of the current interval (only used by the sender thread)
+        self.window = time.time()
+        self.sent = 0
+        self.seen = set()
+        self.digest = {}
+
+        self.closed = False
+        self.thread = threading.Thread(target=self.run,name='qemail')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def put(self,subject,message,job=None):
+        """
+        Queue a message
+        """
+
+        if self.closed:
+            # The sender has been stopped (at exit), so send directly
+            self.deliver(subject,message,time.time(),job)
+            self.close_smtp()
+            return
+
+        self.messages.put((subject,message,time.time(),job))
+
+
+    def flush(self):
+        """
+        Wait until every queued message has been processed
+        """
+
+        self.messages.join()
+
+
+    def close(self):
+        """
+        Send queued messages and any pending digest, then stop the sender
+        """
+
+        if self.closed:
+            return
+
+        self.messages.put(None)
+        self.thread.join()
+        self.closed = True
+
+
+    def run(self):
+        """
+        Sender thread: send or coalesce queued messages until stopped
+        """
+
+        while True:
+            timeout = max(self.window + self.interval - time.time(),0)
+
+            try:
+                item = self.messages.get(True,timeout)
+            except Queue.Empty:
+                self.send_digest()
+                continue
+
+            try:
+                if item is None:
+                    self.send_digest()
+                    self.close_smtp()
+                    return
+
+                (subject,message,queued,job) = item
+                key = (subject,message,job)
+
+                if key in self.seen or self.sent >= self.limit:
+                    # A repeat or over the limit - summarize it in the digest
+                    if key in self.digest:
+                        self.digest[key][0] += 1
+                        self.digest[key][2] = queued
+                    else:
+                        self.digest[key] = [1,queued,queued]
+                else:
+                    self.seen.add(key)
+                    self.sent += 1
+                    self.deliver(subject,message,queued,job)
+
+                if time.time() >= self.window + self.interval:
+                    self.send_digest()
+
+            except Exception as e:
+                if not self.logger is None:
+                    self.logger.error('Unable to process email:%s' % e)
+
+            finally:
+                self.messages.task_done()
+
+
+    def send_digest(self):
+        """
+        Send the messages coalesced during this interval and start a new one
+        """
+
+        if self.digest:
+            count = sum(d[0] for d in self.digest.values())
+            sections = []
+            for (key,(n,first,last)) in sorted(self.digest.items(),key=lambda i: i[1][1]):
+                (subject,message,job) = key
+                sections.append('%s time(s) between %s and %s\nJob:%s\nSubject:%s\n\n%s' % (n,
+                                                                                            time.asctime(time.localtime(first)),
+                                                                                            time.asctime(time.localtime(last)),
+                                                                                            job or host_metadata()[1],
+                                                                                            subject,
+                                                                                            message))
+
+            self.deliver('Digest (%s messages)' % count,
+                         ('\n\n%s\n\n' % ('-' * 72)).join(sections),
+                         time.time())
+
+        self.window = time.time()
+        self.sent = 0
+        self.seen = set()
+        self.digest = {}
+
+
+    def deliver(self,subject,message,queued,job=None):
+        """
+        Send one email message over the (reused) SMTP session
+        """
+
+        (hostname,program) = host_metadata()
+        if job is None:
+            job = program
+
+        # Obtain the localtime
+        localtime = time.asctime( time.localtime(queued) )
 
         # Construct the message
         m = 'To: %s\nFrom: %s\nSubject: Quinico - %s\nQuinico Server:%s\nLocal Time:%s\nJob:%s\n\n%s' % (self.recipient,
@@ -70,11 +310,37 @@ class notify:
                                                                                                          job,
                                                                                                          message)
 
-        try:
-            smtpObj = smtplib.SMTP(self.server)
-            smtpObj.sendmail(self.sender, self.recipient, m)
-            if not self.logger is None:
-                self.logger.info('Successfully sent email')
-        except Exception as e:
-            if not self.logger is None:
-                self.logger.error('Unable to send email:%s' % e)
+        # A reused session may have been dropped by the server, so
+        # retry once on a new session in that case
+        for attempt in (1,2):
+            try:
+                if self.smtp is None:
+                    self.smtp = smtplib.SMTP(self.server)
+                self.smtp.sendmail(self.sender, self.recipient, m)
+                if not self.logger is None:
+                    self.logger.info('Successfully sent email')
+                return
+            except (smtplib.SMTPServerDisconnected,socket.error) as e:
+                self.smtp = None
+                if attempt == 1:
+                    continue
+                if not self.logger is None:
+                    self.logger.error('Unable to send email:%s' % e)
+            except Exception as e:
+                self.close_smtp()
+                if not self.logger is None:
+                    self.logger.error('Unable to send email:%s' % e)
+                return
+
+
+    def close_smtp(self):
+        """
+        Close the SMTP session if one is open
+        """
+
+        if not self.smtp is None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
@@ -0,0 +1,246 @@
+#
+# Copyright 2013 - Tom Alessi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""HTTP connection pool class for Quinico
+
+   Persistent (keep-alive) connections are kept per scheme/host/port and
+   reused by every thread in a process, so repeated API calls to the same
+   host do not each pay for a new TCP and TLS handshake.  Responses are
+   requested gzipped and decompressed transparently.
+
+   Functions:
+    - shared: return the process-wide pool (created on first use)
+
+   Optional:
+    - Logging is optional - provide a properly configured instance of
+      a logger if desired.
+"""
+
+
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+
+# Process-wide pool returned by shared()
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared(logger=None):
+    """
+    Return the process-wide pool, creating it if needed
+    """
+
+    global _shared
+
+    with _shared_lock:
+        if _shared is None:
+            _shared = pool(logger=logger)
+
+    return _shared
+
+
+class pool:
+
+    Name = "pool"
+
+
+    def __init__(self, size=4, idle=60, timeout=120, redirects=5, logger=None):
+        """
+        Constructor
+
+        size is the maximum number of idle connections kept per host,
+        idle is the number of seconds after which an unused connection is
+        closed and timeout is the socket timeout for each connection
+        """
+
+        self.size = size
+        self.idle = idle
+        self.timeout = timeout
+        self.redirects = redirects
+        self.logger = logger
+
+        # Idle connections, keyed by (scheme,host,port): [(connection,last used)]
+        self.connections = {}
+        self.lock = threading.Lock()
+
+
+    def request(self,url,headers=None,method='GET',body=None):
+        """
+        Make a request and return (status code,response body)
+        Redirects are followed.  Exceptions are raised to the caller.
+        """
+
+        (status,response_headers,response) = self.fetch(url,headers,method,body)
+
+        return (status,response)
+
+
+    def fetch(self,url,headers=None,method='GET',body=None):
+        """
+        Make a request and return (status code,response headers,response body)
+        The response header names are lower case.  Redirects are followed.
+        Exceptions are raised to the caller.
+        """
+
+        for i in range(self.redirects + 1):
+            (status,response_headers,response) = self._request(url,headers,method,body)
+
+            location = response_headers.get('location')
+            if not status in (301,302,303,307) or not location:
+                return (status,response_headers,response)
+
+            # Follow the redirect (a 303 is always a GET)
+            url = urlparse.urljoin(url,location)
+            if status == 303:
+                method = 'GET'
+                body = None
+
+            if not self.logger is None:
+                self.logger.debug('following redirect (%s) to:%s' % (status,url))
+
+        return (status,response_headers,response)
+
+
+    def _request(self,url,headers,method,body):
+        """
+        Make a single request over a pooled connection
+        Returns (status code,response headers,response body)
+        """
+
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme,host,port)
+
+        # Honor a proxy from the environment as urllib does
+        proxy = urllib.getproxies().get(scheme)
+        if proxy and urllib.proxy_bypass(host):
+            proxy = None
+
+        path = urlparse.urlunsplit(('','',parts.path or '/',parts.query,''))
+        if proxy and scheme == 'http':
+            # A plain http proxy wants the absolute url
+            path = url
+
+        send = {'Accept-Encoding': 'gzip'}
+        if headers:
+            send.update(headers)
+
+        # A reused connection may have been closed by the server in the
+        # meantime, so retry once on a fresh connection in that case
+        while True:
+            (conn,reused) = self._get(key,proxy)
+
+            try:
+                conn.request(method,path,body,send)
+                r = conn.getresponse()
+                response = r.read()
+            except (httplib.HTTPException,socket.error) as e:
+                conn.close()
+                if reused:
+                    if not self.logger is None:
+                        self.logger.debug('stale connection to %s:%s, reconnecting (%s)' % (host,port,e))
+                    continue
+                raise
+
+            break
+
+        encoding = r.getheader('content-encoding','')
+        if encoding.lower() == 'gzip':
+            response = zlib.decompress(response,16 + zlib.MAX_WBITS)
+
+        if r.will_close:
+            conn.close()
+        else:
+            self._put(key,conn)
+
+        return (r.status,dict(r.getheaders()),response)
+
+
+    def _get(self,key,proxy):
+        """
+        Return (connection,reused) for a host, evicting idle connections
+        """
+
+        now = time.time()
+
+        with self.lock:
+            idle = self.connections.get(key,[])
+
+            # Keep only the connections that have not been idle too long
+            fresh = []
+            for (conn,last_used) in idle:
+                if now - last_used > self.idle:
+                    conn.close()
+                else:
+                    fresh.append((conn,last_used))
+            self.connections[key] = fresh
+
+            if fresh:
+                (conn,last_used) = fresh.pop()
+                return (conn,True)
+
+        (scheme,host,port) = key
+
+        if not self.logger is None:
+            self.logger.debug('opening new connection to %s://%s:%s' % (scheme,host,port))
+
+        if proxy:
+            p = urlparse.urlsplit(proxy)
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(p.hostname,p.port or 80,timeout=self.timeout)
+                conn.set_tunnel(host,port)
+            else:
+                conn = httplib.HTTPConnection(p.hostname,p.port or 80,timeout=self.timeout)
+        elif scheme == 'https':
+            conn = httplib.HTTPSConnection(host,port,timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host,port,timeout=self.timeout)
+
+        return (conn,False)
+
+
+    def _put(self,key,conn):
+        """
+        Return a connection to the pool (or close it if the pool is full)
+        """
+
+        with self.lock:
+            idle = self.connections.setdefault(key,[])
+            if len(idle) < self.size:
+                idle.append((conn,time.time()))
+                return
+
+        conn.close()
+
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+
+        with self.lock:
+            for key in self.connections:
+                for (conn,last_used) in self.connections[key]:
+                    conn.close()
+            self.connections = {}
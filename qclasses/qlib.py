@@ -21,6 +21,14 @@
     2. An instance of qsql
     3. An instance of qemail
 
+   Optional:
+    1. An instance of qquota, shared by every thread in a job, so that
+       API calls and errors are counted in memory rather than in the
+       database on every request
+    2. An instance of qhttp.pool for web queries (the process-wide pool
+       is used if one is not provided)
+    3. The number of times a failed web query is retried (see qretry for
+       the backoff and the per-API circuit breaker)
 """
 
 import os
@@ -31,12 +39,16 @@ import urllib
 import urllib2
 import uuid
 
+from qclasses import qhttp
+from qclasses import qretry
+from qclasses import qsql
+
 
 class lib:
 
     Name = "qlib"
 
-    def __init__(self, qs, qm, notify_error, logger):
+    def __init__(self, qs, qm, notify_error, logger, quota=None, http=None, retries=3):
         """
         Constructor
         """
@@ -45,6 +57,16 @@ class lib:
         self.qs = qs
         self.notify_error = notify_error
         self.logger = logger
+        self.quota = quota
+        self.retries = retries
+
+        # Web queries share persistent connections across all threads
+        if http is None:
+            http = qhttp.shared(logger)
+        self.http = http
+
+        # The configuration parameters, loaded the first time one is needed
+        self.configs = None
 
 
     def return_config(self,option):
@@ -54,22 +76,42 @@ class lib:
 
         self.logger.info('Looking for option: %s' % option)
 
+        # Load all of the parameters at once, a job reads several of them
+        if self.configs is None:
+            sql = """
+                   SELECT config_name,config_value
+                   FROM main_config"""
+
+            (rowcount,rows) = self.qs.execute(sql)
+            if self.qs.status != 0:
+                if self.notify_error:
+                    self.qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,self.qs.emessage))
+                return
+
+            self.configs = dict(rows)
+
+        return self.configs.get(option)
+
+
+    def bump_data_version(self,job):
+        """
+        Record that a data job has saved new data so that cached reports
+        of the old data are no longer used
+        """
+
+        self.logger.info('Updating the data version of %s' % job)
+
         # Create SQL statement
         sql = """
-               SELECT config_value
-               FROM main_config
-               WHERE config_name=%s"""
+               UPDATE main_data_job
+               SET data_version=data_version+1
+               WHERE job_name=%s"""
 
-        (rowcount,rows) = self.qs.execute(sql,(option))
+        self.qs.execute(sql,(job,))
         if self.qs.status != 0:
             if self.notify_error:
                 self.qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,self.qs.emessage))
 
-        if rowcount == 0:
-           return
-        else:
-           return rows[0][0]
-
 
     def remove_data(self,table,d=None):
         """
@@ -96,6 +138,10 @@ class lib:
         Count the number of API calls or errors for today
         """
 
+        # Use the in-memory counters, if we have them
+        if not self.quota is None:
+            return self.quota.count(table,error)
+
         # Counting errors
         if error == 1:
             self.logger.info('Counting current API errors for %s for today' % table)
@@ -126,6 +172,11 @@ class lib:
         Add the count of API calls or errors for today
         """
 
+        # Use the in-memory counters, if we have them
+        if not self.quota is None:
+            self.quota.add(table,count,error)
+            return count
+
         self.logger.info('Updating API calls/errors for today for %s with %i additional call/error(s)' % (table,count))
 
         # Counting errors
@@ -152,6 +203,24 @@ class lib:
         return rowcount
 
 
+    def reserve_api_call(self,table,limit):
+        """
+        Count one API call for today, but only if doing so will not exceed
+        the limit.  Returns True if the call may be made
+        """
+
+        # The in-memory counters can check and add atomically
+        if not self.quota is None:
+            return self.quota.reserve(table,limit)
+
+        current_api_calls = self.count_api_calls(table)
+        if current_api_calls == 'error' or current_api_calls >= limit:
+            return False
+
+        self.add_api_calls(table,1)
+        return True
+
+
     def terminate(self):
         """
         Exit program execution, in error
@@ -162,6 +231,10 @@ class lib:
 
         self.logger.error('Terminating program execution - check Quinico log for details')
 
+        # Save any API calls/errors that have not been written yet
+        if not self.quota is None:
+            self.quota.close()
+
         # Disconnect from the DB server
         self.qs.close()
         exit(2)
@@ -253,89 +326,192 @@ class lib:
         time.sleep(pause_time)
 
 
+    def init_sql_stats(self):
+        """
+        Apply the slow SQL statement threshold from the configuration
+        """
+
+        slow = self.return_config('sql_slow_query')
+        if slow is None:
+            return
+
+        self.logger.info('SQL slow query threshold = %s' % slow)
+        qsql.shared_stats(self.logger).slow = float(slow)
+
 
-    def http_request1(self,api,url,count=None):
+    def report_sql_stats(self):
         """
-        Make a web query with urllib
+        Log a summary of the SQL statement timings and email it, if
+        configured to do so
         """
 
-        self.logger.info('requesting URL:%s' % url)
+        summary = qsql.shared_stats(self.logger).summary()
+        self.logger.info('SQL statement timings:\n%s' % summary)
 
-        # Count the API call, if requested to do so
-        if count:
-            self.add_api_calls(api,1)
+        sql_stats_email = self.return_config('sql_stats_email')
+        if sql_stats_email and int(sql_stats_email):
+            self.qm.send('SQL Statement Timings',summary)
+
+
+
+    def set_interval(self,api,interval):
+        """
+        Set the minimum number of seconds between two requests to an API
+        (for APIs that limit the request rate, 0 for none)
+        """
+
+        qretry.shared(api,self.logger).interval = interval
+
+
+    def http_fetch(self,api,url,headers=None,count=None,method='GET',body=None,limit=None):
+        """
+        Make a web query over a pooled connection, retrying failures
+        Returns (status code,response), or (None,error) if there was no
+        response - the error is None if the API's circuit breaker is open
+        or the limit has been reached.
+
+        Connection errors, 429 and 5xx responses are retried with a
+        jittered exponential backoff (or after the Retry-After delay) and
+        count towards opening the API's circuit breaker.
+
+        For APIs billed per call, limit is the number of calls allowed
+        today: every attempt, retries included, reserves a call and no
+        more attempts are made once the limit is reached.
+        """
+
+        breaker = qretry.shared(api,self.logger)
+
+        for attempt in range(self.retries + 1):
+            if not breaker.allow():
+                self.logger.error('%s API circuit is open, not requesting url:%s' % (api,url))
+                return (None,None)
+
+            # Reserve the call, retries cost as much as the first attempt
+            if not limit is None and not self.reserve_api_call(api,limit):
+                self.logger.info('%s API calls are maxed out for today, not requesting url:%s' % (api,url))
+                if attempt == 0:
+                    return (None,None)
+                break
+
+            breaker.space()
+
+            # Count the API call, if requested to do so
+            if count:
+                self.add_api_calls(api,1)
+
+            wait = None
+            try:
+                (code,response_headers,response) = self.http.fetch(url,headers,method,body)
+            except Exception as e:
+                code = None
+                error = e
+                self.logger.error('Error encountered requesting url (%s):%s' % (url,e))
+            else:
+                if code != 429 and code < 500:
+                    breaker.success()
+                    return (code,response)
+
+                error = 'bad response code (%s) with response:%s' % (code,response)
+                wait = qretry.retry_after(response_headers.get('retry-after'))
+                self.logger.error('bad response code (%s) accessing url:%s with response:%s' % (code,url,response))
 
-        try:
-            request = urllib.urlopen(url)
-        except Exception as e:
             # Count the error
             self.add_api_calls(api,1,1)
 
-            if self.notify_error:
-                self.qm.send('Error','Error encountered requesting url:%s\n%s' % (url,e))
+            # Being rate limited does not mean the API is down
+            if code == 429:
+                breaker.limited(wait)
+            else:
+                cooldown = breaker.failure()
+                if not cooldown is None and self.notify_error:
+                    self.qm.send('Error','%s API failed %s times in a row, not sending it requests for %s seconds.\nLast error:\n%s' % (api,breaker.threshold,cooldown,error))
 
-            self.logger.error('Error encountered requesting url (%s):%s' % (url,e))
+            if attempt == self.retries:
+                break
 
-            return
+            if wait is None:
+                wait = qretry.backoff(attempt)
+            self.logger.info('retrying url:%s in %.1f seconds (retry %s of %s)' % (url,wait,attempt + 1,self.retries))
+            time.sleep(wait)
 
-        response = request.read()
-        request.close()
+        if code is None:
+            return (None,error)
 
-        # Do some checking on the request
-        if request.getcode() != 200:
-            # Count the error (assume anything other than 200 is an error)
-            self.add_api_calls(api,1,1)
+        return (code,response)
+
+
+    def http_request1(self,api,url,count=None,limit=None):
+        """
+        Make a web query over a pooled connection
+        (see http_fetch for limit)
+        """
+
+        self.logger.info('requesting URL:%s' % url)
+
+        # Quote the url the same way urllib.urlopen does
+        (code,response) = self.http_fetch(api,urllib.quote(url,safe="%/:=&?~#+!$,;'@()*[]|"),None,count,limit=limit)
 
+        if code is None:
+            if self.notify_error and not response is None:
+                self.qm.send('Error','Error encountered requesting url:%s\n%s' % (url,response))
+            return
+
+        # Do some checking on the request
+        if code != 200:
+            # Anything other than 200 is an error
             if self.notify_error:
-                self.qm.send('Error','bad response code (%s) accessing url:%s with response:%s' % (request.getcode(),url,response))
-            self.logger.error('bad response code (%s) accessing url:%s with response:%s' % (request.getcode(),url,response))
+                self.qm.send('Error','bad response code (%s) accessing url:%s with response:%s' % (code,url,response))
+            if code < 500 and code != 429:
+                self.add_api_calls(api,1,1)
+                self.logger.error('bad response code (%s) accessing url:%s with response:%s' % (code,url,response))
             return
         else:
-            self.logger.debug('response code: %s' % request.getcode())
+            self.logger.debug('response code: %s' % code)
 
         return response
 
 
-    def http_request2(self,api,url,headers=None,csv=None,count=None):
+    def http_request2(self,api,url,headers=None,csv=None,count=None,body=None):
         """
-        Make a web query with urllib2
+        Make a web query, with optional headers, over a pooled connection
+        The query is a POST if there is a body
+        Any non-2xx response is treated as an error
         """
 
         self.logger.debug('requesting URL:%s' % url)
 
-        # Count the API call, if requested to do so
-        if count:
-            self.add_api_calls(api,1)
-
-        r = urllib2.Request(url)
-
         # If there are headers, add them
         if headers:
             for header in headers:
                 self.logger.debug('adding header: %s => %s' % (header,headers[header]))
-                r.add_header(header,headers[header])
 
-        try:
-            request = urllib2.urlopen(r)
-        # With urllib2, almost anything is an exception (including most non-200 responses)
-        except Exception as e:
-            # Count the error
-            self.add_api_calls(api,1,1)
+        if body is None:
+            (code,response) = self.http_fetch(api,url,headers,count)
+        else:
+            (code,response) = self.http_fetch(api,url,headers,count,'POST',body)
+
+        if code is None:
+            if self.notify_error and not response is None:
+                self.qm.send('Error','Error encountered requesting url:%s\n%s' % (url,response))
+            return
+
+        if code < 200 or code >= 300:
+            e = urllib2.HTTPError(url,code,'bad response code (%s) with response:%s' % (code,response),None,None)
+
+            if code < 500 and code != 429:
+                # Count the error (server errors were counted when they were retried)
+                self.add_api_calls(api,1,1)
+                self.logger.error('Error encountered requesting url (%s):%s' % (url,e))
 
             if self.notify_error:
                 self.qm.send('Error','Error encountered requesting url:%s\n%s' % (url,e))
 
-            self.logger.error('Error encountered requesting url (%s):%s' % (url,e))
-
             return
 
         if csv:
             self.logger.debug('splitting http response on newlines as requested')
-            response = request.read().split('\n')
-        else:
-            response = request.read()
+            response = response.split('\n')
 
-        request.close()
         return response
 
 
@@ -0,0 +1,290 @@
+#
+# Copyright 2013 - Tom Alessi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""API quota accounting class for Quinico
+
+   API calls and errors are counted in memory and periodically written
+   to the <api>_api_calls and <api>_api_errors tables.  A single instance
+   is meant to be shared by every thread in a job.
+
+   When other processes (e.g. on other hosts sharing a work queue) make
+   calls to the same API, the quota is shared: reserved calls are counted
+   in the database right away, so that the limit holds across processes.
+
+   Requirements:
+    1. An instance of qsql that is dedicated to this class
+    2. An instance of qemail
+
+   Optional:
+    1. Logging is optional - provide a properly configured instance of
+       a logger if desired.
+"""
+
+
+import datetime
+import threading
+import time
+
+
+class quota:
+
+    Name = "quota"
+
+
+    def __init__(self, qs, qm, notify_error, logger=None, interval=60, shared=False):
+        """
+        Constructor
+
+        interval is the number of seconds between flushes to the database
+        and shared is whether other processes use the same quota (it can
+        also be set later)
+        """
+
+        self.qs = qs
+        self.qm = qm
+        self.notify_error = notify_error
+        self.logger = logger
+        self.interval = interval
+        self.shared = shared
+
+        # Protects all counters and the sql connection
+        self.lock = threading.Lock()
+
+        # The date that the counters apply to
+        self.day = datetime.date.today()
+
+        # Counts for today (as loaded from the database plus anything added since)
+        self.totals = {}
+
+        # Counts that have not yet been written to the database
+        self.pending = {}
+
+        self.last_flush = time.time()
+
+
+    def _table(self,api,error):
+        """
+        Return the table name for an api
+        """
+
+        if error == 1:
+            return api + '_api_errors'
+        else:
+            return api + '_api_calls'
+
+
+    def _rollover(self):
+        """
+        Start new counters if the date has changed
+        The lock must be held by the caller
+        """
+
+        today = datetime.date.today()
+        if today != self.day:
+            if not self.logger is None:
+                self.logger.info('Date changed to %s, resetting API counters' % today)
+            self._flush()
+            self.day = today
+            self.totals = {}
+
+
+    def _load(self,table):
+        """
+        Load the count for today from the database
+        The lock must be held by the caller
+        """
+
+        sql = 'SELECT count FROM ' + table + ' WHERE call_date=%s'
+
+        (rowcount,rows) = self.qs.execute(sql,(self.day))
+        if self.qs.status != 0:
+            if self.notify_error:
+                self.qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,self.qs.emessage))
+            count = 0
+        elif rowcount == 0:
+            count = 0
+        else:
+            count = int(rows[0][0])
+
+        if not self.logger is None:
+            self.logger.info('Loaded %i API calls/errors for %s for today' % (count,table))
+
+        self.totals[table] = count
+
+
+    def _add(self,table,count):
+        """
+        Add to a counter
+        The lock must be held by the caller
+        """
+
+        if not table in self.totals:
+            self._load(table)
+
+        self.totals[table] += count
+        self.pending[table] = self.pending.get(table,0) + count
+
+
+    def count(self,api,error=None):
+        """
+        Return the number of API calls or errors for today
+        """
+
+        table = self._table(api,error)
+
+        with self.lock:
+            self._rollover()
+
+            if not table in self.totals:
+                self._load(table)
+
+            return self.totals[table]
+
+
+    def add(self,api,count,error=None):
+        """
+        Add API calls or errors for today
+        """
+
+        table = self._table(api,error)
+
+        with self.lock:
+            self._rollover()
+            self._add(table,count)
+
+            if time.time() - self.last_flush >= self.interval:
+                self._flush()
+
+
+    def reserve(self,api,limit):
+        """
+        Count a single API call if doing so will not exceed the limit
+        Returns True if the call may proceed
+        """
+
+        table = self._table(api,None)
+
+        with self.lock:
+            self._rollover()
+
+            if self.shared:
+                return self._reserve_shared(table,limit)
+
+            if not table in self.totals:
+                self._load(table)
+
+            if self.totals[table] >= limit:
+                return False
+
+            self._add(table,1)
+
+            if time.time() - self.last_flush >= self.interval:
+                self._flush()
+
+            return True
+
+
+    def _reserve_shared(self,table,limit):
+        """
+        Count a single API call in the database if doing so will not
+        exceed the limit, checking and adding in one statement so that
+        processes sharing the quota cannot exceed it together
+        The lock must be held by the caller
+        """
+
+        sql = 'UPDATE ' + table + ' SET count = count + 1 WHERE call_date=%s AND count + 1 <= %s'
+
+        for attempt in range(2):
+            (rowcount,rows) = self.qs.execute(sql,(self.day,limit))
+            if self.qs.status != 0:
+                if self.notify_error:
+                    self.qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,self.qs.emessage))
+                return False
+
+            if rowcount == 1:
+                self.totals[table] = self.totals.get(table,0) + 1
+                return True
+
+            # Either the limit was reached or there is no row for today yet
+            self._flush()
+            self._load(table)
+            if self.totals[table] >= limit or attempt == 1:
+                return False
+
+            insert = 'INSERT IGNORE INTO ' + table + ' (call_date,count) VALUES (%s,0)'
+            self.qs.execute(insert,(self.day,))
+            if self.qs.status != 0:
+                if self.notify_error:
+                    self.qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (insert,self.qs.emessage))
+                return False
+
+        return False
+
+
+    def _flush(self):
+        """
+        Write pending counts to the database
+        The lock must be held by the caller
+        """
+
+        self.last_flush = time.time()
+
+        for table in self.pending.keys():
+            count = self.pending[table]
+            if count == 0:
+                continue
+
+            if not self.logger is None:
+                self.logger.info('Updating API calls/errors for %s for %s with %i additional call/error(s)' % (self.day,table,count))
+
+            # Either add a new row for this date or update an existing date
+            sql  = 'INSERT INTO ' + table + ' (call_date,count)'
+            sql += 'VALUES (%s,%s)'
+            sql += 'ON DUPLICATE KEY UPDATE count = count + %s'
+
+            self.qs.execute(sql,(self.day,str(count),str(count)))
+            if self.qs.status != 0:
+                if self.notify_error:
+                    self.qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,self.qs.emessage))
+
+                # Keep the count and try again on the next flush
+                continue
+
+            del self.pending[table]
+
+        # Other processes add to the counts too
+        if self.shared:
+            for table in self.totals.keys():
+                self._load(table)
+
+
+    def flush(self):
+        """
+        Write pending counts to the database
+        """
+
+        with self.lock:
+            self._flush()
+
+
+    def close(self):
+        """
+        Write pending counts and close the database connection
+        """
+
+        with self.lock:
+            self._flush()
+            self.qs.close()
@@ -0,0 +1,227 @@
+#
+# Copyright 2013 - Tom Alessi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Retry policy and circuit breaker class for Quinico
+
+   Failed API requests are retried after a jittered, exponentially
+   growing delay (or the delay the API asks for with Retry-After).  Each
+   API has a circuit breaker, shared by every thread in a process: once an
+   API has failed a number of times in a row, requests to it fail right
+   away until a cool down period has passed, after which a single request
+   is let through to see if the API has recovered.
+
+   Functions:
+    - shared: return the process-wide breaker for an API
+    - backoff: return the delay before a retry
+    - retry_after: parse a Retry-After header
+
+   Optional:
+    - Logging is optional - provide a properly configured instance of
+      a logger if desired.
+"""
+
+
+import email.utils
+import random
+import threading
+import time
+
+
+# Process-wide breakers returned by shared(), keyed by API
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared(api, logger=None):
+    """
+    Return the process-wide breaker for an API, creating it if needed
+    """
+
+    with _shared_lock:
+        if not api in _shared:
+            _shared[api] = breaker(api,logger=logger)
+
+    return _shared[api]
+
+
+def backoff(attempt, base=1, cap=60):
+    """
+    Return the number of seconds to wait before retry number attempt
+    (starting at 0): a random delay of up to base * 2^attempt seconds,
+    but never more than cap
+    """
+
+    return random.uniform(0,min(cap,base * 2 ** attempt))
+
+
+def retry_after(value, cap=300):
+    """
+    Return the number of seconds asked for by a Retry-After header (either
+    seconds or an HTTP date), at most cap, or None if there is none
+    """
+
+    if not value:
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return min(int(value),cap)
+
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+
+    return min(max(email.utils.mktime_tz(date) - time.time(),0),cap)
+
+
+class breaker:
+
+    Name = "breaker"
+
+
+    def __init__(self, api, threshold=5, cooldown=60, max_cooldown=900, interval=0, logger=None):
+        """
+        Constructor
+
+        The breaker opens after threshold failures in a row and stays open
+        for cooldown seconds, doubling (up to max_cooldown) each time the
+        request let through after a cool down fails too.  interval is the
+        minimum number of seconds between the start of two requests (for
+        APIs that limit the request rate).
+        """
+
+        self.api = api
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.interval = interval
+        self.logger = logger
+
+        self.lock = threading.Lock()
+
+        # Failures in a row
+        self.failures = 0
+
+        # While open, requests fail until this time
+        self.open_until = 0
+        self.current_cooldown = cooldown
+
+        # Whether a request has been let through to test the API
+        self.probing = False
+
+        # When the next request may start (see interval)
+        self.next_request = 0
+
+
+    def allow(self):
+        """
+        Return True if a request may be made to the API
+        """
+
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+
+            # Open - after the cool down let one request through
+            if time.time() >= self.open_until and not self.probing:
+                self.probing = True
+                if not self.logger is None:
+                    self.logger.info('%s API circuit half open, testing the API' % self.api)
+                return True
+
+            return False
+
+
+    def space(self):
+        """
+        Wait until the next request may start, if the API limits the
+        request rate
+        """
+
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            start = max(now,self.next_request)
+            self.next_request = start + self.interval
+
+        if start > now:
+            if not self.logger is None:
+                self.logger.debug('spacing %s API requests, waiting %.1f seconds' % (self.api,start - now))
+            time.sleep(start - now)
+
+
+    def success(self):
+        """
+        Record a successful request
+        """
+
+        with self.lock:
+            if self.failures >= self.threshold and not self.logger is None:
+                self.logger.info('%s API circuit closed, the API has recovered' % self.api)
+
+            self.failures = 0
+            self.probing = False
+            self.current_cooldown = self.cooldown
+
+
+    def limited(self, delay=None):
+        """
+        Record a rate limited (429) request
+        Being rate limited does not mean the API is down, so it does not
+        count as a failure, but a request let through after a cool down
+        ends without knowing if the API has recovered: the breaker stays
+        open for another cool down (or delay seconds, if longer) before
+        letting the next one through.
+        """
+
+        with self.lock:
+            if not self.probing:
+                return
+
+            self.probing = False
+            self.open_until = time.time() + max(self.current_cooldown,delay or 0)
+            if not self.logger is None:
+                self.logger.info('%s API is rate limiting requests, circuit open until the next test' % self.api)
+
+
+    def failure(self):
+        """
+        Record a failed request
+        Returns the cool down (seconds) if this failure opened the breaker,
+        or None
+        """
+
+        with self.lock:
+            if self.probing:
+                # The API has not recovered yet, wait longer this time
+                self.probing = False
+                self.current_cooldown = min(self.current_cooldown * 2,self.max_cooldown)
+                self.open_until = time.time() + self.current_cooldown
+                if not self.logger is None:
+                    self.logger.error('%s API is still failing, circuit open for %s seconds' % (self.api,self.current_cooldown))
+                return None
+
+            self.failures += 1
+            if self.failures != self.threshold:
+                return None
+
+            self.open_until = time.time() + self.current_cooldown
+            if not self.logger is None:
+                self.logger.error('%s API failed %s times in a row, circuit open for %s seconds' % (self.api,self.failures,self.current_cooldown))
+
+            return self.current_cooldown
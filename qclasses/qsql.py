@@ -16,23 +16,130 @@
 
 """SQL connection management class for Quinico
 
+   Classes:
+    - sql: a single MySQL connection (statements are serialized so an
+      instance can be shared by several threads, each of which sees the
+      status of its own statements)
+    - pool: a bounded, thread-safe pool of sql connections with health
+      checks
+    - bulk: a buffered, multi-row insert writer for a single table
+    - idmap: a thread-safe value -> id cache for a lookup table that
+      inserts missing values in bulk (optionally keyed on a SHA1 hash
+      column for long values such as urls)
+    - stats: per-statement timing statistics and slow statement logging
+
+   Functions:
+    - shared_stats: return the process-wide stats instance, which every
+      sql instance records into by default
+    - enable_pooling: make connect() hand out connections from process-wide
+      pools (for long running processes such as the job scheduler)
+    - connect: return a sql instance (pooled if pooling is enabled)
+    - release: return the pooled connections a thread still has checked out
+
    Optional:
     - Logging is optional - provide a properly configured instance of
       a logger if desired.
 """
 
 
+import bisect
+import contextlib
+import hashlib
+import re
+import threading
+import time
 import MySQLdb
+import MySQLdb.cursors
+
+
+# Process-wide statistics returned by shared_stats()
+_shared_stats = None
+_shared_stats_lock = threading.Lock()
+
+
+def shared_stats(logger=None):
+    """
+    Return the process-wide stats instance, creating it if needed
+    """
+
+    global _shared_stats
+
+    with _shared_stats_lock:
+        if _shared_stats is None:
+            _shared_stats = stats(logger=logger)
+
+    return _shared_stats
+
+
+# Process-wide pools used by connect(), keyed by (host,username,database)
+_pools = {}
+_pools_lock = threading.Lock()
+_pooling = None
+
+
+def enable_pooling(size=200, keep=10):
+    """
+    Make connect() check connections out of process-wide pools
+    (see pool for size and keep)
+    """
+
+    global _pooling
+
+    _pooling = (size,keep)
+
+
+def connect(host, username, password, database, logger=None):
+    """
+    Return a sql instance - a pooled one if pooling is enabled, in which
+    case closing it returns it to the pool instead of disconnecting
+    """
+
+    if _pooling is None:
+        return sql(host,username,password,database,logger)
+
+    key = (host,username,database)
+
+    with _pools_lock:
+        if not key in _pools:
+            (size,keep) = _pooling
+            _pools[key] = pool(host,username,password,database,size=size,keep=keep,logger=logger)
+
+    return _pools[key].get()
+
+
+def release(thread=None):
+    """
+    Return every pooled connection still checked out by a thread (the
+    calling thread by default) to its pool, e.g. after a job that exited
+    without closing them.  Returns the number of connections returned.
+    """
+
+    if thread is None:
+        thread = threading.current_thread()
 
+    with _pools_lock:
+        pools = _pools.values()
 
-class sql:
+    return sum([p.release(thread) for p in pools])
+
+
+class sql(object):
 
     Name = "sql"
 
+    # MySQL client errors that mean the connection to the server was lost
+    LOST = (2006,2013,2055)
+
+    # Statements that are safe to run again after reconnecting
+    IDEMPOTENT = ('SELECT','SHOW','DESCRIBE','EXPLAIN')
 
-    def __init__(self, host, username, password, database, logger=None):
+
+    def __init__(self, host, username, password, database, logger=None, stats=None):
         """
         Constructor
+
+        Statement timings are recorded in stats (the process-wide instance
+        if one is not provided)
         """
 
         self.host = host
@@ -40,65 +147,335 @@ class sql:
         self.password = password
         self.database = database
         self.logger = logger
+
+        # The status of the last statement run by each thread
+        self.result = threading.local()
         self.status = 0
         self.emessage = ''
 
+        if stats is None:
+            stats = shared_stats(logger)
+        self.stats = stats
+
+        # Serializes statements from threads sharing this connection
+        # A transaction holds it from begin until commit or rollback
+        self.lock = threading.RLock()
+
+        # Statements executed on this connection
+        self.statements = 0
+
+        # Whether a transaction is in progress (no reconnecting then)
+        self.transaction = False
+
+        # The pool this connection belongs to, whether it is checked out
+        # (close returns it to the pool) and the thread that checked it out
+        self.pool = None
+        self.checked_out = False
+        self.owner = None
+
+        self.db = None
+        self.cursor = None
+
         if not self.logger is None:
             self.logger.info('Connecting to sql server: %s, database: %s' % (host,database))
 
+        self.connect()
+
+        # See if we are working
+        if self.status == 0 and not self.logger is None:
+            self.logger.debug('MySQL Status: %s' % self.db.stat())
+
+
+    def _get_status(self):
+        return getattr(self.result,'status',0)
+
+    def _set_status(self,status):
+        self.result.status = status
+
+    # 0 if the last statement of the calling thread succeeded, 1 if not
+    status = property(_get_status,_set_status)
+
+
+    def _get_emessage(self):
+        return getattr(self.result,'emessage','')
+
+    def _set_emessage(self,emessage):
+        self.result.emessage = emessage
+
+    # The error of the last statement of the calling thread
+    emessage = property(_get_emessage,_set_emessage)
+
+
+    def connect(self):
+        """
+        Connect (or reconnect) to the database server
+        """
+
+        # Reset status to normal
+        self.status = 0
+        self.emessage = ''
+
+        # Drop any previous connection
+        if not self.db is None:
+            try:
+                self.db.close()
+            except MySQLdb.Error:
+                pass
+            self.db = None
+            self.cursor = None
+
         try:
             # Connect
-            self.db = MySQLdb.connect(host=host,user=username,passwd=password,db=database,charset='utf8',use_unicode=True)
+            self.db = MySQLdb.connect(host=self.host,user=self.username,passwd=self.password,db=self.database,charset='utf8',use_unicode=True)
 
             # Commit everything without needing to specify it
             self.db.autocommit(True)
+
+            # Prepare the cursor
+            self.cursor = self.db.cursor()
         except MySQLdb.Error as e:
            if not self.logger is None:
                self.logger.error('Error connecting to MySQL: %s' % e)
-               self.status = 1
-               self.emessage = e
-               return
+           self.status = 1
+           self.emessage = e
+           self.db = None
 
-        # Prepare the cursor
-        self.cursor = self.db.cursor()
 
-        # See if we are working
-        if not self.logger is None:
-            self.logger.debug('MySQL Status: %s' % self.db.stat())
+    def ping(self):
+        """
+        Check that the connection is usable, reconnecting if it is not
+        Returns True if the connection is usable
+        """
+
+        with self.lock:
+            # Reset status to normal
+            self.status = 0
+            self.emessage = ''
+
+            if not self.db is None:
+                try:
+                    self.db.ping()
+                    return True
+                except MySQLdb.Error as e:
+                    if not self.logger is None:
+                        self.logger.warning('MySQL connection failed health check, reconnecting: %s' % e)
+
+            self.connect()
+
+            return self.status == 0
 
 
     def execute(self,sql,tup=None):
         """
         Execute SQL
+        If the connection to the server was lost, reconnect and, for statements
+        that are safe to repeat, retry once
         """
 
-        # Reset status to normal
-        self.status = 0
-        self.emessage = ''
-
         if not self.logger is None:
            self.logger.debug('Executing sql: %s' % sql)
 
+        with self.lock:
+            # Reset status to normal
+            self.status = 0
+            self.emessage = ''
+
+            start = time.time()
+            try:
+                return self._execute(sql,tup)
+            except MySQLdb.OperationalError as e:
+                if not e.args[0] in self.LOST or self.transaction:
+                    return self._error(e)
+
+                # The server dropped us (e.g. wait_timeout during a long API wait)
+                if not self.logger is None:
+                    self.logger.warning('Lost connection to MySQL, reconnecting: %s' % e)
+
+                self.connect()
+                if self.status != 0:
+                    return (0,[])
+
+                if not sql.lstrip().split(None,1)[0].upper() in self.IDEMPOTENT:
+                    # It may have been applied before the connection dropped
+                    return self._error(e)
+
+                try:
+                    return self._execute(sql,tup)
+                except MySQLdb.Error as e:
+                    return self._error(e)
+            except MySQLdb.Error as e:
+                return self._error(e)
+            finally:
+                self.stats.record(sql,tup,time.time() - start)
+
+
+    def iterate(self,sql,tup=None,size=1000):
+        """
+        Execute SQL on a server-side cursor and yield the rows in batches of
+        at most size rows, so a large result is never held in memory at once
+
+        Other threads can not use the connection until the generator is
+        exhausted or closed.  The server gives up on the query if rows are
+        not read for net_write_timeout seconds, so don't do slow work (such
+        as API calls) between batches.  Check status afterwards, as with
+        execute.
+        """
+
+        if not self.logger is None:
+           self.logger.debug('Iterating sql: %s' % sql)
+
+        with self.lock:
+            # Reset status to normal
+            self.status = 0
+            self.emessage = ''
+
+            # Make sure the connection is still there before relying on it
+            if not self.transaction and not self.ping():
+                self._error(self.emessage)
+                return
+
+            cursor = None
+            rowcount = 0
+
+            # Time spent in the database (not in the caller between batches)
+            elapsed = 0.0
+            try:
+                start = time.time()
+                cursor = self.db.cursor(MySQLdb.cursors.SSCursor)
+
+                self.statements += 1
+
+                if tup is None:
+                    cursor.execute(sql)
+                else:
+                    cursor.execute(sql,tup)
+
+                while True:
+                    rows = cursor.fetchmany(size)
+                    elapsed += time.time() - start
+                    if not rows:
+                        break
+
+                    rowcount += len(rows)
+                    yield rows
+                    start = time.time()
+            except MySQLdb.Error as e:
+                elapsed += time.time() - start
+                self._error(e)
+            finally:
+                if not cursor is None:
+                    try:
+                        cursor.close()
+                    except MySQLdb.Error:
+                        pass
+
+                self.stats.record(sql,tup,elapsed)
+
+                if not self.logger is None:
+                    self.logger.debug('Rows read by SQL: %i' % rowcount)
+
+
+    def _execute(self,sql,tup):
+        """
+        Execute SQL and return (rowcount,rows)
+        The lock must be held by the caller
+        """
+
+        if self.cursor is None:
+            # Not connected (the connection failed earlier), try again
+            self.connect()
+            if self.status != 0:
+                raise MySQLdb.OperationalError(2006,'Not connected to MySQL: %s' % self.emessage)
+
+        self.statements += 1
+
+        if tup is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(sql,tup)
+
+        # How many rows affected
+        if not self.logger is None:
+            self.logger.debug('Rows affected by SQL: %i' % self.cursor.rowcount)
+
+        rowcount = self.cursor.rowcount
+        rows = self.cursor.fetchall()
+
+        return (rowcount,rows)
+
+
+    def _error(self,e):
+        """
+        Record a failed statement
+        """
+
+        if not self.logger is None:
+            self.logger.error('Error executing SQL: %s' % e)
+        self.status = 1
+        self.emessage = e
+
+        return (0,[])
+
+
+    def begin(self):
+        """
+        Start a transaction (autocommit is turned off until commit or rollback)
+        Other threads sharing this connection wait until the transaction ends
+        """
+
+        self.lock.acquire()
+
+        # Make sure the connection is still there before relying on it
+        if not self.ping():
+            if not self.logger is None:
+                self.logger.error('Error starting transaction: %s' % self.emessage)
+            self.lock.release()
+            return
+
         try:
-            if tup is None:
-                self.cursor.execute(sql)
-            else:
-                self.cursor.execute(sql,tup)
+            self.db.autocommit(False)
+            self.transaction = True
         except MySQLdb.Error as e:
            if not self.logger is None:
-               self.logger.error('Error executing SQL: %s' % e)
-               self.status = 1
-               self.emessage = e
-               return (0,[])
-        else:
-            # How many rows affected
-            if not self.logger is None:
-                self.logger.debug('Rows affected by SQL: %i' % self.cursor.rowcount)
+               self.logger.error('Error starting transaction: %s' % e)
+           self.status = 1
+           self.emessage = e
+           self.lock.release()
 
-            rowcount = self.cursor.rowcount
-            rows = self.cursor.fetchall()
-        
-            return (rowcount,rows)
+
+    def commit(self):
+        """
+        Commit a transaction and return to autocommit
+        """
+
+        try:
+            self.db.commit()
+            self.db.autocommit(True)
+        except MySQLdb.Error as e:
+           if not self.logger is None:
+               self.logger.error('Error committing transaction: %s' % e)
+           self.status = 1
+           self.emessage = e
+        finally:
+            self.transaction = False
+            self.lock.release()
+
+
+    def rollback(self):
+        """
+        Roll back a transaction and return to autocommit
+        The status of the statement that failed is preserved
+        """
+
+        try:
+            self.db.rollback()
+            self.db.autocommit(True)
+        except MySQLdb.Error as e:
+           if not self.logger is None:
+               self.logger.error('Error rolling back transaction: %s' % e)
+        finally:
+            self.transaction = False
+            self.lock.release()
 
 
     def close_cursor(self):
@@ -120,8 +497,17 @@ class sql:
         self.status = 0
         self.emessage = ''
 
+        # A pooled connection is returned to its pool and stays connected
+        if not self.pool is None:
+            if self.checked_out:
+                self.pool.put(self)
+            return
+
         if not self.logger is None:
-            self.logger.info('Closing MySQL connection')
+            self.logger.info('Closing MySQL connection (%i statements executed)' % self.statements)
+
+        if self.db is None:
+            return
 
         try:
             self.cursor.close()
@@ -129,3 +515,571 @@ class sql:
         except MySQLdb.Error as e:
            if not self.logger is None:
                self.logger.error('Error closing connection: %s' % e)
+
+        self.db = None
+        self.cursor = None
+
+
+class pool:
+
+    Name = "pool"
+
+
+    def __init__(self, host, username, password, database, size=5, check=60, keep=None, logger=None):
+        """
+        Constructor
+
+        At most size connections are checked out at once (get blocks until
+        one is returned) and at most keep (default size) idle connections
+        are kept open.  A connection that has been idle for more than
+        check seconds is health checked, and reconnected if needed, before
+        it is handed out again.  Closing a checked out connection returns
+        it to the pool.
+        """
+
+        self.host = host
+        self.username = username
+        self.password = password
+        self.database = database
+        self.size = size
+        self.check = check
+        self.keep = size if keep is None else keep
+        self.logger = logger
+
+        self.semaphore = threading.BoundedSemaphore(size)
+
+        # Connections that are not checked out: [(connection,last returned)]
+        self.idle = []
+
+        # Connections that are checked out
+        self.busy = set()
+        self.lock = threading.Lock()
+
+
+    def get(self):
+        """
+        Check out a connection (check its status as with any qsql instance)
+        """
+
+        self.semaphore.acquire()
+
+        with self.lock:
+            if self.idle:
+                (qs,last_used) = self.idle.pop()
+            else:
+                qs = None
+
+        if qs is None:
+            qs = sql(self.host,self.username,self.password,self.database,self.logger)
+        elif time.time() - last_used > self.check:
+            qs.ping()
+
+        qs.pool = self
+        qs.checked_out = True
+        qs.owner = threading.current_thread()
+
+        with self.lock:
+            self.busy.add(qs)
+
+        return qs
+
+
+    def put(self,qs):
+        """
+        Return a connection to the pool
+        """
+
+        qs.checked_out = False
+        qs.owner = None
+
+        with self.lock:
+            self.busy.discard(qs)
+
+            if qs.db is None:
+                # It never connected, so don't keep it around
+                extra = None
+            elif len(self.idle) >= self.keep:
+                extra = qs
+            else:
+                extra = None
+                self.idle.append((qs,time.time()))
+
+        self.semaphore.release()
+
+        # Disconnect anything beyond the idle connections we keep
+        if not extra is None:
+            extra.pool = None
+            extra.close()
+
+
+    def release(self,thread):
+        """
+        Return the connections checked out by a thread
+        Returns the number of connections returned
+        """
+
+        with self.lock:
+            held = [qs for qs in self.busy if qs.owner is thread]
+
+        for qs in held:
+            if not self.logger is None:
+                self.logger.warning('Returning a connection to %s left checked out by thread %s' % (self.database,thread.name))
+            qs.close()
+
+        return len(held)
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of a with block
+        """
+
+        qs = self.get()
+        try:
+            yield qs
+        finally:
+            self.put(qs)
+
+
+    def close(self):
+        """
+        Close all connections that are not checked out
+        """
+
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+
+        for (qs,last_used) in idle:
+            qs.pool = None
+            qs.close()
+
+
+class bulk:
+
+    Name = "bulk"
+
+
+    def __init__(self, qs, table, columns, values=None, size=500, interval=30, logger=None):
+        """
+        Constructor
+
+        Rows are buffered and written with multi-row INSERT statements, in
+        a single transaction, once there are size rows or interval seconds
+        have passed since the last write.  The table must be transactional
+        (InnoDB) for a batch that fails part way through to be rolled back.
+
+        values is the template for a single row and defaults to one %s per
+        column, e.g. '(DATE(NOW()),%s,%s)'
+        """
+
+        self.qs = qs
+        self.table = table
+        self.columns = columns
+        self.size = size
+        self.interval = interval
+        self.logger = logger
+        self.status = 0
+        self.emessage = ''
+
+        if values is None:
+            values = '(' + ','.join(['%s'] * len(columns)) + ')'
+        self.values = values
+
+        # The statement that was last executed (for error reporting)
+        self.sql = ''
+
+        self.rows = []
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+
+
+    def add(self,row):
+        """
+        Buffer a row, writing the buffer if it is full or old enough
+        Returns the number of rows written (0 if the row was only buffered)
+        """
+
+        with self.lock:
+            # Reset status to normal
+            self.status = 0
+            self.emessage = ''
+
+            self.rows.append(row)
+
+            if len(self.rows) >= self.size or time.time() - self.last_flush >= self.interval:
+                return self._flush()
+
+        return 0
+
+
+    def flush(self):
+        """
+        Write all buffered rows
+        """
+
+        with self.lock:
+            return self._flush()
+
+
+    def _flush(self):
+        """
+        Write all buffered rows in a single transaction
+        The lock must be held by the caller
+        """
+
+        # Reset status to normal
+        self.status = 0
+        self.emessage = ''
+
+        self.last_flush = time.time()
+
+        if not self.rows:
+            return 0
+
+        rows = self.rows
+        self.rows = []
+
+        if not self.logger is None:
+            self.logger.debug('Writing %i buffered rows to %s' % (len(rows),self.table))
+
+        self.qs.begin()
+        if self.qs.status != 0:
+            self.status = 1
+            self.emessage = self.qs.emessage
+
+            if not self.logger is None:
+                self.logger.error('Discarding %i rows for %s after error: %s' % (len(rows),self.table,self.emessage))
+
+            return 0
+
+        # Never put more than size rows into one statement
+        for i in range(0,len(rows),self.size):
+            chunk = rows[i:i + self.size]
+
+            self.sql = 'INSERT INTO %s (%s) VALUES %s' % (self.table,
+                                                        ','.join(self.columns),
+                                                        ','.join([self.values] * len(chunk)))
+
+            args = []
+            for row in chunk:
+                args.extend(row)
+
+            self.qs.execute(self.sql,args)
+            if self.qs.status != 0:
+                break
+
+        if self.qs.status != 0:
+            self.status = 1
+            self.emessage = self.qs.emessage
+            self.qs.rollback()
+
+            if not self.logger is None:
+                self.logger.error('Discarding %i rows for %s after error: %s' % (len(rows),self.table,self.emessage))
+
+            return 0
+
+        self.qs.commit()
+        if self.qs.status != 0:
+            self.status = 1
+            self.emessage = self.qs.emessage
+            return 0
+
+        return len(rows)
+
+
+class idmap:
+
+    Name = "idmap"
+
+
+    def __init__(self, qs, table, column, logger=None, size=500, hash_column=None):
+        """
+        Constructor
+
+        The qsql instance should be dedicated to this class as it is
+        meant to be shared by all threads
+
+        If hash_column is given, it must hold the SHA1 hex digest of column
+        and have a unique index.  Lookups are then done on the hash and new
+        values are added with INSERT IGNORE so concurrent writers are safe.
+        """
+
+        self.qs = qs
+        self.table = table
+        self.column = column
+        self.logger = logger
+        self.size = size
+        self.hash_column = hash_column
+        self.status = 0
+        self.emessage = ''
+
+        # The statement that was last executed (for error reporting)
+        self.sql = ''
+
+        self.ids = {}
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        """
+        Load every row of the table into the cache
+        """
+
+        with self.lock:
+            # Reset status to normal
+            self.status = 0
+            self.emessage = ''
+
+            self.sql = 'SELECT %s,id FROM %s' % (self.column,self.table)
+
+            (rowcount,rows) = self.qs.execute(self.sql)
+            if self.qs.status != 0:
+                self.status = 1
+                self.emessage = self.qs.emessage
+                return
+
+            for row in rows:
+                self.ids[row[0]] = row[1]
+
+            if not self.logger is None:
+                self.logger.info('Loaded %i ids from %s' % (len(self.ids),self.table))
+
+
+    def get_ids(self,values):
+        """
+        Return a dictionary of value -> id for the given values, adding
+        any values that are not yet in the table
+        """
+
+        with self.lock:
+            # Reset status to normal
+            self.status = 0
+            self.emessage = ''
+
+            missing = [v for v in set(values) if not v in self.ids]
+
+            if missing:
+                # Some may have been added since we last looked
+                self._select(missing)
+
+                missing = [v for v in missing if not v in self.ids]
+                if missing and self.status == 0:
+                    if not self.logger is None:
+                        self.logger.info('Adding %i new values to %s' % (len(missing),self.table))
+
+                    for i in range(0,len(missing),self.size):
+                        chunk = missing[i:i + self.size]
+
+                        if self.hash_column is None:
+                            self.sql = 'INSERT INTO %s (%s) VALUES %s' % (self.table,
+                                                                        self.column,
+                                                                        ','.join(['(%s)'] * len(chunk)))
+                            args = chunk
+                        else:
+                            self.sql = 'INSERT IGNORE INTO %s (%s,%s) VALUES %s' % (self.table,
+                                                                                  self.column,
+                                                                                  self.hash_column,
+                                                                                  ','.join(['(%s,%s)'] * len(chunk)))
+                            args = []
+                            for v in chunk:
+                                args.extend((v,self._hash(v)))
+
+                        self.qs.execute(self.sql,args)
+                        if self.qs.status != 0:
+                            self.status = 1
+                            self.emessage = self.qs.emessage
+                            break
+
+                    self._select(missing)
+
+            result = {}
+            for v in values:
+                if v in self.ids:
+                    result[v] = self.ids[v]
+
+            return result
+
+
+    def _select(self,values):
+        """
+        Look up ids for values in the table
+        The lock must be held by the caller
+        """
+
+        for i in range(0,len(values),self.size):
+            chunk = values[i:i + self.size]
+
+            if self.hash_column is None:
+                key = self.column
+                args = chunk
+            else:
+                key = self.hash_column
+                hashes = dict([(self._hash(v),v) for v in chunk])
+                args = hashes.keys()
+
+            self.sql = 'SELECT %s,id FROM %s WHERE %s IN (%s)' % (key,
+                                                                self.table,
+                                                                key,
+                                                                ','.join(['%s'] * len(args)))
+
+            (rowcount,rows) = self.qs.execute(self.sql,args)
+            if self.qs.status != 0:
+                self.status = 1
+                self.emessage = self.qs.emessage
+                return
+
+            for row in rows:
+                if self.hash_column is None:
+                    self.ids[row[0]] = row[1]
+                elif row[0] in hashes:
+                    self.ids[hashes[row[0]]] = row[1]
+
+
+    def _hash(self,value):
+        """
+        Return the SHA1 hex digest of a value (unicode is hashed as utf-8,
+        which matches SHA1() in MySQL for a utf8 column)
+        """
+
+        if isinstance(value,unicode):
+            value = value.encode('utf-8')
+
+        return hashlib.sha1(value).hexdigest()
+
+
+    def close(self):
+        """
+        Close the database connection
+        """
+
+        self.qs.close()
+
+
+class stats:
+
+    Name = "stats"
+
+
+    def __init__(self, slow=1.0, logger=None):
+        """
+        Constructor
+
+        Statement timings are kept per fingerprint (the statement with its
+        literals and value lists collapsed) in log-scale latency buckets.
+        Any statement that takes slow seconds or more is logged with its
+        arguments.
+        """
+
+        self.slow = slow
+        self.logger = logger
+
+        # Upper bounds (seconds) of the latency buckets: 0.1ms to ~1000s
+        self.bounds = []
+        bound = 0.0001
+        while bound < 1000:
+            self.bounds.append(bound)
+            bound *= 1.25
+
+        # Keyed by fingerprint: [count,total,max,bucket counts]
+        self.statements = {}
+        self.lock = threading.Lock()
+
+
+    def reset(self):
+        """
+        Discard all recorded timings
+        """
+
+        with self.lock:
+            self.statements = {}
+
+
+    def fingerprint(self,sql):
+        """
+        Return the statement with whitespace normalized and its literals,
+        placeholders and value lists replaced
+        """
+
+        s = ' '.join(sql.split())
+        s = re.sub(r"'(?:[^'\\]|\\.)*'",'?',s)
+        s = re.sub(r'\b\d+(\.\d+)?\b','?',s)
+        s = s.replace('%s','?')
+
+        # Multi-row inserts and IN lists
+        s = re.sub(r'(?i)(VALUES\s*)\(.*\)',r'\1(...)',s)
+        s = re.sub(r'\?(\s*,\s*\?)+','?,...',s)
+
+        return s[:200]
+
+
+    def record(self,sql,tup,elapsed):
+        """
+        Record the time taken by a statement
+        """
+
+        # Guard against the clock being set back
+        elapsed = max(elapsed,0)
+
+        key = self.fingerprint(sql)
+        bucket = bisect.bisect_left(self.bounds,elapsed)
+
+        with self.lock:
+            if not key in self.statements:
+                self.statements[key] = [0,0.0,0.0,[0] * (len(self.bounds) + 1)]
+
+            entry = self.statements[key]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2],elapsed)
+            entry[3][bucket] += 1
+
+        if elapsed >= self.slow and not self.logger is None:
+            args = repr(tup)
+            if len(args) > 1000:
+                args = args[:1000] + '...'
+            self.logger.warning('Slow SQL (%.3f seconds): %s\nArguments: %s' % (elapsed,sql,args))
+
+
+    def _percentile(self,entry,p):
+        """
+        Return the upper bound of the bucket holding the p percentile
+        The lock must be held by the caller
+        """
+
+        target = entry[0] * p / 100.0
+        seen = 0
+        for i in range(len(entry[3])):
+            seen += entry[3][i]
+            if seen >= target and seen > 0:
+                if i < len(self.bounds):
+                    return min(self.bounds[i],entry[2])
+                return entry[2]
+
+        return entry[2]
+
+
+    def summary(self,limit=25):
+        """
+        Return a text table of the statements that took the most time
+        """
+
+        lines = ['%8s %10s %9s %9s %9s %9s  %s' % ('count','total(s)','p50(ms)','p95(ms)','p99(ms)','max(ms)','statement')]
+
+        with self.lock:
+            entries = sorted(self.statements.items(),key=lambda item: item[1][1],reverse=True)
+
+            for (key,entry) in entries[:limit]:
+                lines.append('%8i %10.3f %9.1f %9.1f %9.1f %9.1f  %s' % (entry[0],
+                                                                        entry[1],
+                                                                        self._percentile(entry,50) * 1000,
+                                                                        self._percentile(entry,95) * 1000,
+                                                                        self._percentile(entry,99) * 1000,
+                                                                        entry[2] * 1000,
+                                                                        key))
+
+            if len(entries) > limit:
+                lines.append('(%i more statements not shown)' % (len(entries) - limit))
+
+        return '\n'.join(lines)
@@ -0,0 +1,350 @@
+#
+# Copyright 2013 - Tom Alessi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Shared work queue class for Quinico
+
+   The work items of a job run are kept in the main_work_item table so
+   that the same job can be run by any number of processes, on any number
+   of hosts, at once.  Each item is claimed with a lease; items whose lease
+   expires (e.g. the process collecting them died) are claimed again by
+   another worker.
+
+   Every process started for the same scheduled run must be given the same
+   run key (the scheduler uses the scheduled date and time of the job).
+
+   The first process to start a run (begin) sets it up and adds the items;
+   every other process waits until the items are ready.  A queue can be
+   used by the job Worker threads in place of a Queue.Queue (get/task_done);
+   a worker that takes long on an item calls touch to keep its lease.
+
+   Requirements:
+    1. An instance of qsql that is dedicated to this class
+    2. An instance of qemail
+
+   Optional:
+    1. Logging is optional - provide a properly configured instance of
+       a logger if desired.
+"""
+
+
+import hashlib
+import json
+import os
+import Queue
+import socket
+import threading
+import time
+
+
+class queue:
+
+    Name = "queue"
+
+
+    def __init__(self, qs, qm, notify_error, job, run, logger=None, lease=600, attempts=3, poll=5):
+        """
+        Constructor
+
+        Items of a job belong to a run, which every process started for the
+        same scheduled run must be given (at most 20 characters).  lease is
+        the number of seconds a worker has to finish an item (or to touch
+        it again), attempts the number of times an item is handed out
+        before it is given up on and poll the number of seconds between
+        checks while waiting on other processes.
+        """
+
+        self.qs = qs
+        self.qm = qm
+        self.notify_error = notify_error
+        self.job = job
+        self.logger = logger
+        self.run = run
+        self.lease = lease
+        self.attempts = attempts
+        self.poll = poll
+
+        self.owner = '%s:%s' % (socket.gethostname(),os.getpid())
+
+        # The item claimed by each worker thread
+        self.local = threading.local()
+
+
+    def _execute(self,sql,tup=None):
+        """
+        Execute a statement, notifying someone of errors
+        Returns (rowcount,rows) or None on error
+        """
+
+        result = self.qs.execute(sql,tup)
+        if self.qs.status != 0:
+            if self.notify_error:
+                self.qm.send('Error','Error executing sql statement:\n%s\n\nERROR:\n%s' % (sql,self.qs.emessage))
+            return None
+
+        return result
+
+
+    def begin(self):
+        """
+        Start (or join) the run
+        Returns True if this process must set the run up (add the items and
+        call ready), or False once another process has done so
+        """
+
+        # The run itself is an item with an empty key, leased while the run
+        # is being set up and done once the items have been added
+        sql = """
+               INSERT IGNORE INTO main_work_item (job_name,run,item_key,payload,state,owner,lease_expires,attempts,created)
+               VALUES (%s,%s,'','',1,%s,NOW() + INTERVAL %s SECOND,1,NOW())"""
+
+        result = self._execute(sql,(self.job,self.run,self.owner,self.lease))
+        if result is None:
+            return False
+
+        if result[0] == 1:
+            if not self.logger is None:
+                self.logger.info('Setting up %s work queue run %s' % (self.job,self.run))
+            self._cleanup()
+            return True
+
+        if not self.logger is None:
+            self.logger.info('Joining %s work queue run %s' % (self.job,self.run))
+
+        while True:
+            sql = """
+                   SELECT state,lease_expires < NOW()
+                   FROM main_work_item
+                   WHERE job_name=%s AND run=%s AND item_key=''"""
+
+            result = self._execute(sql,(self.job,self.run))
+            if result is None:
+                return False
+
+            (rowcount,rows) = result
+            (state,expired) = rows[0]
+
+            if state == 2:
+                return False
+
+            if expired:
+                # Whoever was setting the run up did not finish, take over
+                sql = """
+                       UPDATE main_work_item
+                       SET owner=%s,lease_expires=NOW() + INTERVAL %s SECOND,attempts=attempts+1
+                       WHERE job_name=%s AND run=%s AND item_key='' AND state=1 AND lease_expires < NOW()"""
+
+                result = self._execute(sql,(self.owner,self.lease,self.job,self.run))
+                if result is None:
+                    return False
+
+                if result[0] == 1:
+                    if not self.logger is None:
+                        self.logger.info('Taking over setting up %s work queue run %s' % (self.job,self.run))
+                    return True
+
+            if not self.logger is None:
+                self.logger.info('Waiting for %s work queue run %s to be set up' % (self.job,self.run))
+
+            time.sleep(self.poll)
+
+
+    def _cleanup(self):
+        """
+        Remove runs of this job that are more than a day old
+        """
+
+        sql = """
+               DELETE FROM main_work_item
+               WHERE job_name=%s AND run<>%s AND created < NOW() - INTERVAL 1 DAY"""
+
+        self._execute(sql,(self.job,self.run))
+
+
+    def add(self,items,size=500):
+        """
+        Add items (anything that can be stored as JSON) to the run
+        Adding an item that is already part of the run has no effect
+        """
+
+        rows = []
+        for item in items:
+            payload = json.dumps(item)
+            rows.append((self.job,self.run,hashlib.sha1(payload).hexdigest(),payload))
+
+        if not self.logger is None:
+            self.logger.info('Adding %i items to %s work queue run %s' % (len(rows),self.job,self.run))
+
+        for i in range(0,len(rows),size):
+            batch = rows[i:i + size]
+
+            sql = 'INSERT IGNORE INTO main_work_item (job_name,run,item_key,payload,state,owner,attempts,created) VALUES '
+            sql += ','.join(["(%s,%s,%s,%s,0,'',0,NOW())"] * len(batch))
+
+            self._execute(sql,tuple(value for row in batch for value in row))
+
+
+    def ready(self):
+        """
+        Mark the run as set up so that other processes can start on it
+        """
+
+        sql = """
+               UPDATE main_work_item
+               SET state=2
+               WHERE job_name=%s AND run=%s AND item_key=''"""
+
+        self._execute(sql,(self.job,self.run))
+
+
+    def get(self,block=True,timeout=None):
+        """
+        Claim the next item and return it
+        Raises Queue.Empty when there are no items left to claim.  While
+        items are leased by other workers this waits (whatever block is)
+        in case one of their leases expires.
+        """
+
+        # Every thread claims one item at a time, so the owner identifies it
+        owner = '%s:%s' % (self.owner,threading.current_thread().ident)
+
+        while True:
+            sql = """
+                   UPDATE main_work_item
+                   SET state=1,owner=%s,lease_expires=NOW() + INTERVAL %s SECOND,attempts=attempts+1
+                   WHERE job_name=%s AND run=%s AND item_key<>''
+                     AND (state=0 OR (state=1 AND lease_expires < NOW()))
+                     AND attempts < %s
+                   ORDER BY id
+                   LIMIT 1"""
+
+            result = self._execute(sql,(owner,self.lease,self.job,self.run,self.attempts))
+            if result is None:
+                raise Queue.Empty
+
+            if result[0] == 1:
+                sql = """
+                       SELECT id,payload,attempts
+                       FROM main_work_item
+                       WHERE job_name=%s AND run=%s AND owner=%s AND state=1
+                       ORDER BY lease_expires DESC
+                       LIMIT 1"""
+
+                result = self._execute(sql,(self.job,self.run,owner))
+                if result is None or result[0] == 0:
+                    raise Queue.Empty
+
+                (id,payload,attempts) = result[1][0]
+                if attempts > 1 and not self.logger is None:
+                    self.logger.info('Reclaimed work item %s (attempt %s)' % (id,attempts))
+
+                self.local.item = id
+                self.local.owner = owner
+                return json.loads(payload)
+
+            # Nothing to claim - done, unless other workers still hold leases
+            sql = """
+                   SELECT COUNT(*)
+                   FROM main_work_item
+                   WHERE job_name=%s AND run=%s AND item_key<>'' AND state=1 AND lease_expires >= NOW()"""
+
+            result = self._execute(sql,(self.job,self.run))
+            if result is None or result[1][0][0] == 0:
+                raise Queue.Empty
+
+            time.sleep(self.poll)
+
+
+    def touch(self):
+        """
+        Extend the lease of the item claimed by this thread
+        Returns False if the item is no longer this thread's (its lease
+        expired and another worker claimed it), so its results must not be
+        saved, or True otherwise
+        """
+
+        id = getattr(self.local,'item',None)
+        if id is None:
+            return True
+
+        sql = """
+               UPDATE main_work_item
+               SET lease_expires=NOW() + INTERVAL %s SECOND
+               WHERE id=%s AND owner=%s AND state=1"""
+
+        if self._execute(sql,(self.lease,id,self.local.owner)) is None:
+            return True
+
+        # The rowcount of an UPDATE is 0 when nothing changed (a touch within
+        # the same second), so check the owner separately
+        sql = """
+               SELECT COUNT(*)
+               FROM main_work_item
+               WHERE id=%s AND owner=%s AND state=1"""
+
+        result = self._execute(sql,(id,self.local.owner))
+        if result is None or result[1][0][0] == 1:
+            return True
+
+        if not self.logger is None:
+            self.logger.warning('Work item %s was reclaimed by another worker' % id)
+
+        self.local.item = None
+        return False
+
+
+    def task_done(self):
+        """
+        Mark the item claimed by this thread as done (unless another worker
+        has reclaimed it)
+        """
+
+        id = getattr(self.local,'item',None)
+        if id is None:
+            return
+
+        sql = """
+               UPDATE main_work_item
+               SET state=2
+               WHERE id=%s AND owner=%s"""
+
+        self._execute(sql,(id,self.local.owner))
+        self.local.item = None
+
+
+    def failed(self):
+        """
+        Return the number of items of the run that were given up on
+        """
+
+        sql = """
+               SELECT COUNT(*)
+               FROM main_work_item
+               WHERE job_name=%s AND run=%s AND item_key<>''
+                 AND state=1 AND lease_expires < NOW() AND attempts >= %s"""
+
+        result = self._execute(sql,(self.job,self.run,self.attempts))
+        if result is None:
+            return 0
+
+        return int(result[1][0][0])
+
+
+    def close(self):
+        """
+        Close the database connection
+        """
+
+        self.qs.close()
@@ -27,7 +27,7 @@ from quinico.pagespeed.models import Test
 from quinico.webpagetest.models import Test as WPT_test
 from quinico.seomoz.models import Url
 from quinico.webmaster.models import Domain as Webmaster_Domain
-from quinico.main.models import Config
+from quinico.main import configs
 
 
 class prefs:
@@ -160,7 +160,7 @@ class prefs:
         self.logger.debug('Setting up %s default graphs' % 'seo')
 
         # Determine if this is a free or paid account
-        type = Config.objects.filter(config_name='seomoz_account_type').values('config_value')[0]['config_value']
+        type = configs.get('seomoz_account_type')
 
         # SEO Trend Urls
         # Example: http://www.domain.com/seomoz/trends?url=www.domain.com&metric=ueid&format=db
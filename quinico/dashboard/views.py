@@ -29,13 +29,12 @@ from django.template import RequestContext
 from django.http import HttpResponseRedirect
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-from quinico.main.models import Config
+from quinico.main import configs
 from quinico.dashboard.models import Subscription
 from quinico.dashboard.models import Dash_Settings
 from quinico.dashboard.models import Url
 from quinico.dashboard.models import Url_Subscription
 from quinico.dashboard import preferences
-from quinico.main.models import Config
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -90,21 +89,21 @@ def admin(request):
             # User has no custom settings
             if not set_exists:
                 Dash_Settings(user_id=user_id[0]['id'],
-                              slots=Config.objects.filter(config_name='dashboard_slots').values('config_value')[0]['config_value'],
-                              frequency=Config.objects.filter(config_name='dashboard_frequency').values('config_value')[0]['config_value'],
-                              width=Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                              height=Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                              font=Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']
+                              slots=configs.get('dashboard_slots'),
+                              frequency=configs.get('dashboard_frequency'),
+                              width=configs.get('dashboard_width'),
+                              height=configs.get('dashboard_height'),
+                              font=configs.get('dashboard_font')
                              ).save()
 
             # User had custom settings, check them
             else:
                 # Set the settings to defaults and then check if they have been changed
-                dash_set = {'slots':Config.objects.filter(config_name='dashboard_slots').values('config_value')[0]['config_value'],
-                            'frequency':Config.objects.filter(config_name='dashboard_frequency').values('config_value')[0]['config_value'],
-                            'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                            'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                            'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}
+                dash_set = {'slots':configs.get('dashboard_slots'),
+                            'frequency':configs.get('dashboard_frequency'),
+                            'width':configs.get('dashboard_width'),
+                            'height':configs.get('dashboard_height'),
+                            'font':configs.get('dashboard_font')}
 
                 for set in dash_set:
                     if set in request.POST and request.POST[set] != '':
@@ -186,11 +185,11 @@ def admin(request):
         # Subscribe them to everything and give the defaults
         else:
             subscription = [{'keyword_rank':1,'pagespeed':1,'webpagetest':1,'seomoz':1,'webmaster':1}]
-            dash_settings = [{'slots':Config.objects.filter(config_name='dashboard_slots').values('config_value')[0]['config_value'],
-                              'frequency':Config.objects.filter(config_name='dashboard_frequency').values('config_value')[0]['config_value'],
-                              'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                              'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                              'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+            dash_settings = [{'slots':configs.get('dashboard_slots'),
+                              'frequency':configs.get('dashboard_frequency'),
+                              'width':configs.get('dashboard_width'),
+                              'height':configs.get('dashboard_height'),
+                              'font':configs.get('dashboard_font')}]
             urls = None
             user = 'anon'
 
@@ -242,7 +241,7 @@ def index(request):
         logger.debug('setting dashboard prefs for %s' % report)
 
         # Create the url list
-        disable_report = int(Config.objects.filter(config_name='disable_%s_reports' % report).values('config_value')[0]['config_value'])
+        disable_report = int(configs.get('disable_%s_reports' % report))
 
         # If the admin has disabled these reports, they won't be shown
         if disable_report:
@@ -266,11 +265,11 @@ def index(request):
     # Check if there is an entry for the user if not, give them the defaults
     dash_settings = Dash_Settings.objects.filter(user__username=request.user.username)
     if not dash_settings:
-        dash_settings = [{'slots':Config.objects.filter(config_name='dashboard_slots').values('config_value')[0]['config_value'],
-                          'frequency':Config.objects.filter(config_name='dashboard_frequency').values('config_value')[0]['config_value'],
-                          'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                          'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                          'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+        dash_settings = [{'slots':configs.get('dashboard_slots'),
+                          'frequency':configs.get('dashboard_frequency'),
+                          'width':configs.get('dashboard_width'),
+                          'height':configs.get('dashboard_height'),
+                          'font':configs.get('dashboard_font')}]
 
     # Add any custom graph URLs the user may have added
     # The user must be authenticated
@@ -280,7 +279,7 @@ def index(request):
             url_list[url['url_id__url']] = 'custom'
 
     # Determine the refresh rate
-    refresh = Config.objects.filter(config_name='dashboard_refresh').values('config_value')[0]['config_value']
+    refresh = configs.get('dashboard_refresh')
 
     # Print the page
     if not url_list:
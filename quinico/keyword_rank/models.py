@@ -79,9 +79,14 @@ class API_Errors(models.Model):
 
 
 class Url(models.Model):
-    """Urls that accompany the rank"""
+    """Urls that accompany the rank
+
+       url_hash is the SHA1 of the url and is what urls are looked up by,
+       since the url itself is too long to index
+    """
 
     url = models.CharField(max_length=1000)
+    url_hash = models.CharField(max_length=40, unique=True)
 
 
 class Rank(models.Model):
@@ -102,3 +107,31 @@ class Top_Ten(models.Model):
     keyword = models.ForeignKey(Keyword)
     url = models.ForeignKey(Url)
     rank = models.IntegerField(max_length=11)
+
+
+class Summary(models.Model):
+    """Daily first page rank count for each domain
+    (saved by the keyword_rank job for the dashboards)"""
+
+    date = models.DateField(null=False,blank=False)
+    domain = models.ForeignKey(Domain)
+    first_page = models.IntegerField(max_length=11)
+
+    class Meta:
+        unique_together = ['date','domain']
+
+
+class Summary_Change(models.Model):
+    """Daily count of each domain's keywords whose rank went up, down or
+    stayed the same since a number of days before
+    (saved by the keyword_rank job for the dashboards)"""
+
+    date = models.DateField(null=False,blank=False)
+    domain = models.ForeignKey(Domain)
+    days = models.IntegerField(max_length=11)
+    up = models.IntegerField(max_length=11)
+    down = models.IntegerField(max_length=11)
+    unch = models.IntegerField(max_length=11)
+
+    class Meta:
+        unique_together = ['date','domain','days']
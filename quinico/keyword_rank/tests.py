@@ -5,7 +5,22 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
+import hashlib
+import imp
+import os
+from django.conf import settings
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from qclasses import qemail
+from qclasses import qsql
+from quinico.keyword_rank import views
+from quinico.keyword_rank.models import Domain
+from quinico.keyword_rank.models import Keyword
+from quinico.keyword_rank.models import Rank
+from quinico.keyword_rank.models import Test
+from quinico.keyword_rank.models import Url
 
 
 class SimpleTest(TestCase):
@@ -14,3 +29,57 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SummaryTest(TransactionTestCase):
+    """The summary saved by the job matches what the dashboard computes"""
+
+    def setUp(self):
+        # The job is a script, not a module of a package
+        self.job = imp.load_source('keyword_rank_job',os.path.join(settings.APP_DIR,'jobs','keyword_rank.py'))
+
+        db = settings.DATABASES['default']
+        self.qs = qsql.connect(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'])
+        self.qm = qemail.notify(settings.SMTP_HOST,settings.SMTP_SENDER,settings.SMTP_RECIPIENT)
+
+        self.domain = Domain.objects.create(domain='www.example.com',gl='us',googlehost='google.com')
+        self.url = Url.objects.create(url='http://www.example.com/',url_hash=hashlib.sha1('http://www.example.com/').hexdigest())
+
+        # Not today, so nothing depends on the date the database is on
+        self.date = datetime.date(2013,1,31)
+        self.dates = [self.date - datetime.timedelta(days=n) for n in (0,1,2,3,4,5,6,30)]
+
+    def tearDown(self):
+        self.qs.close()
+
+    def ranks(self,keyword,ranks,tested=True):
+        """Save the ranks of a keyword, keyed by days before the date"""
+
+        keyword = Keyword.objects.create(keyword=keyword)
+        if tested:
+            Test.objects.create(domain=self.domain,keyword=keyword)
+
+        for (days,rank) in ranks.items():
+            Rank.objects.create(date=self.date - datetime.timedelta(days=days),domain=self.domain,keyword=keyword,url=self.url,rank=rank)
+
+    def test_summary(self):
+        """update_summary saves the dashboard's first page and change counts under the run date"""
+
+        self.ranks('up',{0:3,1:5,30:3})
+        self.ranks('down',{0:0,1:8})
+        self.ranks('unchanged',{0:12,1:12,30:0})
+        self.ranks('missing',{1:1,2:4})
+        self.ranks('untested',{0:1,1:20},tested=False)
+
+        with override_settings(SMTP_NOTIFY_ERROR=False):
+            self.job.update_summary(self.qs,self.qm,self.date)
+
+        keyword_list = Test.objects.filter(domain=self.domain).values('keyword__keyword')
+        (ranks,first_page) = views.dashboard_ranks(self.domain.id,keyword_list,self.dates)
+        changes = views.dashboard_changes(ranks,self.dates)
+
+        self.assertEqual(views.dashboard_summary(self.domain.id,self.dates),(first_page,changes))
+
+        self.assertEqual(first_page[:3],[{'2013-01-31':1},{'2013-01-30':3},{'2013-01-29':1}])
+        self.assertEqual(dict(changes)['2013-01-30'],{'up':1,'down':1,'unch':1})
+        self.assertEqual(dict(changes)['2013-01-01'],{'up':1,'down':0,'unch':1})
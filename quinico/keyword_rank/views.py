@@ -29,10 +29,14 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from quinico.main.models import Config
+from quinico.main import configs
+from quinico.main import cache
+from quinico.main.cache import cache_response
 from quinico.keyword_rank.models import Domain
 from quinico.keyword_rank.models import Keyword
 from quinico.keyword_rank.models import Rank
+from quinico.keyword_rank.models import Summary
+from quinico.keyword_rank.models import Summary_Change
 from quinico.keyword_rank.models import Top_Ten
 from quinico.keyword_rank.models import Test
 from quinico.keyword_rank.forms import UploadForm
@@ -68,6 +72,9 @@ def upload(request):
         if upload_form.is_valid():
             upload_form.save()
 
+            # The cached reports do not include the new keywords
+            cache.bump('keyword_rank')
+
     else:
         # Display the upload form
         upload_form = UploadForm()
@@ -86,6 +93,7 @@ def upload(request):
     )
 
 
+@cache_response('keyword_rank')
 def trends(request):
     """Keyword Rank Trends View
     Allow graphing of individual keyword ranks over time
@@ -176,9 +184,9 @@ def trends(request):
 
                     if not dash_settings:
                         # Give the default
-                        dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                         'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                         'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                        dash_settings = [{'width':configs.get('dashboard_width'),
+                                         'height':configs.get('dashboard_height'),
+                                         'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
                      'keyword_rank/trends-db.html',
@@ -281,6 +289,172 @@ def trends(request):
 
 
 
+def dashboard_ranks(id,keyword_list,dates):
+    """Return the ranks of a domain's keywords on the dashboard dates
+    (newest first) and the first page rank counts of those dates
+    - ranks is of the form {'keyword':[url,rank1,rank2,...]}
+    - first_page is of the form [{'date':counter}] to keep the dates in order
+    """
+
+    ranks = {}
+    first_page = []
+
+    # Request all ranks for these dates at once and index them by
+    # keyword and date
+    ranks_dates = {}
+    for r in Rank.objects.filter(domain__id=id,
+                                 date__in=dates
+                                ).values('keyword__keyword','date','rank','url__url'):
+        ranks_dates.setdefault((r['keyword__keyword'],r['date']),r)
+
+    for current_date in dates:
+        # Counter for 1st page ranks
+        first_page_counter = 0
+
+        current_date_str = current_date.strftime("%Y-%m-%d")
+        logger.debug('Formatted date: %s' % current_date_str)
+
+        # Look at each keyword and see if we have a result, otherwise set to 'n/a'
+        for k in keyword_list:
+            keyword = k['keyword__keyword']
+
+            # Add an empty keyword dict to our dict if its not already there
+            if not keyword in ranks:
+                ranks[keyword] = []
+
+            r = ranks_dates.get((keyword,current_date))
+            if r is None:
+                # The URL and rank must be set to n/a if no result was found
+                if current_date == dates[0]:
+                    ranks[keyword].append('n/a')
+                ranks[keyword].append('n/a')
+                continue
+
+            # If this is the first day, add the URL first
+            if current_date == dates[0]:
+                ranks[keyword].append(r['url__url'])
+            ranks[keyword].append(r['rank'])
+
+            # If its on the first page of results, count it
+            if r['rank'] > 0 and r['rank'] <= 10:
+                first_page_counter += 1
+
+        # Add the first page ranks
+        first_page.append({current_date_str:first_page_counter})
+
+    return (ranks,first_page)
+
+
+def dashboard_changes(ranks,dates):
+    """Return the number of keywords whose rank went up, down or stayed the
+    same between the first dashboard date and each of the others
+    If the first date is not available, then these will all be blank.
+    """
+
+    # Dictionary to hold the up/down/unch numbers
+    changes = {}
+
+    # The dates compared against
+    updown_dates = [current_date.strftime("%Y-%m-%d") for current_date in dates]
+
+    for keyword in ranks:
+
+        logger.debug('Processing new keyword')
+
+        # Skip the last one since we don't have a previous one to compare it to
+        # Also note that the first entry in the ranks array is the url so need to account for that
+        for day in range(len(ranks[keyword]) - 2):
+            logger.debug('Keyword Ranks for day: %s' % ranks[keyword])
+            logger.debug('Processing data for day: %s' % day)
+
+            up = 0    # Improved
+            down = 0  # Declined
+            unch = 0  # Unchanged
+
+            # Did it go up or down between the most recent day and the date in question?
+            # Current day (remember that position 0 is the url)
+            current_day = ranks[keyword][1]
+
+            # Previous day (skip ahead 2.  The url and the first day
+            previous_day = ranks[keyword][day + 2]
+
+            # If the current day or previous day is 'n/a', then skip this one
+            if current_day == 'n/a':
+                continue
+
+            if previous_day == 'n/a':
+                continue
+
+            # Nothing changed
+            if current_day == previous_day:
+                unch += 1
+
+            # In the case where the current day is zero but the previous day had a rank
+            # then the rank actually declined (assuming the user did not change the allowable rank results)
+            elif current_day == 0:
+                if previous_day > 0:
+                    down += 1
+
+            # In the case where the previous day is zero but the current day has a rank
+            # then the rank actually improved (assuming the user did not change the allowable rank results)
+            elif previous_day == 0:
+                if current_day > 0:
+                    up += 1
+
+            # Rank declined
+            elif current_day > previous_day:
+                down += 1
+
+            # Rank improved
+            elif current_day < previous_day:
+                up += 1
+
+            # Add to our list
+            if not updown_dates[day + 1] in changes:
+                logger.debug('Adding %s to changes dict' % updown_dates[day + 1])
+                changes[updown_dates[day + 1]] = {'up':0,'down':0,'unch':0}
+
+            changes[updown_dates[day + 1]]['up'] += up
+            changes[updown_dates[day + 1]]['down'] += down
+            changes[updown_dates[day + 1]]['unch'] += unch
+
+    # Sort the changes list b/c it will be out of order
+    changes = sorted(changes.items(), reverse=True)
+
+    return changes
+
+
+def dashboard_summary(id,dates):
+    """Return the first page and rank change counts that the keyword_rank
+    job saved for a domain on the dashboard dates (in the same format as
+    dashboard_ranks and dashboard_changes), or None if there is no summary
+    for the first date
+    """
+
+    first_pages = dict(Summary.objects.filter(domain__id=id,date__in=dates).values_list('date','first_page'))
+    if not dates[0] in first_pages:
+        return None
+
+    first_page = []
+    for current_date in dates:
+        first_page.append({current_date.strftime("%Y-%m-%d"):first_pages.get(current_date,0)})
+
+    changes = {}
+    for row in Summary_Change.objects.filter(domain__id=id,date=dates[0]).values('days','up','down','unch'):
+        # Only days with ranks to compare are shown
+        if row['up'] + row['down'] + row['unch'] == 0:
+            continue
+
+        previous_date = dates[0] - datetime.timedelta(days=row['days'])
+        changes[previous_date.strftime("%Y-%m-%d")] = {'up':row['up'],'down':row['down'],'unch':row['unch']}
+
+    # Sort the changes list b/c it will be out of order
+    changes = sorted(changes.items(), reverse=True)
+
+    return (first_page,changes)
+
+
+@cache_response('keyword_rank')
 def dashboard(request):
     """Keyword Rank Dashboard View
     Provide all relevant keyword information for a specific domain
@@ -305,21 +479,11 @@ def dashboard(request):
     	    # Obtain all of the keywords for this domain, gl and googlehost
     	    # This will be the definitive source
     	    keyword_list = Test.objects.filter(domain__id=id).values('keyword__keyword')
-            print keyword_list
-
-    	    # Setup an empty dictionary to hold the ranks, of the following form: {'keyword':[rank1,rank2,...]}
-    	    ranks = {}
-
-    	    # Setup a dictionary for first page ranks, of the following form in order to keep the dates in order: [{'date':'counter'}]
-    	    first_page = []
 
     	    # Setup a dictionary for headings on the daily keyword results table
     	    headings = {}
     	    headings = ['Keyword','Url']
 
-    	    # Setup a lookup table for the up/down/unch dates
-    	    updown_dates = []
-
     	    # Setup the dates that we'll check ranks for - there can be spans here if desired
             # but the first day must be 0 (today) because we store special data for this one
             # including the rank on this day and the URL.
@@ -360,136 +524,30 @@ def dashboard(request):
                 days = (now - last_run[0]['date']).days
                 logger.debug('Last run of keyword_rank was %s days ago' % days)
 
+            # The dates to check, newest first
+            dates = []
             for number in numbers:
                 logger.debug('Acquiring data for %s days ago' % (number + days))
                 then = datetime.timedelta(days=(number + days))
-                current_date = now - then
-                current_date = current_date.strftime("%Y-%m-%d")
-                logger.debug('Formatted date: %s' % current_date)
-
-                # Counter for 1st page ranks
-                first_page_counter = 0
-
-                # Add the formatted date to our headings
-                headings.append(current_date)
-                logger.debug('Headings is now: %s' % headings)
-                updown_dates.append(current_date)
-                logger.debug('Updown_dates is now: %s' % updown_dates)
-
-                # Request all keywords and ranks for this date
-                ranks_date = Rank.objects.filter(domain__id=id,
-                                                 date=current_date
-                                                ).values('keyword__keyword','rank','url__url').order_by('keyword__keyword')
-
-                # Look at each keyword and see if we have a result, otherwise set to 'n/a'
-                for k in keyword_list:
-                    found = 0
-
-                    # Add an empty keyword dict to our dict if its not already there
-                    if not k['keyword__keyword'] in ranks:
-                        ranks[k['keyword__keyword']] = []
-
-                    # Check every rank result for this date for our keyword
-                    for r in ranks_date:
-                        # If this is our keyword, save the rank
-                        if k['keyword__keyword'] == r['keyword__keyword']:
-                            found = 1 
-                            # If this is the first day, add the URL first
-                            if number == 0:
-                                ranks[k['keyword__keyword']].append(r['url__url'])
-                                ranks[k['keyword__keyword']].append(r['rank'])
-                                # If its on the first page of results, count it
-                                if r['rank'] > 0 and r['rank'] <= 10:
-                                    first_page_counter += 1
-                            else:
-                                ranks[k['keyword__keyword']].append(r['rank'])
-                                # If its on the first page of results, count it
-                                if r['rank'] > 0 and r['rank'] <= 10:
-                                    first_page_counter += 1
-
-                    # If we didn't find a result, set to 'n/a'
-                    if found != 1:
-                        # The URL and rank must be set to n/a if no result was found
-                        if number == 0:
-                            ranks[k['keyword__keyword']].append('n/a')
-                            ranks[k['keyword__keyword']].append('n/a')
-                        else:
-                            ranks[k['keyword__keyword']].append('n/a')
-
-                # Add the first page ranks
-                first_page.append({current_date:first_page_counter})
-
-
-            # Compile the position change numbers
-            # If the current day is not available, then these will
-            # all be blank.
-
-    	    # Dictionary to hold the up/down/unch numbers
-            changes = {}
-
-            for keyword in ranks:
-
-                logger.debug('Processing new keyword')
-
-                # Skip the last one since we don't have a previous one to compare it to
-                # Also note that the first entry in the ranks array is the url so need to account for that
-                for day in range(len(ranks[keyword]) - 2):
-                    logger.debug('Keyword Ranks for day: %s' % ranks[keyword])
-                    logger.debug('Processing data for day: %s' % day)
-
-                    up = 0    # Improved
-                    down = 0  # Declined
-                    unch = 0  # Unchanged
-
-                    # Did it go up or down between the most recent day and the date in question?
-                    # Current day (remember that position 0 is the url)
-                    current_day = ranks[keyword][1]
-
-                    # Previous day (skip ahead 2.  The url and the first day
-                    previous_day = ranks[keyword][day + 2]
-
-                    # If the current day or previous day is 'n/a', then skip this one
-                    if current_day == 'n/a':
-                        continue
-
-                    if previous_day == 'n/a':
-                        continue
-
-                    # Nothing changed
-                    if current_day == previous_day:
-                        unch += 1
-
-                    # In the case where the current day is zero but the previous day had a rank
-                    # then the rank actually declined (assuming the user did not change the allowable rank results)
-                    elif current_day == 0:
-                        if previous_day > 0:
-                            down += 1
-
-                    # In the case where the previous day is zero but the current day has a rank
-                    # then the rank actually improved (assuming the user did not change the allowable rank results)
-                    elif previous_day == 0:
-                        if current_day > 0:
-                            up += 1
-
-                    # Rank declined
-                    elif current_day > previous_day:
-                        down += 1
-
-                    # Rank improved
-                    elif current_day < previous_day:
-                        up += 1
-
-                    # Add to our list
-                    if not updown_dates[day + 1] in changes:
-                        logger.debug('Adding %s to changes dict' % updown_dates[day + 1])
-                        changes[updown_dates[day + 1]] = {'up':0,'down':0,'unch':0}
-
-                    changes[updown_dates[day + 1]]['up'] += up
-                    changes[updown_dates[day + 1]]['down'] += down
-                    changes[updown_dates[day + 1]]['unch'] += unch
-
-            # Sort the changes list b/c it will be out of order
-            changes = sorted(changes.items(), reverse=True)
+                dates.append(now - then)
+
+            # Add the formatted dates to our headings
+            for current_date in dates:
+                headings.append(current_date.strftime("%Y-%m-%d"))
+            logger.debug('Headings is now: %s' % headings)
+
+            # The dashboard formats only need the first page and rank change
+            # counts, which the keyword_rank job saves when it runs
+            summary = None
+            if format in ('db','db1','db2','json1','json2'):
+                summary = dashboard_summary(id,dates)
+
+            if summary is None:
+                (ranks,first_page) = dashboard_ranks(id,keyword_list,dates)
+                changes = dashboard_changes(ranks,dates)
+            else:
+                ranks = {}
+                (first_page,changes) = summary
 
             # Obtain a count of all keywords
             keyword_count = Test.objects.filter(domain__id=id).values('keyword__keyword').count()
@@ -504,21 +562,24 @@ def dashboard(request):
             date_from = date_from.strftime("%Y-%m-%d")
 
 
-            # Obtain the keyword ranks for this keyword and domain
+            # Obtain the keyword ranks for this domain
             # Add the last heading
             headings.append('History')
+
+            # Only the full page has the charts
             small_charts = {}
-            # Obtain all the keywords first
-            sc_keywords = Test.objects.filter(domain__id=id).values('keyword__keyword')
 
-            for keyword in sc_keywords:
+            if not format:
+                # Every keyword gets a chart, even without ranks
+                small_charts = dict([(k['keyword__keyword'],[]) for k in keyword_list])
+
                 sc_ranks = Rank.objects.filter(domain__id=id,
-                                            keyword__keyword=keyword['keyword__keyword'],
-                                            date__range=[date_from,date_to]
-                                            ).values('date','rank').order_by('date')
+                                               date__range=[date_from,date_to]
+                                              ).values('keyword__keyword','date','rank').order_by('date')
 
-                # Add this keyword range
-                small_charts[keyword['keyword__keyword']] = sc_ranks
+                for r in sc_ranks:
+                    if r['keyword__keyword'] in small_charts:
+                        small_charts[r['keyword__keyword']].append(r)
 
             # Construct the dashboard, download and monitoring links
             base_url = 'http://%s/keyword_rank/dashboard?id' % (request.META['HTTP_HOST'])
@@ -563,9 +624,9 @@ def dashboard(request):
 
                     if not dash_settings:
                         # Give the default
-                        dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                          'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                          'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                        dash_settings = [{'width':configs.get('dashboard_width'),
+                                          'height':configs.get('dashboard_height'),
+                                          'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
                         'keyword_rank/dashboard-db.html',
@@ -592,9 +653,9 @@ def dashboard(request):
 
                     if not dash_settings:
                         # Give the default
-                        dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                          'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                          'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                        dash_settings = [{'width':configs.get('dashboard_width'),
+                                          'height':configs.get('dashboard_height'),
+                                          'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
                         'keyword_rank/dashboard-db1.html',
@@ -618,9 +679,9 @@ def dashboard(request):
 
                     if not dash_settings:
                         # Give the default
-                        dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                          'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                          'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                        dash_settings = [{'width':configs.get('dashboard_width'),
+                                          'height':configs.get('dashboard_height'),
+                                          'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
                         'keyword_rank/dashboard-db2.html',
@@ -656,7 +717,7 @@ def dashboard(request):
             else: 
 
                 # Obtain the maxValue for the history charts
-                maxValue = Config.objects.filter(config_name='max_keyword_results').values('config_value')[0]['config_value']
+                maxValue = configs.get('max_keyword_results')
 
                 return render_to_response(
                     'keyword_rank/dashboard.html',
@@ -666,11 +727,10 @@ def dashboard(request):
                         'gl':details[0]['gl'],
                         'googlehost':details[0]['googlehost'],
                         'headings':headings,
-                        'ranks':sorted(ranks.iteritems()),
+                        'ranks':[(keyword,ranks[keyword],small_charts[keyword]) for keyword in sorted(ranks)],
                         'first_page':first_page,
                         'changes':changes,
                         'keyword_count':keyword_count,
-                        'small_charts':small_charts,
                         'maxValue':maxValue,
                         'db_link':db_link,
                         'db_link1':db_link1,
@@ -23,6 +23,7 @@
 """
 
 
+from quinico.main import configs
 from quinico.main.models import Help
 from quinico.main.forms import HelpAdminForm
 from django.contrib import admin
@@ -38,6 +39,16 @@ class HelpAdmin(admin.ModelAdmin):
 
     list_display = ('help_name','help_value')
 
+    def save_model(self, request, obj, form, change):
+        """Save the help blurb and have every process pick it up"""
+        obj.save()
+        configs.bump()
+
+    def delete_model(self, request, obj):
+        """Delete the help blurb and have every process drop it"""
+        obj.delete()
+        configs.bump()
+
 
 # Register the classes with the admin
 admin.site.register(Help,HelpAdmin)
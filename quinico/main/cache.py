@@ -0,0 +1,263 @@
+#
+# Copyright 2013 - Tom Alessi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Response cache for Quinico
+
+   The json, db and csv formats of the reports only change when a data
+   job saves new data, so they are cached under the request parameters
+   and the data version of the jobs they report on.  Every data job bumps
+   its version (main_data_job) when it finishes, and a configuration
+   change (which can alter the reports) bumps config_version.
+
+   The API status counts are written throughout a job run, not when it
+   finishes, so they are not cached.
+
+   The cache is configured in settings.py:
+    - RESPONSE_CACHE: 'memory' (each web server process keeps its own),
+      'file' (kept in RESPONSE_CACHE_DIR, shared by every process) or ''
+      to turn it off
+    - RESPONSE_CACHE_SIZE: the number of responses kept, the least
+      recently used are removed first
+
+   Functions:
+    - cache_response: decorator for the report views
+    - bump: record new data saved outside of the data jobs
+
+"""
+
+
+import collections
+import cPickle
+import datetime
+import functools
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from django.conf import settings
+from django.db.models import F
+from django.http import HttpResponse
+from quinico.main import configs
+from quinico.main.models import Data_Job
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# The formats that are cached (the HTML pages are not)
+FORMATS = ['json','json1','json2','db','db1','db2','csv']
+
+# The process-wide cache returned by shared()
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+class memory:
+
+    Name = "memory"
+
+
+    def __init__(self, size):
+        """
+        Constructor
+        """
+
+        self.size = size
+        self.lock = threading.Lock()
+
+        # Least recently used first
+        self.entries = collections.OrderedDict()
+
+
+    def get(self,key):
+        """
+        Return the entry for a key, or None
+        """
+
+        with self.lock:
+            entry = self.entries.pop(key,None)
+            if not entry is None:
+                self.entries[key] = entry
+
+            return entry
+
+
+    def set(self,key,entry):
+        """
+        Save the entry for a key, removing the least recently used entries
+        if there are too many
+        """
+
+        with self.lock:
+            self.entries.pop(key,None)
+            self.entries[key] = entry
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class files:
+
+    Name = "files"
+
+
+    def __init__(self, path, size):
+        """
+        Constructor
+
+        Each entry is a file in path named by its key.  The modification
+        time of a file is when the entry was last used.
+        """
+
+        self.path = path
+        self.size = size
+
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+    def get(self,key):
+        """
+        Return the entry for a key, or None
+        """
+
+        name = os.path.join(self.path,key)
+
+        try:
+            with open(name,'rb') as f:
+                entry = cPickle.load(f)
+            os.utime(name,None)
+        except (IOError,OSError,EOFError,cPickle.UnpicklingError):
+            return None
+
+        return entry
+
+
+    def set(self,key,entry):
+        """
+        Save the entry for a key, removing the least recently used entries
+        if there are too many
+        """
+
+        # Write to a temporary file first so other processes never read
+        # a partial entry
+        (fd,temp) = tempfile.mkstemp(prefix='.',dir=self.path)
+        with os.fdopen(fd,'wb') as f:
+            cPickle.dump(entry,f,cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp,os.path.join(self.path,key))
+
+        names = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            try:
+                names.append((os.path.getmtime(os.path.join(self.path,name)),name))
+            except OSError:
+                pass
+
+        names.sort()
+        for (mtime,name) in names[:max(len(names) - self.size,0)]:
+            try:
+                os.remove(os.path.join(self.path,name))
+            except OSError:
+                pass
+
+
+def shared():
+    """
+    Return the process-wide cache, or None if caching is turned off
+    """
+
+    with _shared_lock:
+        if not 'cache' in _shared:
+            backend = getattr(settings,'RESPONSE_CACHE','')
+            size = int(getattr(settings,'RESPONSE_CACHE_SIZE',1000))
+
+            if backend == 'memory':
+                _shared['cache'] = memory(size)
+            elif backend == 'file':
+                _shared['cache'] = files(settings.RESPONSE_CACHE_DIR,size)
+            else:
+                _shared['cache'] = None
+
+    return _shared['cache']
+
+
+def bump(job):
+    """
+    Record that new data was saved for the reports of a data job
+    """
+
+    Data_Job.objects.filter(job_name=job).update(data_version=F('data_version') + 1)
+
+
+def cache_key(request,jobs):
+    """
+    Return the cache key of a request for the reports of jobs
+    """
+
+    # The same parameters in any order (or left blank) give the same report
+    params = sorted((name,sorted(values)) for (name,values) in request.GET.lists() if [v for v in values if v])
+
+    versions = sorted(Data_Job.objects.filter(job_name__in=jobs).values_list('job_name','data_version'))
+
+    # Reports without dates cover the days up to today, the dashboard
+    # sizes depend on the user and the others on the configuration
+    key = (request.path,params,versions,configs.get('config_version'),request.user.username,datetime.date.today().isoformat())
+
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+def cache_response(*jobs):
+    """
+    Decorator for the views that report on the data of jobs: serve the
+    json, db and csv formats from the cache until the jobs save new data
+    """
+
+    def decorator(view):
+
+        @functools.wraps(view)
+        def cached_view(request,*args,**kwargs):
+            cache = shared()
+            if cache is None or request.method != 'GET' or not request.GET.get('format') in FORMATS:
+                return view(request,*args,**kwargs)
+
+            key = cache_key(request,jobs)
+
+            entry = cache.get(key)
+            if not entry is None:
+                logger.debug('Response cache hit for %s' % request.get_full_path())
+                (status,content,headers) = entry
+                response = HttpResponse(content,status=status)
+                for (header,value) in headers:
+                    response[header] = value
+                return response
+
+            response = view(request,*args,**kwargs)
+
+            # Only keep complete responses that do not set cookies
+            if response.status_code == 200 and not response.cookies:
+                cache.set(key,(response.status_code,response.content,response.items()))
+
+            return response
+
+        return cached_view
+
+    return decorator
@@ -0,0 +1,94 @@
+#
+# Copyright 2013 - Tom Alessi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Configuration cache for Quinico
+
+   The configuration parameters and help blurbs are loaded once and kept
+   by every process until they change.  Whenever either is saved the
+   config_version parameter is bumped; each process checks it at most
+   every CHECK_INTERVAL seconds and reloads when it differs.
+
+   Functions:
+    - get: return a configuration parameter
+    - help: return the help blurb for a path
+    - bump: have every process reload the configuration
+
+"""
+
+
+import threading
+import time
+from quinico.main.models import Config
+from quinico.main.models import Help
+
+
+# Seconds between checks of the config_version parameter
+CHECK_INTERVAL = 5
+
+_cache = {'version':None,'checked':0,'configs':{},'help':{}}
+_lock = threading.Lock()
+
+
+def _load():
+    """
+    Return the cache, reloading it if the configuration has changed
+    """
+
+    with _lock:
+        now = time.time()
+        if _cache['checked'] and now - _cache['checked'] < CHECK_INTERVAL:
+            return _cache
+
+        version = Config.objects.filter(config_name='config_version').values('config_value')
+        version = version[0]['config_value'] if version else None
+
+        # Without a version everything is reloaded after every interval
+        if not _cache['checked'] or version is None or version != _cache['version']:
+            _cache['configs'] = dict(Config.objects.values_list('config_name','config_value'))
+            _cache['help'] = dict(Help.objects.values_list('help_name','help_value'))
+            _cache['version'] = version
+
+        _cache['checked'] = now
+
+        return _cache
+
+
+def get(name, default=None):
+    """
+    Return a configuration parameter, or default if there is none
+    """
+
+    return _load()['configs'].get(name,default)
+
+
+def help(path):
+    """
+    Return the help blurb for a path, or None if there is none
+    """
+
+    return _load()['help'].get(path)
+
+
+def bump():
+    """
+    Record a change to the configuration or help so every process
+    reloads them
+    """
+
+    Config.objects.filter(config_name='config_version').update(config_value='%.6f' % time.time())
+
+    with _lock:
+        _cache['checked'] = 0
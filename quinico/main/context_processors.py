@@ -26,8 +26,7 @@
    
 
 from django.conf import settings
-from quinico.main.models import Config
-from quinico.main.models import Help
+from quinico.main import configs
 
 
 def help(request):
@@ -36,7 +35,7 @@ def help(request):
     help_blurb = None
 
     try:
-        help_blurb = Help.objects.filter(help_name=request.META['PATH_INFO']).values('help_value')[0]['help_value']
+        help_blurb = configs.help(request.META['PATH_INFO'])
     except Exception:
         pass
 
@@ -81,12 +80,12 @@ def redirect(request):
 
 def reports(request):
 
-    # See if we are disabling any reports (just load all configs)
+    # See if we are disabling any reports (the configs are cached)
     reports = {}
-    reports['disable_pagespeed'] = int(Config.objects.filter(config_name='disable_pagespeed_reports').values('config_value')[0]['config_value'])
-    reports['disable_keyword_rank'] = int(Config.objects.filter(config_name='disable_keyword_rank_reports').values('config_value')[0]['config_value'])
-    reports['disable_webpagetest'] = int(Config.objects.filter(config_name='disable_webpagetest_reports').values('config_value')[0]['config_value'])
-    reports['disable_seomoz'] = int(Config.objects.filter(config_name='disable_seomoz_reports').values('config_value')[0]['config_value'])
-    reports['disable_webmaster'] = int(Config.objects.filter(config_name='disable_webmaster_reports').values('config_value')[0]['config_value'])
+    reports['disable_pagespeed'] = int(configs.get('disable_pagespeed_reports'))
+    reports['disable_keyword_rank'] = int(configs.get('disable_keyword_rank_reports'))
+    reports['disable_webpagetest'] = int(configs.get('disable_webpagetest_reports'))
+    reports['disable_seomoz'] = int(configs.get('disable_seomoz_reports'))
+    reports['disable_webmaster'] = int(configs.get('disable_webmaster_reports'))
 
     return{'reports':reports}
\ No newline at end of file
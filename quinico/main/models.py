@@ -62,3 +62,26 @@ class Data_Job(models.Model):
     job_hour = models.CharField(max_length=50,blank=True)
     job_minute = models.CharField(max_length=25,blank=True)
 
+    # Bumped whenever the job saves new data (see quinico/main/cache.py)
+    data_version = models.IntegerField(default=0)
+
+
+class Work_Item(models.Model):
+    """Work Queue Items
+
+    The items of a data job run, shared by every process running the job
+    (see qclasses/qwork.py).  The item with an empty item_key is the run itself.
+    """
+
+    job_name = models.CharField(max_length=25)
+    run = models.CharField(max_length=20)
+    item_key = models.CharField(max_length=40,blank=True)
+    payload = models.TextField(blank=True)
+    state = models.IntegerField(default=0)
+    owner = models.CharField(max_length=100,blank=True)
+    lease_expires = models.DateTimeField(null=True,blank=True)
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['job_name','run','item_key']
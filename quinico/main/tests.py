@@ -5,7 +5,40 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import BaseHTTPServer
+import datetime
+import gzip
+import hashlib
+import logging
+import os
+import Queue
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.client import RequestFactory
+from qclasses import qhttp
+from qclasses import qlib
+from qclasses import qquota
+from qclasses import qretry
+from qclasses import qsql
+from qclasses import qwork
+from quinico.keyword_rank.models import API_Calls
+from quinico.keyword_rank.models import API_Errors
+from quinico.keyword_rank.models import Domain
+from quinico.keyword_rank.models import Keyword
+from quinico.keyword_rank.models import Rank
+from quinico.keyword_rank.models import Url
+from quinico.main import cache
+from quinico.main import configs
+from quinico.main.models import Config
+from quinico.main.models import Data_Job
+from quinico.main.models import Work_Item
 
 
 class SimpleTest(TestCase):
@@ -14,3 +47,847 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SQLTest(TransactionTestCase):
+    """Base class for tests of the qclasses that use the test database"""
+
+    def setUp(self):
+        db = settings.DATABASES['default']
+        self.qs = qsql.connect(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'])
+
+    def tearDown(self):
+        self.qs.close()
+
+
+class StatusTest(SQLTest):
+    """qsql.sql: threads sharing a connection see their own status"""
+
+    def test_threads(self):
+        """A failed statement in one thread does not show in another"""
+
+        failed = threading.Event()
+        done = threading.Event()
+        seen = []
+
+        def fail():
+            self.qs.execute('SELECT * FROM no_such_table')
+            failed.set()
+            done.wait(10)
+            seen.append((self.qs.status,self.qs.emessage != ''))
+
+        t = threading.Thread(target=fail)
+        t.start()
+        failed.wait(10)
+
+        self.assertEqual(self.qs.execute('SELECT 1')[1][0][0],1)
+        self.assertEqual(self.qs.status,0)
+        self.assertEqual(self.qs.emessage,'')
+
+        done.set()
+        t.join()
+
+        self.assertEqual(seen,[(1,True)])
+
+
+class QuotaTest(SQLTest):
+    """qquota.quota: API calls counted against a daily limit"""
+
+    def test_add(self):
+        """Calls and errors are added to the counts of today"""
+
+        API_Calls.objects.create(call_date=datetime.date.today(),count=5)
+
+        calls = qquota.quota(self.qs,None,False,interval=0)
+        calls.add('keyword_rank',2)
+        calls.add('keyword_rank',1,1)
+
+        self.assertEqual(calls.count('keyword_rank'),7)
+        self.assertEqual(API_Calls.objects.get().count,7)
+        self.assertEqual(API_Errors.objects.get().count,1)
+
+    def test_reserve(self):
+        """Calls are reserved until the limit is reached"""
+
+        calls = qquota.quota(self.qs,None,False)
+
+        self.assertEqual([calls.reserve('keyword_rank',2) for i in range(3)],[True,True,False])
+
+        calls.flush()
+        self.assertEqual(API_Calls.objects.get().count,2)
+
+    def test_reserve_shared(self):
+        """Processes sharing a quota cannot exceed the limit together"""
+
+        # Someone else has already made a call today
+        API_Calls.objects.create(call_date=datetime.date.today(),count=1)
+
+        db = settings.DATABASES['default']
+        other_qs = qsql.connect(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'])
+        try:
+            first = qquota.quota(self.qs,None,False,shared=True)
+            second = qquota.quota(other_qs,None,False,shared=True)
+
+            reserved = []
+            for i in range(3):
+                reserved.append(first.reserve('keyword_rank',4))
+                reserved.append(second.reserve('keyword_rank',4))
+        finally:
+            other_qs.close()
+
+        self.assertEqual(reserved,[True,True,True,False,False,False])
+        self.assertEqual(API_Calls.objects.get().count,4)
+
+    def test_reserve_shared_first(self):
+        """The first shared reservation of the day adds the row for today"""
+
+        calls = qquota.quota(self.qs,None,False,shared=True)
+
+        self.assertTrue(calls.reserve('keyword_rank',1))
+        self.assertFalse(calls.reserve('keyword_rank',1))
+        self.assertEqual(API_Calls.objects.get().count,1)
+
+
+class BreakerTest(TestCase):
+    """qretry.breaker: closed, open and half open"""
+
+    def setUp(self):
+        self.breaker = qretry.breaker('test',threshold=3,cooldown=60,max_cooldown=200)
+
+    def open(self):
+        """Fail until the breaker opens"""
+
+        for i in range(2):
+            self.assertEqual(self.breaker.failure(),None)
+            self.assertTrue(self.breaker.allow())
+
+        self.assertEqual(self.breaker.failure(),60)
+
+    def test_closed(self):
+        """Failures short of the threshold, or broken up by a success, keep it closed"""
+
+        for i in range(2):
+            self.breaker.failure()
+        self.breaker.success()
+        for i in range(2):
+            self.breaker.failure()
+
+        self.assertTrue(self.breaker.allow())
+
+    def test_open(self):
+        """The threshold opens it until the cool down has passed"""
+
+        self.open()
+
+        self.assertFalse(self.breaker.allow())
+        self.assertTrue(self.breaker.open_until > time.time() + 50)
+
+    def test_half_open(self):
+        """A single request is let through after the cool down"""
+
+        self.open()
+        self.breaker.open_until = 0
+
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.probing)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_success(self):
+        """A successful probe closes it"""
+
+        self.open()
+        self.breaker.open_until = 0
+        self.breaker.allow()
+        self.breaker.success()
+
+        self.assertFalse(self.breaker.probing)
+        self.assertEqual(self.breaker.failures,0)
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_failure(self):
+        """A failed probe reopens it for twice as long, up to max_cooldown"""
+
+        self.open()
+
+        for cooldown in (120,200,200):
+            self.breaker.open_until = 0
+            self.assertTrue(self.breaker.allow())
+            self.assertEqual(self.breaker.failure(),None)
+
+            self.assertFalse(self.breaker.probing)
+            self.assertEqual(self.breaker.current_cooldown,cooldown)
+            self.assertFalse(self.breaker.allow())
+
+        # Recovering resets the cool down
+        self.breaker.open_until = 0
+        self.breaker.allow()
+        self.breaker.success()
+        self.assertEqual(self.breaker.current_cooldown,60)
+
+    def test_half_open_limited(self):
+        """A rate limited probe ends the probe without counting as a failure"""
+
+        self.open()
+        self.breaker.open_until = 0
+        self.breaker.allow()
+        self.breaker.limited(300)
+
+        self.assertFalse(self.breaker.probing)
+        self.assertEqual(self.breaker.current_cooldown,60)
+        self.assertTrue(self.breaker.open_until > time.time() + 250)
+        self.assertFalse(self.breaker.allow())
+
+        # The next probe is let through once the delay has passed
+        self.breaker.open_until = 0
+        self.assertTrue(self.breaker.allow())
+
+    def test_limited_closed(self):
+        """Rate limiting alone never opens it"""
+
+        for i in range(5):
+            self.breaker.limited(300)
+
+        self.assertEqual(self.breaker.failures,0)
+        self.assertTrue(self.breaker.allow())
+
+
+class StandInHTTP:
+    """Stand-in for qhttp that always answers 503"""
+
+    def __init__(self):
+        self.requests = 0
+
+    def fetch(self,url,headers=None,method='GET',body=None):
+        self.requests += 1
+        return (503,{'retry-after':'0'},'unavailable')
+
+
+class StandInQuota:
+    """Stand-in for qquota that allows limit calls"""
+
+    def __init__(self):
+        self.reserved = 0
+
+    def reserve(self,table,limit):
+        if self.reserved >= limit:
+            return False
+        self.reserved += 1
+        return True
+
+    def add(self,table,count,error=None):
+        pass
+
+
+class FetchLimitTest(TestCase):
+    """qlib.http_fetch: retries of billed APIs count against the limit"""
+
+    def setUp(self):
+        self.http = StandInHTTP()
+        self.quota = StandInQuota()
+        self.ql = qlib.lib(None,None,False,logging.getLogger('quinico.tests'),self.quota,self.http,retries=3)
+
+        # A breaker that does not open during the test
+        qretry._shared['test_limit'] = qretry.breaker('test_limit',threshold=100)
+
+    def test_retries_reserved(self):
+        """Every attempt reserves a call and retrying stops at the limit"""
+
+        (code,response) = self.ql.http_fetch('test_limit','http://localhost/',limit=2)
+
+        self.assertEqual(code,503)
+        self.assertEqual(self.http.requests,2)
+        self.assertEqual(self.quota.reserved,2)
+
+    def test_maxed_out(self):
+        """Nothing is requested once the limit is reached"""
+
+        self.quota.reserved = 2
+
+        self.assertEqual(self.ql.http_fetch('test_limit','http://localhost/',limit=2),(None,None))
+        self.assertEqual(self.http.requests,0)
+
+    def test_unlimited(self):
+        """Without a limit every retry is made and nothing is reserved"""
+
+        self.ql.http_fetch('test_limit','http://localhost/')
+
+        self.assertEqual(self.http.requests,4)
+        self.assertEqual(self.quota.reserved,0)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive handler that records the client port of every request"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.ports.append(self.client_address[1])
+        self.server.encodings.append(self.headers.get('accept-encoding'))
+
+        if self.path == '/moved':
+            self.send_response(302)
+            self.send_header('Location','/')
+            self.send_header('Content-Length','0')
+            self.end_headers()
+            return
+
+        body = 'Hello'
+        self.send_response(200)
+
+        if self.path == '/gzip':
+            data = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=data,mode='wb')
+            f.write(body)
+            f.close()
+            body = data.getvalue()
+            self.send_header('Content-Encoding','gzip')
+
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        # Drop the connection without telling the client
+        if self.path == '/drop':
+            self.close_connection = 1
+
+    def log_message(self,*args):
+        pass
+
+
+class HTTPPoolTest(TestCase):
+    """qhttp.pool: keep-alive connections and gzipped responses"""
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1',0),StandInHandler)
+        self.server.ports = []
+        self.server.encodings = []
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.pool = qhttp.pool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """Requests to the same host reuse one connection"""
+
+        for i in range(3):
+            self.assertEqual(self.pool.request(self.url + '/'),(200,'Hello'))
+
+        self.assertEqual(len(set(self.server.ports)),1)
+
+    def test_gzip(self):
+        """Responses are requested gzipped and decompressed"""
+
+        self.assertEqual(self.pool.request(self.url + '/gzip'),(200,'Hello'))
+        self.assertEqual(self.server.encodings,['gzip'])
+
+    def test_redirect(self):
+        """Redirects are followed"""
+
+        self.assertEqual(self.pool.request(self.url + '/moved'),(200,'Hello'))
+        self.assertEqual(len(self.server.ports),2)
+
+    def test_stale(self):
+        """A connection closed by the server is replaced"""
+
+        self.assertEqual(self.pool.request(self.url + '/drop'),(200,'Hello'))
+        self.assertEqual(self.pool.request(self.url + '/'),(200,'Hello'))
+
+        self.assertEqual(len(set(self.server.ports)),2)
+
+
+def kill(qs):
+    """Have the server drop the connection of a qsql instance"""
+
+    (rowcount,rows) = qs.execute('SELECT CONNECTION_ID()')
+
+    db = settings.DATABASES['default']
+    other = qsql.sql(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'])
+    other.execute('KILL %s' % rows[0][0])
+    other.close()
+
+    return rows[0][0]
+
+
+class ReconnectTest(SQLTest):
+    """qsql.sql: reconnecting after the server drops the connection"""
+
+    def test_select(self):
+        """A SELECT is run again on a new connection"""
+
+        id = kill(self.qs)
+
+        (rowcount,rows) = self.qs.execute('SELECT CONNECTION_ID()')
+
+        self.assertEqual(self.qs.status,0)
+        self.assertNotEqual(rows[0][0],id)
+
+    def test_insert(self):
+        """A statement that may have been applied is not run again"""
+
+        kill(self.qs)
+
+        self.qs.execute('INSERT INTO keyword_rank_api_calls (call_date,count) VALUES (%s,1)',(datetime.date.today(),))
+        self.assertEqual(self.qs.status,1)
+        self.assertEqual(API_Calls.objects.count(),0)
+
+        # The connection is usable again
+        self.qs.execute('SELECT 1')
+        self.assertEqual(self.qs.status,0)
+
+    def test_transaction(self):
+        """Nothing is run again during a transaction"""
+
+        self.qs.begin()
+        kill(self.qs)
+
+        self.qs.execute('SELECT 1')
+        self.assertEqual(self.qs.status,1)
+        self.qs.rollback()
+
+        self.qs.execute('SELECT 1')
+        self.assertEqual(self.qs.status,0)
+
+
+class PoolTest(TestCase):
+    """qsql.pool: connections checked out and returned"""
+
+    def setUp(self):
+        db = settings.DATABASES['default']
+        self.pool = qsql.pool(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'],size=2,check=0,keep=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reuse(self):
+        """A returned connection is handed out again"""
+
+        qs = self.pool.get()
+        qs.close()
+
+        self.assertTrue(self.pool.get() is qs)
+        self.assertTrue(qs.checked_out)
+        qs.close()
+
+    def test_keep(self):
+        """Only keep idle connections stay open"""
+
+        first = self.pool.get()
+        second = self.pool.get()
+        first.close()
+        second.close()
+
+        self.assertEqual([qs for (qs,last_used) in self.pool.idle],[first])
+        self.assertEqual(second.db,None)
+
+    def test_check(self):
+        """An idle connection dropped by the server is reconnected before it is handed out"""
+
+        qs = self.pool.get()
+        kill(qs)
+        qs.close()
+
+        # Make sure the idle time is over check
+        time.sleep(0.01)
+
+        # The SELECT works the first time, it is not retried after an error
+        with self.pool.connection() as qs:
+            statements = qs.statements
+            qs.execute('SELECT 1')
+            self.assertEqual(qs.status,0)
+            self.assertEqual(qs.statements,statements + 1)
+
+
+class PoolReleaseTest(TestCase):
+    """qsql.pool: connections left checked out by a thread are returned"""
+
+    def setUp(self):
+        db = settings.DATABASES['default']
+        self.pool = qsql.pool(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'],size=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_release(self):
+        """Only the connections of the given thread are returned"""
+
+        held = []
+        t = threading.Thread(target=lambda: held.extend([self.pool.get(),self.pool.get()]))
+        t.start()
+        t.join()
+
+        self.assertEqual(self.pool.release(threading.current_thread()),0)
+        self.assertEqual(self.pool.release(t),2)
+
+        self.assertEqual([qs.checked_out for qs in held],[False,False])
+        self.assertEqual(len(self.pool.idle),2)
+
+        # Both are available again (get would block otherwise)
+        self.pool.get().close()
+        self.pool.get().close()
+
+
+class IterateTest(SQLTest):
+    """qsql.sql.iterate: rows read in batches"""
+
+    def setUp(self):
+        SQLTest.setUp(self)
+
+        for i in range(5):
+            url = 'http://www.example.com/%i' % i
+            Url.objects.create(url=url,url_hash=hashlib.sha1(url).hexdigest())
+
+    def test_batches(self):
+        """Every row is read, at most size at a time"""
+
+        batches = list(self.qs.iterate('SELECT url FROM keyword_rank_url ORDER BY id',size=2))
+
+        self.assertEqual(self.qs.status,0)
+        self.assertEqual([len(rows) for rows in batches],[2,2,1])
+        self.assertEqual([row[0] for rows in batches for row in rows],['http://www.example.com/%i' % i for i in range(5)])
+
+    def test_error(self):
+        """An error is reported in status"""
+
+        self.assertEqual(list(self.qs.iterate('SELECT nothing FROM keyword_rank_url')),[])
+        self.assertEqual(self.qs.status,1)
+
+    def test_stop(self):
+        """The connection can be used again once the caller stops reading"""
+
+        batches = self.qs.iterate('SELECT url FROM keyword_rank_url',size=1)
+        batches.next()
+        batches.close()
+
+        (rowcount,rows) = self.qs.execute('SELECT COUNT(*) FROM keyword_rank_url')
+        self.assertEqual(self.qs.status,0)
+        self.assertEqual(rows[0][0],5)
+
+
+class BulkTest(SQLTest):
+    """qsql.bulk: buffered inserts written a batch at a time"""
+
+    columns = ['date','domain_id','keyword_id','url_id','rank']
+
+    def setUp(self):
+        super(BulkTest,self).setUp()
+
+        self.domain = Domain.objects.create(domain='www.example.com',gl='us',googlehost='google.com')
+        self.keyword = Keyword.objects.create(keyword='example')
+        self.url = Url.objects.create(url='http://www.example.com/',url_hash=hashlib.sha1('http://www.example.com/').hexdigest())
+
+    def row(self,rank,domain_id=None):
+        if domain_id is None:
+            domain_id = self.domain.id
+        return ('2013-01-01',domain_id,self.keyword.id,self.url.id,rank)
+
+    def ranks(self):
+        return list(Rank.objects.order_by('rank').values_list('rank',flat=True))
+
+    def test_transactional(self):
+        """The tables written by the data jobs can roll a batch back"""
+
+        tables = ['keyword_rank_rank','keyword_rank_top_ten','pagespeed_score','pagespeed_rule_result',
+                  'pagespeed_rule_url','seomoz_metrics','webmaster_crawl_error',
+                  'webmaster_top_search_queries','webpagetest_score']
+
+        sql = 'SELECT table_name,engine FROM information_schema.tables WHERE table_schema=DATABASE() AND table_name IN (%s)'
+        (rowcount,rows) = self.qs.execute(sql % ','.join(['%s'] * len(tables)),tables)
+
+        self.assertEqual(sorted((t,e.lower()) for (t,e) in rows),sorted((t,'innodb') for t in tables))
+
+    def test_buffer(self):
+        """Rows are only written once size rows are buffered"""
+
+        writer = qsql.bulk(self.qs,'keyword_rank_rank',self.columns,size=3,interval=3600)
+
+        self.assertEqual(writer.add(self.row(1)),0)
+        self.assertEqual(writer.add(self.row(2)),0)
+        self.assertEqual(self.ranks(),[])
+
+        self.assertEqual(writer.add(self.row(3)),3)
+        self.assertEqual(self.ranks(),[1,2,3])
+
+    def test_flush(self):
+        """flush writes the buffered rows, in statements of at most size rows"""
+
+        writer = qsql.bulk(self.qs,'keyword_rank_rank',self.columns,size=2,interval=3600)
+        writer.rows = [self.row(i) for i in range(5)]
+
+        self.assertEqual(writer.flush(),5)
+        self.assertEqual(writer.status,0)
+        self.assertEqual(self.ranks(),range(5))
+        self.assertEqual(writer.flush(),0)
+
+    def test_values(self):
+        """The row template can hold sql"""
+
+        writer = qsql.bulk(self.qs,'keyword_rank_rank',self.columns,values='(%s,%s,%s,%s,%s + 10)')
+        writer.add(self.row(1))
+        writer.flush()
+
+        self.assertEqual(self.ranks(),[11])
+
+    def test_rollback(self):
+        """An error in any statement discards every row of the batch"""
+
+        writer = qsql.bulk(self.qs,'keyword_rank_rank',self.columns,size=2,interval=3600)
+
+        # The first statement succeeds, the second refers to a missing domain
+        writer.rows = [self.row(1),self.row(2),self.row(3),self.row(4,self.domain.id + 1000)]
+
+        self.assertEqual(writer.flush(),0)
+        self.assertEqual(writer.status,1)
+        self.assertNotEqual(writer.emessage,'')
+        self.assertEqual(writer.rows,[])
+        self.assertEqual(self.ranks(),[])
+
+        # The connection is usable again and the next batch is unaffected
+        writer.add(self.row(5))
+        self.assertEqual(writer.flush(),1)
+        self.assertEqual(writer.status,0)
+        self.assertEqual(self.ranks(),[5])
+
+
+class IdmapTest(SQLTest):
+    """qsql.idmap: value -> id lookups that add missing values"""
+
+    def test_insert(self):
+        """Missing values are added and their ids returned"""
+
+        urls = qsql.idmap(self.qs,'keyword_rank_url','url',hash_column='url_hash')
+        ids = urls.get_ids(['http://a/','http://b/','http://a/'])
+
+        self.assertEqual(urls.status,0)
+        self.assertEqual(sorted(ids.keys()),['http://a/','http://b/'])
+        self.assertEqual(Url.objects.get(url='http://a/').id,ids['http://a/'])
+        self.assertEqual(Url.objects.get(url='http://b/').url_hash,hashlib.sha1('http://b/').hexdigest())
+
+        # Already cached, nothing is added
+        self.assertEqual(urls.get_ids(['http://a/']),{'http://a/':ids['http://a/']})
+        self.assertEqual(Url.objects.count(),2)
+
+    def test_lookup(self):
+        """Values added by someone else are found by their hash"""
+
+        url = u'http://example.com/\u00e9'
+        existing = Url.objects.create(url=url,url_hash=hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+        urls = qsql.idmap(self.qs,'keyword_rank_url','url',hash_column='url_hash')
+
+        self.assertEqual(urls.get_ids([url]),{url:existing.id})
+        self.assertEqual(Url.objects.count(),1)
+
+    def test_load(self):
+        """load fills the cache from the table"""
+
+        existing = Url.objects.create(url='http://a/',url_hash=hashlib.sha1('http://a/').hexdigest())
+
+        urls = qsql.idmap(self.qs,'keyword_rank_url','url',hash_column='url_hash')
+        urls.load()
+
+        self.assertEqual(urls.ids,{'http://a/':existing.id})
+
+    def test_shared(self):
+        """Two maps adding the same value get the same id"""
+
+        first = qsql.idmap(self.qs,'keyword_rank_url','url',hash_column='url_hash')
+        second = qsql.idmap(self.qs,'keyword_rank_url','url',hash_column='url_hash')
+
+        self.assertEqual(first.get_ids(['http://a/']),second.get_ids(['http://a/']))
+        self.assertEqual(Url.objects.count(),1)
+
+
+class WorkQueueTest(SQLTest):
+    """qwork.queue: items claimed with a lease"""
+
+    def queue(self,**kwargs):
+        return qwork.queue(self.qs,None,False,'test','2013-01-01 00:00',**kwargs)
+
+    def expire(self):
+        """Expire every lease"""
+
+        self.qs.execute('UPDATE main_work_item SET lease_expires = NOW() - INTERVAL 1 SECOND')
+
+    def test_begin(self):
+        """Only the first process sets the run up"""
+
+        first = self.queue()
+        self.assertTrue(first.begin())
+        first.add([1,2])
+        first.ready()
+
+        self.assertFalse(self.queue().begin())
+
+    def test_begin_expired(self):
+        """A run whose set up was not finished is taken over"""
+
+        self.assertTrue(self.queue().begin())
+        self.expire()
+
+        self.assertTrue(self.queue(poll=0).begin())
+
+    def test_claim(self):
+        """Each item is claimed once"""
+
+        work = self.queue()
+        work.begin()
+        work.add([{'id':1},{'id':2},{'id':1}])
+        work.ready()
+
+        claimed = []
+        for i in range(2):
+            claimed.append(work.get())
+            work.task_done()
+
+        self.assertEqual(sorted(item['id'] for item in claimed),[1,2])
+        self.assertRaises(Queue.Empty,work.get)
+        self.assertEqual(work.failed(),0)
+
+    def test_expired(self):
+        """An item whose lease expires is claimed again, up to attempts times"""
+
+        work = self.queue(attempts=2,poll=0)
+        work.begin()
+        work.add([1])
+        work.ready()
+
+        self.assertEqual(work.get(),1)
+        self.expire()
+
+        self.assertEqual(work.get(),1)
+        self.assertEqual(Work_Item.objects.get(item_key__gt='').attempts,2)
+        self.expire()
+
+        self.assertRaises(Queue.Empty,work.get)
+        self.assertEqual(work.failed(),1)
+
+    def test_reclaimed(self):
+        """An item reclaimed and finished by another worker is not handed out again"""
+
+        work = self.queue(poll=0)
+        work.begin()
+        work.add([1])
+        work.ready()
+
+        self.assertEqual(work.get(),1)
+        self.expire()
+
+        other = self.queue(poll=0)
+        self.assertEqual(other.get(),1)
+        other.task_done()
+
+        self.assertRaises(Queue.Empty,work.get)
+        self.assertEqual(work.failed(),0)
+
+    def test_touch(self):
+        """A touched item keeps its lease"""
+
+        work = self.queue(poll=0)
+        work.begin()
+        work.add([1])
+        work.ready()
+
+        self.assertEqual(work.get(),1)
+        self.expire()
+
+        # Twice, as touching within the same second changes nothing
+        self.assertTrue(work.touch())
+        self.assertTrue(work.touch())
+
+        (rowcount,rows) = self.qs.execute("SELECT lease_expires > NOW() FROM main_work_item WHERE item_key<>''")
+        self.assertEqual(rows[0][0],1)
+
+    def test_touch_reclaimed(self):
+        """An item reclaimed by another worker is not the first worker's to finish"""
+
+        work = self.queue(poll=0)
+        work.begin()
+        work.add([1])
+        work.ready()
+
+        self.assertEqual(work.get(),1)
+        self.expire()
+
+        other = self.queue(poll=0)
+        other.owner = 'other:1'
+        self.assertEqual(other.get(),1)
+
+        self.assertFalse(work.touch())
+        work.task_done()
+        self.assertEqual(Work_Item.objects.get(item_key__gt='').state,1)
+
+        other.task_done()
+        self.assertEqual(Work_Item.objects.get(item_key__gt='').state,2)
+
+
+class CacheTest(TestCase):
+    """The response cache backends and keys"""
+
+    def test_memory(self):
+        """The least recently used entries are removed"""
+
+        responses = cache.memory(2)
+        responses.set('a',1)
+        responses.set('b',2)
+        responses.get('a')
+        responses.set('c',3)
+
+        self.assertEqual(responses.get('a'),1)
+        self.assertEqual(responses.get('b'),None)
+        self.assertEqual(responses.get('c'),3)
+
+    def test_files(self):
+        """The least recently used files are removed"""
+
+        path = tempfile.mkdtemp()
+        try:
+            responses = cache.files(path,2)
+            responses.set('a',(200,'A',[]))
+            responses.set('b',(200,'B',[]))
+
+            # Make the order of use certain, whatever the mtime resolution
+            os.utime(os.path.join(path,'a'),(1000,1000))
+            os.utime(os.path.join(path,'b'),(2000,2000))
+            responses.set('c',(200,'C',[]))
+
+            self.assertEqual(sorted(os.listdir(path)),['b','c'])
+            self.assertEqual(responses.get('a'),None)
+            self.assertEqual(responses.get('b'),(200,'B',[]))
+        finally:
+            shutil.rmtree(path)
+
+    def key(self,query,username='user',jobs=('pagespeed',)):
+        request = RequestFactory().get('/pagespeed/trends/',query)
+        request.user = User(username=username)
+
+        return cache.cache_key(request,jobs)
+
+    def test_key(self):
+        """The key covers the parameters, user, data version and configuration"""
+
+        Data_Job.objects.create(job_name='pagespeed')
+        Config.objects.create(config_name='config_version',friendly_name='Config Version',config_value='1',display='false')
+        configs.bump()
+
+        key = self.key({'format':'json','domain':'a','url':''})
+
+        # Order and blank parameters make no difference
+        self.assertEqual(self.key([('domain','a'),('format','json')]),key)
+
+        self.assertNotEqual(self.key({'format':'json','domain':'b'}),key)
+        self.assertNotEqual(self.key({'format':'json','domain':'a'},username='other'),key)
+
+        cache.bump('pagespeed')
+        self.assertNotEqual(self.key({'format':'json','domain':'a'}),key)
+        key = self.key({'format':'json','domain':'a'})
+
+        configs.bump()
+        self.assertNotEqual(self.key({'format':'json','domain':'a'}),key)
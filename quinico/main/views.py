@@ -23,8 +23,8 @@
 import datetime
 import logging
 import os
+import signal
 import sys
-from crontab import CronTab
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.http import HttpResponseRedirect
@@ -37,6 +37,7 @@ from quinico.keyword_rank.models import API_Errors as keyword_rank_errors
 from quinico.seomoz.models import API_Errors as seomoz_errors
 from quinico.pagespeed.models import API_Errors as pagespeed_errors
 from quinico.webpagetest.models import API_Errors as webpagetest_errors
+from quinico.main import configs
 from quinico.main.models import Config
 from quinico.main.models import Data_Job
 from quinico.main.forms import ConfigForm
@@ -85,7 +86,7 @@ def index(request):
             lights[api] = 'red'
     
     # See if there is an alert
-    alert = Config.objects.filter(config_name='alert').values('config_value')[0]['config_value']
+    alert = configs.get('alert')
 
     # Print the page
     return render_to_response(
@@ -99,6 +100,43 @@ def index(request):
     )
 
 
+def scheduler_pid(app_dir):
+    """Return the PID of the running data job scheduler (or None)
+
+    """
+
+    file = '%s/jobs/pid/scheduler.pid' % app_dir
+    if not os.path.exists(file):
+        return None
+
+    pidfile = open(file, "r")
+    pidfile.seek(0)
+    pid = pidfile.readline().strip()
+    pidfile.close()
+
+    # See if the PID is running
+    if pid.isdigit() and os.path.exists('/proc/%s' % pid):
+        return int(pid)
+    else:
+        return None
+
+
+def signal_scheduler(app_dir):
+    """Signal the data job scheduler to re-read the job schedules
+       - if it cannot be signalled it picks up the change within a minute
+
+    """
+
+    pid = scheduler_pid(app_dir)
+    if pid is None:
+        return
+
+    try:
+        os.kill(pid,signal.SIGHUP)
+    except OSError as e:
+        logger.error('Could not signal the data job scheduler (pid %s): %s' % (pid,e))
+
+
 @staff_member_required
 def datajobs(request):
     """Manage Data Jobs
@@ -127,25 +165,11 @@ def datajobs(request):
             webpagetest_hour = form.cleaned_data['webpagetest_hour']
             webpagetest_minute = form.cleaned_data['webpagetest_minute']
 
-            # Access the crontab
-            cron = CronTab()
-          
-            # Remove everything from the crontab - Quinico needs complete control to ensure there
-            # are no errors
-            cron.remove_all('')
-
             # Setup the Pagespeed job
             if 'pagespeed_enabled' in request.POST:
                 Data_Job.objects.filter(job_name='pagespeed').update(job_status=True,
                                                                      job_hour=pagespeed_hour,
                                                                      job_minute=pagespeed_minute)
-                # Schedule the job
-                job = cron.new(command='export PYTHONPATH=%s && %s/jobs/pagespeed.py' % (app_dir,app_dir),
-                               comment='Quinico Pagespeed Data Job')
-                nums = pagespeed_hour.split(',')
-                for num in nums:
-                    job.hour.on(num)
-                job.minute.on(pagespeed_minute)
             else:
                 Data_Job.objects.filter(job_name='pagespeed').update(job_status=False,
   								     job_hour=pagespeed_hour,
@@ -156,11 +180,6 @@ def datajobs(request):
                 Data_Job.objects.filter(job_name='webmaster').update(job_status=True,
                                                                      job_hour=webmaster_hour,
                                                                      job_minute=webmaster_minute)
-                # Schedule the job
-                job = cron.new(command='export PYTHONPATH=%s && %s/jobs/webmaster.py' % (app_dir,app_dir),
-                               comment='Quinico Webmaster Data Job')
-                job.hour.on(webmaster_hour)
-                job.minute.on(webmaster_minute)
             else:
                 Data_Job.objects.filter(job_name='webmaster').update(job_status=False,
   								     job_hour=webmaster_hour,
@@ -171,11 +190,6 @@ def datajobs(request):
                 Data_Job.objects.filter(job_name='seomoz').update(job_status=True,
                                                                      job_hour=seomoz_hour,
                                                                      job_minute=seomoz_minute)
-                # Schedule the job
-                job = cron.new(command='export PYTHONPATH=%s && %s/jobs/seomoz.py' % (app_dir,app_dir),
-                               comment='Quinico SEOMoz Data Job')
-                job.hour.on(seomoz_hour)
-                job.minute.on(seomoz_minute)
             else:
                 Data_Job.objects.filter(job_name='seomoz').update(job_status=False,
   								     job_hour=seomoz_hour,
@@ -186,11 +200,6 @@ def datajobs(request):
                 Data_Job.objects.filter(job_name='keyword_rank').update(job_status=True,
                                                                      job_hour=keyword_rank_hour,
                                                                      job_minute=keyword_rank_minute)
-                # Schedule the job
-                job = cron.new(command='export PYTHONPATH=%s && %s/jobs/keyword_rank.py' % (app_dir,app_dir),
-                               comment='Quinico Keyword Rank Data Job')
-                job.hour.on(keyword_rank_hour)
-                job.minute.on(keyword_rank_minute)
             else:
                 Data_Job.objects.filter(job_name='keyword_rank').update(job_status=False,
   								     job_hour=keyword_rank_hour,
@@ -201,20 +210,13 @@ def datajobs(request):
                 Data_Job.objects.filter(job_name='webpagetest').update(job_status=True,
                                                                      job_hour=webpagetest_hour,
                                                                      job_minute=webpagetest_minute)
-                # Schedule the job
-                job = cron.new(command='export PYTHONPATH=%s && %s/jobs/webpagetest.py' % (app_dir,app_dir),
-                               comment='Quinico Webpagetest Data Job')
-                nums = webpagetest_hour.split(',')
-                for num in nums:
-                    job.hour.on(num)
-                job.minute.on(webpagetest_minute)
             else:
                 Data_Job.objects.filter(job_name='webpagetest').update(job_status=False,
   								     job_hour=webpagetest_hour,
                                                                      job_minute=webpagetest_minute)
 
-            # Write out the crontab
-            cron.write()
+            # Let the scheduler know that the schedules have changed
+            signal_scheduler(app_dir)
 
             # Redirect back
             return HttpResponseRedirect('/admin/datajobs')
@@ -226,11 +228,8 @@ def datajobs(request):
     # Obtain what Quinico says should be scheduled 
     jobs = Data_Job.objects.values('job_name','job_status','job_hour','job_minute')
 
-    # Now obtain what the cron tab says is scheduled (if debug is requested)
-    if 'debug' in request.GET:
-        cron = CronTab()
-    else:
-        cron = None
+    # Check if the scheduler is running
+    scheduler = not scheduler_pid(app_dir) is None
 
     # Check if any jobs are running
     for job in jobs:
@@ -254,7 +253,7 @@ def datajobs(request):
        {
           'title':'Data Job Manager',
           'jobs':jobs,
-          'cron':cron,
+          'scheduler':scheduler,
           'form':form
        },
        context_instance=RequestContext(request)
@@ -314,6 +313,9 @@ def config(request):
                     print '%s is being updated' % param
                     Config.objects.filter(config_name=param).update(config_value=params[param])
 
+            # Have every process pick up the changes
+            configs.bump()
+
             # Redirect back
             return HttpResponseRedirect('/admin/config')
 
@@ -321,7 +323,8 @@ def config(request):
     else:
         form = ConfigForm()
 
-    configs = Config.objects.values('config_name',
+    # The config_version is kept up to date by Quinico, not the admin
+    config_list = Config.objects.exclude(config_name='config_version').values('config_name',
 				    'friendly_name',
 				    'config_value',
 				    'description',
@@ -333,7 +336,7 @@ def config(request):
        {
           'title':'Configuration Manager',
           'form':form,
-          'configs':configs
+          'configs':config_list
        },
        context_instance=RequestContext(request)
     )
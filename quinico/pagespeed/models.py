@@ -72,6 +72,7 @@ class Score(models.Model):
     """Pagespeed Score"""
 
     date = models.DateTimeField(null=False,blank=False)
+    local_date = models.DateField(null=False,blank=False)
     test = models.ForeignKey(Test)
     strategy = models.CharField(max_length=11)
     score = models.IntegerField(max_length=3)
@@ -90,3 +91,23 @@ class Score(models.Model):
 
     class Meta:
         unique_together = ['id','report']
+
+
+class Rule_Result(models.Model):
+    """Pagespeed rule result of a score's report"""
+
+    score = models.ForeignKey(Score)
+    rule_name = models.CharField(max_length=100, db_index=True)
+    formatted_name = models.CharField(max_length=255)
+    rule_score = models.IntegerField(max_length=3)
+    rule_impact = models.FloatField()
+
+
+class Rule_Url(models.Model):
+    """Urls (grouped in blocks) a Pagespeed rule result applies to"""
+
+    score = models.ForeignKey(Score)
+    rule_name = models.CharField(max_length=100)
+    block = models.IntegerField(max_length=11)
+    header = models.TextField()
+    url = models.TextField()
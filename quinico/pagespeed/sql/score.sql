@@ -0,0 +1 @@
+CREATE INDEX `pagespeed_score_test_strategy_local_date` ON `pagespeed_score` (`test_id`,`strategy`,`local_date`);
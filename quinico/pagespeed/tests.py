@@ -5,7 +5,21 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
+import imp
+import os
+from django.conf import settings
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from qclasses import qemail
+from qclasses import qsql
+from quinico.pagespeed import views
+from quinico.pagespeed.models import Domain
+from quinico.pagespeed.models import Rule_Result
+from quinico.pagespeed.models import Score
+from quinico.pagespeed.models import Test
+from quinico.pagespeed.models import Url
 
 
 class SimpleTest(TestCase):
@@ -14,3 +28,74 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+# The rule results of a Pagespeed report
+REPORT = {
+    'formattedResults': {
+        'ruleResults': {
+            'AvoidCssImport': {
+                'localizedRuleName': 'Avoid CSS @import',
+                'ruleScore': 60,
+                'ruleImpact': 12.5,
+                'urlBlocks': [
+                    {'header': {'format': 'The following stylesheets were included in $1',
+                                'args': [{'type': 'URL', 'value': 'http://www.example.com/'}]},
+                     'urls': [{'result': {'format': '$1 imports $2',
+                                          'args': [{'type': 'URL', 'value': 'http://www.example.com/a.css'},
+                                                   {'type': 'URL', 'value': 'http://www.example.com/b.css'}]}},
+                              {'result': {'format': 'http://www.example.com/c.css'}}]},
+                    {'header': {'format': 'Nothing else to report'}}
+                ]
+            },
+            'MinifyHTML': {
+                'localizedRuleName': 'Minify HTML',
+                'ruleScore': 100,
+                'ruleImpact': 0
+            }
+        }
+    }
+}
+
+
+class RulesTest(TransactionTestCase):
+    """The rule results saved with a score"""
+
+    def setUp(self):
+        # The job is a script, not a module of a package
+        self.job = imp.load_source('pagespeed_job',os.path.join(settings.APP_DIR,'jobs','pagespeed.py'))
+
+        db = settings.DATABASES['default']
+        self.qs = qsql.connect(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'])
+        self.qm = qemail.notify(settings.SMTP_HOST,settings.SMTP_SENDER,settings.SMTP_RECIPIENT)
+
+        test = Test.objects.create(domain=Domain.objects.create(domain='www.example.com'),url=Url.objects.create(url='/'))
+        self.results = [datetime.datetime(2013,1,31,12,0,0),test.id,'desktop',90] + [0] * 11 + ['report.json',datetime.date(2013,1,31)]
+
+    def tearDown(self):
+        self.qs.close()
+
+    def test_rules(self):
+        """The saved rules are shown the same as the rules of the report file"""
+
+        with override_settings(SMTP_NOTIFY_ERROR=False):
+            id = self.job.save_score(self.qm,self.qs,self.results,*self.job.extract_rules(REPORT))
+
+        by_name = lambda rules: sorted(rules,key=lambda r: r['name'])
+
+        self.assertEqual(by_name(views.report_rules(id)),by_name(views.report_file_rules(REPORT)))
+
+    def test_incomplete(self):
+        """A score whose rules can not all be saved is not saved either"""
+
+        # The rule urls can not be written
+        self.qs.execute('RENAME TABLE pagespeed_rule_url TO pagespeed_rule_url_away')
+        try:
+            with override_settings(SMTP_NOTIFY_ERROR=False):
+                id = self.job.save_score(self.qm,self.qs,self.results,*self.job.extract_rules(REPORT))
+        finally:
+            self.qs.execute('RENAME TABLE pagespeed_rule_url_away TO pagespeed_rule_url')
+
+        self.assertEqual(id,None)
+        self.assertEqual(Score.objects.count(),0)
+        self.assertEqual(Rule_Result.objects.count(),0)
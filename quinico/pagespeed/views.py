@@ -32,8 +32,11 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from quinico.main.models import Config
+from quinico.main import configs
+from quinico.main.cache import cache_response
 from quinico.pagespeed.models import Domain
+from quinico.pagespeed.models import Rule_Result
+from quinico.pagespeed.models import Rule_Url
 from quinico.pagespeed.models import Score
 from quinico.pagespeed.models import Test
 from quinico.pagespeed.models import Url
@@ -48,6 +51,138 @@ from quinico.dashboard.models import Dash_Settings
 logger = logging.getLogger(__name__)
 
 
+def report_file_rules(json_data):
+    """Return the rule results of a Pagespeed report file, for the template"""
+
+    # Report Results for the template, in this format
+    data = []
+    # data[{
+    #       name: 'AvoidCssImport'
+    #       formattedName: 'Avoid CSS @import',
+    #       score: 100,
+    #       impact: 0.1,
+    #       color: 'red',
+    #       urls: [
+    #              {
+    #               header: 'The following external stylesheets were included in http://www.foo.bar',
+    #		urls: [
+    #                      'http://www.foo.bar',
+    #                      'http://www.clown.com
+  	    #		      ]
+    #              }
+    #	      ]
+    #      }
+    #     ]
+    #
+
+    # Manipulate the data so its easier to provide in the template
+    for result in json_data['formattedResults']['ruleResults']:
+        # Create a temporary structure to hold this result
+        data_tmp = {}
+        data_tmp['name'] = result
+        data_tmp['formattedName'] = json_data['formattedResults']['ruleResults'][result]['localizedRuleName']
+        data_tmp['score'] = json_data['formattedResults']['ruleResults'][result]['ruleScore']
+        data_tmp['impact'] = json_data['formattedResults']['ruleResults'][result]['ruleImpact']
+
+        data_tmp['color'] = impact_color(data_tmp['impact'])
+
+        if 'urlBlocks' in json_data['formattedResults']['ruleResults'][result]:
+            
+            # We've got some URLs so create an array to hold them
+            data_tmp['urls'] = []
+
+            for block in json_data['formattedResults']['ruleResults'][result]['urlBlocks']:
+
+                # Each block will have its own dict
+                block_tmp = {}
+
+                ## First the Header ##
+
+                # The optimization, in human readable form
+                header = block['header']['format']
+
+                # If there are args, then we need to interpolate them in
+                if 'args' in block['header']:
+                    for counter,item in enumerate(block['header']['args'],start=1):
+                        header = header.replace('$%s' % counter,item['value'])
+
+                # Add the header
+                block_tmp['header'] = header
+
+                ## Now the Urls ##
+
+                # First see if there are urls
+                if 'urls' in block:
+
+                    urls_tmp = []
+
+                    for url in block['urls']:
+                        url_format = url['result']['format']
+
+                        # Now see if we need to interpolate
+                        if 'args' in url['result']:
+                            for counter,item in enumerate(url['result']['args'],start=1):
+                                url_format = url_format.replace('$%s' % counter,item['value'])
+
+                        urls_tmp.append(url_format)
+
+                    # Add the url data
+                    block_tmp['urls'] = urls_tmp
+
+                # Add the block data
+                data_tmp['urls'].append(block_tmp) 
+
+        # Add the tmp data structure
+        data.append(data_tmp)
+
+    return data
+
+
+def report_rules(id):
+    """Return the rule results saved for a Pagespeed score, for the template
+    (in the same format as report_file_rules)
+    """
+
+    data = []
+
+    # The urls of each rule, in blocks (a block without urls has none)
+    blocks = {}
+    last_block = {}
+    for row in Rule_Url.objects.filter(score_id=id).order_by('block','id').values('rule_name','block','header','url'):
+        rule_blocks = blocks.setdefault(row['rule_name'],[])
+        if last_block.get(row['rule_name']) != row['block']:
+            last_block[row['rule_name']] = row['block']
+            rule_blocks.append({'header':row['header']})
+        if row['url']:
+            rule_blocks[-1].setdefault('urls',[]).append(row['url'])
+
+    for result in Rule_Result.objects.filter(score_id=id).values('rule_name','formatted_name','rule_score','rule_impact'):
+        data_tmp = {}
+        data_tmp['name'] = result['rule_name']
+        data_tmp['formattedName'] = result['formatted_name']
+        data_tmp['score'] = result['rule_score']
+        data_tmp['impact'] = result['rule_impact']
+        data_tmp['color'] = impact_color(data_tmp['impact'])
+
+        if result['rule_name'] in blocks:
+            data_tmp['urls'] = blocks[result['rule_name']]
+
+        data.append(data_tmp)
+
+    return data
+
+
+def impact_color(impact):
+    """Return the color to display a rule result with"""
+
+    if impact >= 10:
+        return '#F62217'
+    elif impact < 10 and impact >= 2:
+        return '#FF9900'
+    else:
+        return '#6699FF'
+
+
 def report(request):
     """Pagespeed Report View
     Provide the full Pagespeed report
@@ -58,7 +193,7 @@ def report(request):
         id = form.cleaned_data['id']
 
         # Obtain the report download location
-        report_path = Config.objects.filter(config_name='report_path').values('config_value')[0]['config_value']
+        report_path = configs.get('report_path')
 
         # Obtain the report name
         details = Score.objects.filter(id=id).values('test_id','date','strategy','report')
@@ -75,111 +210,31 @@ def report(request):
         # Report
         report = details[0]['report']
  
-        try:
-            # Load the file
-            json_file = open('%s/%s' % (report_path,report))
-        except:
-            # Give the error page
-            return render_to_response(
-               'error/error.html',               
-               {
-                  'title':'Error',
-                  'error':'File not found:%s/%s' % (report_path,report)
-               },
-               context_instance=RequestContext(request)
-            )
-
-        # Deserialize it
-        json_data = json.load(json_file)
-
-        # Close the file
-        json_file.close()
-
-        # Report Results for the template, in this format
-        data = []
-        # data[{
-        #       name: 'AvoidCssImport'
-        #       formattedName: 'Avoid CSS @import',
-        #       score: 100,
-        #       impact: 0.1,
-        #       color: 'red',
-        #       urls: [
-        #              {
-        #               header: 'The following external stylesheets were included in http://www.foo.bar',
-        #		urls: [
-        #                      'http://www.foo.bar',
-        #                      'http://www.clown.com
-  	    #		      ]
-        #              }
-        #	      ]
-        #      }
-        #     ]
-        #
-
-        # Manipulate the data so its easier to provide in the template
-        for result in json_data['formattedResults']['ruleResults']:
-            # Create a temporary structure to hold this result
-            data_tmp = {}
-            data_tmp['name'] = result
-            data_tmp['formattedName'] = json_data['formattedResults']['ruleResults'][result]['localizedRuleName']
-            data_tmp['score'] = json_data['formattedResults']['ruleResults'][result]['ruleScore']
-            data_tmp['impact'] = json_data['formattedResults']['ruleResults'][result]['ruleImpact']
- 
-            if data_tmp['impact'] >= 10:
-                data_tmp['color'] = '#F62217'
-            elif data_tmp['impact'] < 10 and data_tmp['impact'] >= 2:
-                data_tmp['color'] = '#FF9900'
-            else:
-                data_tmp['color'] = '#6699FF'
-
-            if 'urlBlocks' in json_data['formattedResults']['ruleResults'][result]:
-                
-                # We've got some URLs so create an array to hold them
-                data_tmp['urls'] = []
-
-                for block in json_data['formattedResults']['ruleResults'][result]['urlBlocks']:
-
-                    # Each block will have its own dict
-                    block_tmp = {}
-
-                    ## First the Header ##
-
-                    # The optimization, in human readable form
-                    header = block['header']['format']
-
-                    # If there are args, then we need to interpolate them in
-                    if 'args' in block['header']:
-                        for counter,item in enumerate(block['header']['args'],start=1):
-                            header = header.replace('$%s' % counter,item['value'])
-
-                    # Add the header
-                    block_tmp['header'] = header
-
-                    ## Now the Urls ##
-
-                    # First see if there are urls
-                    if 'urls' in block:
-
-                        urls_tmp = []
-
-                        for url in block['urls']:
-                            url_format = url['result']['format']
-
-                            # Now see if we need to interpolate
-                            if 'args' in url['result']:
-                                for counter,item in enumerate(url['result']['args'],start=1):
-                                    url_format = url_format.replace('$%s' % counter,item['value'])
-
-                            urls_tmp.append(url_format)
+        # The rule results are saved when the report is collected (reports
+        # collected before then are read from the file)
+        data = report_rules(id)
+        if not data:
+            try:
+                # Load the file
+                json_file = open('%s/%s' % (report_path,report))
+            except:
+                # Give the error page
+                return render_to_response(
+                   'error/error.html',               
+                   {
+                      'title':'Error',
+                      'error':'File not found:%s/%s' % (report_path,report)
+                   },
+                   context_instance=RequestContext(request)
+                )
 
-                        # Add the url data
-                        block_tmp['urls'] = urls_tmp
+            # Deserialize it
+            json_data = json.load(json_file)
 
-                    # Add the block data
-                    data_tmp['urls'].append(block_tmp) 
+            # Close the file
+            json_file.close()
 
-            # Add the tmp data structure
-            data.append(data_tmp)        
+            data = report_file_rules(json_data)
 
         # Print the page
         return render_to_response(
@@ -208,6 +263,7 @@ def report(request):
         )
 
 
+@cache_response('pagespeed')
 def trends(request):
     """Pagespeed Trends View
     Allow graphing of individual pagespeed metrics over time
@@ -250,28 +306,16 @@ def trends(request):
                 date_to = date_to.strftime("%Y-%m-%d")
                 date_from = date_from.strftime("%Y-%m-%d")
 
-            # Add time information to the dates and the timezone (use the server's timezone)
-            # We need to keep the originals unchanged for the CSV link
-            date_from_tz = date_from
-            date_from_tz += ' 00:00:00'
-            date_from_tz = datetime.datetime.strptime(date_from_tz, '%Y-%m-%d %H:%M:%S')
-            date_from_tz = pytz.timezone(settings.TIME_ZONE).localize(date_from_tz)
-
-            date_to_tz = date_to
-            date_to_tz += ' 23:59:59'
-            date_to_tz = datetime.datetime.strptime(date_to_tz, '%Y-%m-%d %H:%M:%S')
-            date_to_tz = pytz.timezone(settings.TIME_ZONE).localize(date_to_tz)
-
     	    # Unquote the url to UTF-8 and then decode
     	    u_unenc = urllib.unquote(url.encode('utf-8')).decode('utf-8')
 
     	    # Obtain the scores for this test
-            # Convert the times to the server timezone first and then take the date portion
+            # The local (server timezone) date of each score is stored with it
     	    scores = Score.objects.filter(test_id__domain__domain=domain,
                                           test_id__url__url=u_unenc,
-                                          date__range=[date_from_tz,date_to_tz],
+                                          local_date__range=[date_from,date_to],
                                           strategy=strategy
-                                         ).extra({'date':"date(convert_tz(date,'%s','%s'))" % ('UTC',settings.TIME_ZONE)}
+                                         ).extra({'date':'local_date'}
                                          ).values('date').annotate(Avg(metric)).order_by('date')
 
             logger.debug(scores.query)
@@ -307,9 +351,9 @@ def trends(request):
 
                         if not dash_settings:
                             # Give the default
-                            dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                              'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                              'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                            dash_settings = [{'width':configs.get('dashboard_width'),
+                                              'height':configs.get('dashboard_height'),
+                                              'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
             		    'pagespeed/trends-db.html',
@@ -404,6 +448,7 @@ def trends(request):
     )
 
 
+@cache_response('pagespeed')
 def breakdown(request):
     """Pagespeed Page Breakdown View
     Allow visual representation of page components
@@ -458,15 +503,8 @@ def breakdown(request):
                         context_instance=RequestContext(request)
                      )
 
-            # DJango does not give us an easy way to match on the date of a datetime, so we'll do a range between
-            # 00:00:00 and 23:59:59
-            # From/To dates will be variants of the existing date 
-            # date is currently in the form Y-m-d
-
-            # Format the datetime as a date string - this will be the starting point for the from/to dates
+            # Format the datetime as a date string
             date = date.strftime('%Y-%m-%d')
-            d_from = date
-            d_to = date
 
             # Create forward/backward links for navigation if this is not an API request
             if not format:
@@ -477,22 +515,12 @@ def breakdown(request):
                 date_forward = (ref_date + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
                 forward_link = '/pagespeed/breakdown?domain=%s&url=%s&strategy=%s&date=%s' % (domain,url,strategy,date_forward)
 
-            # Make the from date the beginning of the day
-            # Convert back to a datetime
-            # Add our timezone
-            d_from += ' 00:00:00'
-            d_from = datetime.datetime.strptime(d_from,'%Y-%m-%d %H:%M:%S')
-            d_from = pytz.timezone(settings.TIME_ZONE).localize(d_from)
-
-            d_to += ' 23:59:59'
-            d_to = datetime.datetime.strptime(d_to,'%Y-%m-%d %H:%M:%S')
-            d_to = pytz.timezone(settings.TIME_ZONE).localize(d_to)
-
+            # Match on the local (server timezone) date stored with each score
             scores = Score.objects.filter(test_id__domain__domain=domain,
                                           test_id__url__url=u_unenc,
-                                          date__range=[d_from,d_to],
+                                          local_date=date,
                                           strategy=strategy,
-                                         ).extra({'date':"date(convert_tz(date,'%s','%s'))" % ('UTC',settings.TIME_ZONE)}
+                                         ).extra({'date':'local_date'}
                                          ).values('date').annotate(
     					                   Avg('numberResources'),
     					                   Avg('numberStaticResources'),
@@ -569,9 +597,9 @@ def breakdown(request):
 
                     if not dash_settings:
                         # Give the default
-                        dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                          'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                          'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                        dash_settings = [{'width':configs.get('dashboard_width'),
+                                          'height':configs.get('dashboard_height'),
+                                          'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
                         'pagespeed/breakdown-db2.html',
@@ -651,6 +679,7 @@ def breakdown(request):
     )
 
 
+@cache_response('pagespeed')
 def history(request):
     """Pagespeed History View
     Allow presentation of raw pagespeed data for a defined time range
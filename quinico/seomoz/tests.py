@@ -5,7 +5,12 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import imp
+import json
+import os
+from django.conf import settings
 from django.test import TestCase
+from django.test.utils import override_settings
 
 
 class SimpleTest(TestCase):
@@ -14,3 +19,75 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class StandInLib:
+    """Stand-in for qlib that answers every request with response"""
+
+    def __init__(self, response):
+        self.response = response
+        self.bodies = []
+
+    def http_request2(self,api,url,headers,count,error,body):
+        self.bodies.append(body)
+        return self.response
+
+
+class StandInWriter:
+    """Stand-in for qsql.bulk that keeps the rows"""
+
+    def __init__(self):
+        self.rows = []
+        self.status = 0
+
+    def add(self,row):
+        self.rows.append(row)
+
+
+class UrlMetricsTest(TestCase):
+    """Url metrics requested for a batch of urls at once"""
+
+    batch = [(1,'www.example.com/'),(2,'www.example.com/a')]
+
+    def setUp(self):
+        # The job is a script, not a module of a package
+        self.job = imp.load_source('seomoz_job',os.path.join(settings.APP_DIR,'jobs','seomoz.py'))
+        self.writer = StandInWriter()
+
+    def query(self,response):
+        ql = StandInLib(response)
+
+        with override_settings(SMTP_NOTIFY_ERROR=False):
+            self.job.query_urlmetrics(None,ql,self.writer,self.batch)
+
+        return ql
+
+    def test_batch(self):
+        """Every url of the batch gets a row, in order"""
+
+        ql = self.query(json.dumps([{'ueid':12,'umrp':4.56},{}]))
+
+        self.assertEqual(json.loads(ql.bodies[0]),['www.example.com/','www.example.com/a'])
+        self.assertEqual([row[0] for row in self.writer.rows],[1,2])
+
+        # Missing metrics are zero and fractions have one decimal
+        first = dict(zip(self.job.metrics,self.writer.rows[0][1:]))
+        self.assertEqual(first['ueid'],'12')
+        self.assertEqual(first['umrp'],'4.6')
+        self.assertEqual(first['pda'],'0')
+        self.assertEqual(self.writer.rows[1][1:],['0'] * len(self.job.metrics))
+
+    def test_mismatch(self):
+        """A response that does not match the batch is not saved"""
+
+        self.query(json.dumps([{'ueid':12}]))
+        self.query(json.dumps({'error_message':'Too many urls'}))
+
+        self.assertEqual(self.writer.rows,[])
+
+    def test_failed(self):
+        """Nothing is saved when the request fails"""
+
+        self.query(None)
+
+        self.assertEqual(self.writer.rows,[])
@@ -32,7 +32,8 @@ from quinico.seomoz.models import Url
 from quinico.seomoz.models import Metrics
 from quinico.seomoz.models import Competitor
 from quinico.seomoz.models import Description
-from quinico.main.models import Config
+from quinico.main import configs
+from quinico.main.cache import cache_response
 from quinico.dashboard.models import Dash_Settings
 from quinico.seomoz.forms import SEOTrendForm
 from quinico.seomoz.forms import SEODashboardForm
@@ -42,6 +43,7 @@ from quinico.seomoz.forms import SEODashboardForm
 logger = logging.getLogger(__name__)
 
 
+@cache_response('seomoz')
 def trends(request):
     """SEO Metrics Trends View
     Allow graphing of individual SEO metrics
@@ -114,9 +116,9 @@ def trends(request):
 
                     if not dash_settings:
                         # Give the default
-                        dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                         'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                         'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                        dash_settings = [{'width':configs.get('dashboard_width'),
+                                         'height':configs.get('dashboard_height'),
+                                         'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
                      'seomoz/trends-db.html',
@@ -172,7 +174,7 @@ def trends(request):
     urls = Url.objects.all().order_by('url')
 
     # See if the user has a free or paid account
-    account_type = Config.objects.filter(config_name='seomoz_account_type').values('config_value')
+    account_type = configs.get('seomoz_account_type')
 
     # Get the descriptions
     descriptions = Description.objects.values('metric','column_description','full_description')
@@ -202,6 +204,7 @@ def trends(request):
     )
 
 
+@cache_response('seomoz')
 def dashboard(request):
     """SEO Metrics Dashboard Index Page
     Create a dashboard of SEO metrics (including competitors)
@@ -229,7 +232,7 @@ def dashboard(request):
                     date = last_date[0]['date']
 
             # See if the user has a free or paid account
-            account_type = Config.objects.filter(config_name='seomoz_account_type').values('config_value')
+            account_type = configs.get('seomoz_account_type')
 
             # Obtain the SEO metrics for this url and any competitors for the requested date
             metrics = Metrics.objects.filter(url__url=url,date=date).values('url','ueid','feid','peid','ujid','uifq','uipl','uid','fid','pid','umrp','fmrp','pmrp','utrp','ftrp','ptrp','uemrp','fejp','pejp','fjp','pjp','fuid','puid','fipl','upa','pda')
@@ -36,7 +36,9 @@ from django.template import RequestContext
 from django.db.models import Sum, Count
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.mail import send_mail
-from quinico.main.models import Config
+from quinico.main import configs
+from quinico.main import cache
+from quinico.main.cache import cache_response
 from quinico.webmaster.models import Domain
 from quinico.webmaster.models import Crawl_Error
 from quinico.webmaster.models import Crawl_Error_Type
@@ -60,6 +62,7 @@ from quinico.dashboard.models import Dash_Settings
 logger = logging.getLogger(__name__)
 
 
+@cache_response('webmaster')
 def queries(request):
     """Google Search Queries Trends View
     Allow graphing of impressions and clicks in Google search for keywords
@@ -131,9 +134,9 @@ def queries(request):
 
 					if not dash_settings:
 						# Give the default
-						dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-		                                  'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-		                                  'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+						dash_settings = [{'width':configs.get('dashboard_width'),
+		                                  'height':configs.get('dashboard_height'),
+		                                  'font':configs.get('dashboard_font')}]
 
 					return render_to_response(
 				     'webmaster/queries-db.html',
@@ -222,6 +225,7 @@ def queries(request):
     )
 
 
+@cache_response('webmaster')
 def trends(request):
     """Webmaster Crawl Error Trends View
     Allow graphing of individual crawl error counts over time
@@ -286,9 +290,9 @@ def trends(request):
 
 				    if not dash_settings:
 					# Give the default
-					dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-		                              'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-		                              'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+					dash_settings = [{'width':configs.get('dashboard_width'),
+		                              'height':configs.get('dashboard_height'),
+		                              'font':configs.get('dashboard_font')}]
 
 				    return render_to_response(
 				     'webmaster/trends-db.html',
@@ -375,6 +379,7 @@ def trends(request):
     )
 
 
+@cache_response('webmaster')
 def total(request):
     """Webmaster Total Crawl Error Trends View
     Allow graphing of the total crawl error counts over time
@@ -433,9 +438,9 @@ def total(request):
 
 				    if not dash_settings:
 						# Give the default
-						dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-		                              	  'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-		                              	  'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+						dash_settings = [{'width':configs.get('dashboard_width'),
+		                              	  'height':configs.get('dashboard_height'),
+		                              	  'font':configs.get('dashboard_font')}]
 
 				    return render_to_response(
 				     'webmaster/total-db.html',
@@ -515,6 +520,7 @@ def total(request):
     )
 
 
+@cache_response('webmaster')
 def all(request):
     """Webmaster All Crawl Error Trends View (so, everything)
 
@@ -571,9 +577,9 @@ def all(request):
 
 				    if not dash_settings:
 						# Give the default
-						dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-		                              	  'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-		                              	  'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+						dash_settings = [{'width':configs.get('dashboard_width'),
+		                              	  'height':configs.get('dashboard_height'),
+		                              	  'font':configs.get('dashboard_font')}]
 
 				    return render_to_response(
 				     'webmaster/all-db.html',
@@ -725,6 +731,7 @@ def summary(request):
     )
 
 
+@cache_response('webmaster')
 def messages(request):
 	"""Webmaster Messages
 	Display and manage Google webmaster messages
@@ -848,6 +855,9 @@ def message_update(request):
 					m = 'The following Google webmaster message is assigned to you and has been updated:\n\nMessage Subject: %s.\nMessage URL: %s' % (subject,url)
 					send_mail('Quinico: Google Webmaster Message Update', m, settings.SMTP_URGENT_MESSAGES,[email_address], fail_silently=True)
 
+			# The cached message lists are out of date
+			cache.bump('webmaster')
+
 			# Send them to the message detail page with the updated data
 			return HttpResponseRedirect('/webmaster/message_detail?id=%s' % id)
 
@@ -941,6 +951,9 @@ def message_delete(request):
 		# Delete the message	
 		Messages.objects.filter(id=id).delete()
 
+		# The cached message lists are out of date
+		cache.bump('webmaster')
+
 		# Redirect back to the messages detail view
 		return HttpResponseRedirect('/webmaster/messages')
     
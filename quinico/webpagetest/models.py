@@ -84,6 +84,7 @@ class Score(models.Model):
     """Webpagetest Scores"""
 
     date = models.DateTimeField(null=False,blank=False)
+    local_date = models.DateField(null=False,blank=False)
     test = models.ForeignKey(Test)
     testId = models.CharField(max_length=25)
     viewNumber = models.IntegerField(max_length=1)
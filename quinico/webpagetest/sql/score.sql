@@ -0,0 +1 @@
+CREATE INDEX `webpagetest_score_test_view_local_date` ON `webpagetest_score` (`test_id`,`viewNumber`,`local_date`);
@@ -5,7 +5,29 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import BaseHTTPServer
+import imp
+import json
+import os
+import Queue
+import shutil
+import socket
+import tempfile
+import threading
+import urllib2
+import urlparse
+from django.conf import settings
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from qclasses import qemail
+from qclasses import qlib
+from qclasses import qsql
+from quinico.webpagetest.models import Domain
+from quinico.webpagetest.models import Location
+from quinico.webpagetest.models import Score
+from quinico.webpagetest.models import Test
+from quinico.webpagetest.models import Url
 
 
 class SimpleTest(TestCase):
@@ -14,3 +36,164 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+# A WPT XML report with one run of each view
+REPORT = """<?xml version="1.0" encoding="UTF-8"?>
+<response>
+ <statusCode>200</statusCode>
+ <data>
+  <successfulFVRuns>1</successfulFVRuns>
+  <successfulRVRuns>1</successfulRVRuns>
+  <run>
+   <id>1</id>
+   <firstView><results><loadTime>1200</loadTime><TTFB>300</TTFB><requests>20</requests></results></firstView>
+   <repeatView><results><loadTime>600</loadTime><TTFB>250</TTFB><requests>5</requests></results></repeatView>
+  </run>
+ </data>
+</response>"""
+
+
+class StandInWPT(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in WPT server
+
+    Tests submitted with a pingback url complete right away: the pingback
+    url is requested with the test id, like WPT does.
+    """
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(url.query)
+
+        if url.path == '/runtest.php':
+            testId = 'T%s' % len(self.server.submitted)
+            self.server.submitted.append(params)
+            body = json.dumps({'statusCode':200,
+                               'data':{'testId':testId,
+                                       'jsonUrl':'http://%s/jsonResult.php?test=%s' % (self.headers['host'],testId),
+                                       'xmlUrl':'http://%s/xmlResult/%s/' % (self.headers['host'],testId)}})
+
+            if 'pingback' in params:
+                t = threading.Thread(target=urllib2.urlopen,args=('%s?id=%s' % (params['pingback'][0],testId),))
+                t.daemon = True
+                t.start()
+
+        elif url.path == '/testStatus.php':
+            self.server.status_checks += 1
+            body = json.dumps({'statusCode':200})
+
+        elif url.path.startswith('/xmlResult/'):
+            body = REPORT
+
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+
+def free_port():
+    """Return a port that nothing is listening on"""
+
+    s = socket.socket()
+    s.bind(('127.0.0.1',0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+
+class PingbackTest(TransactionTestCase):
+    """The webpagetest job against a stand-in WPT server"""
+
+    def setUp(self):
+        # The job is a script, not a module of a package
+        self.job = imp.load_source('webpagetest_job',os.path.join(settings.APP_DIR,'jobs','webpagetest.py'))
+        self.job.report_path = tempfile.mkdtemp()
+        self.job.wpt_key = ''
+        self.job.wpt_wait = 1
+        self.job.wpt_attempts = 10
+
+        self.wpt = BaseHTTPServer.HTTPServer(('127.0.0.1',0),StandInWPT)
+        self.wpt.submitted = []
+        self.wpt.status_checks = 0
+        t = threading.Thread(target=self.wpt.serve_forever)
+        t.daemon = True
+        t.start()
+
+        db = settings.DATABASES['default']
+        self.qs = qsql.connect(db['HOST'],db['USER'],db['PASSWORD'],db['NAME'])
+        self.qm = qemail.notify(settings.SMTP_HOST,settings.SMTP_SENDER,settings.SMTP_RECIPIENT)
+        self.ql = qlib.lib(self.qs,self.qm,False,self.job.logger)
+
+        self.test = Test.objects.create(domain=Domain.objects.create(domain='www.example.com'),
+                                        url=Url.objects.create(url='/'),
+                                        location=Location.objects.create(location='Dulles'))
+
+    def tearDown(self):
+        self.wpt.shutdown()
+        self.wpt.server_close()
+        self.qs.close()
+        shutil.rmtree(self.job.report_path)
+
+    def test_pingback(self):
+        """Tests are collected when WPT requests the pingback url"""
+
+        port = free_port()
+        pingback = 'http://127.0.0.1:%s/' % port
+
+        with override_settings(WPT_SERVER='127.0.0.1:%s' % self.wpt.server_port,
+                               WPT_PINGBACK_URL=pingback,
+                               WPT_PINGBACK_PORT=port,
+                               SMTP_NOTIFY_ERROR=False):
+            server = self.job.start_pingback()
+            self.assertNotEqual(server,None)
+
+            test = self.job.submit_webpagetest(self.qm,self.ql,self.test.id,'www.example.com','/','Dulles',pingback)
+
+            queue = Queue.Queue()
+            self.job.wait_webpagetest(self.qm,self.ql,queue,[test],server.completed)
+            self.job.stop_pingback(server)
+
+            writer = self.job.create_writer(self.qs)
+            self.job.collect_webpagetest(self.qm,self.ql,writer,*queue.get(False))
+            writer.flush()
+
+        self.assertEqual(self.wpt.submitted[0]['pingback'],[pingback])
+        self.assertEqual(self.wpt.status_checks,0)
+
+        scores = Score.objects.filter(test=self.test).order_by('viewNumber')
+        self.assertEqual([(s.viewNumber,s.loadTime,s.ttfb,s.requests) for s in scores],[(1,1200,300,20),(2,600,250,5)])
+
+    def test_pingback_port_in_use(self):
+        """The status is polled when the pingback port cannot be listened on"""
+
+        s = socket.socket()
+        s.bind(('',0))
+        s.listen(1)
+        port = s.getsockname()[1]
+
+        try:
+            with override_settings(WPT_SERVER='127.0.0.1:%s' % self.wpt.server_port,
+                                   WPT_PINGBACK_URL='http://127.0.0.1:%s/' % port,
+                                   WPT_PINGBACK_PORT=port,
+                                   SMTP_NOTIFY_ERROR=False):
+                self.assertEqual(self.job.start_pingback(),None)
+
+                test = self.job.submit_webpagetest(self.qm,self.ql,self.test.id,'www.example.com','/','Dulles')
+
+                queue = Queue.Queue()
+                self.job.poll_webpagetest(self.qm,self.ql,queue,[test],1)
+        finally:
+            s.close()
+
+        self.assertFalse('pingback' in self.wpt.submitted[0])
+        self.assertEqual(self.wpt.status_checks,1)
+        self.assertEqual(queue.get(False),test)
@@ -31,7 +31,8 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
-from quinico.main.models import Config
+from quinico.main import configs
+from quinico.main.cache import cache_response
 from quinico.webpagetest.models import Test
 from quinico.webpagetest.models import Score
 from quinico.webpagetest.forms import WebpagetestHistoryForm
@@ -54,7 +55,7 @@ def report(request):
         id = form.cleaned_data['id']
 
         # Obtain the report download location
-        report_path = Config.objects.filter(config_name='report_path').values('config_value')[0]['config_value']
+        report_path = configs.get('report_path')
 
         # Obtain the report name
         details = Score.objects.filter(id=id).values('test_id','report')
@@ -97,6 +98,7 @@ def report(request):
     )
 
 
+@cache_response('webpagetest')
 def trends(request):
     """Webpagetest Trends View
     Allow graphing of individual Webpagetest metrics over time
@@ -139,18 +141,6 @@ def trends(request):
                 date_to = date_to.strftime("%Y-%m-%d")
                 date_from = date_from.strftime("%Y-%m-%d")
 
-            # Add time information to the dates and the timezone (use the server's timezone)
-            date_from = date_from
-            date_from += ' 00:00:00'
-            date_from = datetime.datetime.strptime(date_from, '%Y-%m-%d %H:%M:%S')
-            date_from = pytz.timezone(settings.TIME_ZONE).localize(date_from)
-
-            date_to = date_to
-            date_to += ' 23:59:59'
-            date_to = datetime.datetime.strptime(date_to, '%Y-%m-%d %H:%M:%S')
-            date_to = pytz.timezone(settings.TIME_ZONE).localize(date_to)
-
-
             # Obtain the domain, url and location for the chart display
             test = Test.objects.filter(id=test_id)
 
@@ -161,10 +151,10 @@ def trends(request):
 
     	    # Obtain the scores for this test
             scores1 = Score.objects.filter(test_id=test_id,
-                                           date__range=[date_from,date_to],
+                                           local_date__range=[date_from,date_to],
                                            viewNumber='1',
                                            test_failed__lte=test_failed,
-                                        ).extra({'date':"date(convert_tz(date,'%s','%s'))" % ('UTC',settings.TIME_ZONE)}
+                                        ).extra({'date':'local_date'}
                                         ).values('date').annotate(Avg(metric)).order_by('date')
 
             logger.debug(scores1.query)
@@ -172,10 +162,10 @@ def trends(request):
 
     	    # Obtain the scores for this test
             scores2 = Score.objects.filter(test_id=test_id,
-                                           date__range=[date_from,date_to],
+                                           local_date__range=[date_from,date_to],
                                            viewNumber='2',
                                            test_failed__lte=test_failed,
-                                         ).extra({'date':"date(convert_tz(date,'%s','%s'))" % ('UTC',settings.TIME_ZONE)}
+                                         ).extra({'date':'local_date'}
                                          ).values('date').annotate(Avg(metric)).order_by('date')
 
             logger.debug(scores2.query)
@@ -223,9 +213,9 @@ def trends(request):
 
                     if not dash_settings:
                         # Give the default
-                        dash_settings = [{'width':Config.objects.filter(config_name='dashboard_width').values('config_value')[0]['config_value'],
-                                          'height':Config.objects.filter(config_name='dashboard_height').values('config_value')[0]['config_value'],
-                                          'font':Config.objects.filter(config_name='dashboard_font').values('config_value')[0]['config_value']}]
+                        dash_settings = [{'width':configs.get('dashboard_width'),
+                                          'height':configs.get('dashboard_height'),
+                                          'font':configs.get('dashboard_font')}]
 
                     return render_to_response(
                         'webpagetest/trends-db.html',
@@ -291,6 +281,7 @@ def trends(request):
     )
 
 
+@cache_response('webpagetest')
 def history(request):
     """Webpagetest History View
     Allow presentation of raw webpagetest data for a defined time range